@@ -9,11 +9,15 @@ import threading
 import time
 import io
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 import PyPDF2
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, jsonify, render_template, request, send_file, session, redirect, url_for
 
 try:
@@ -765,44 +769,140 @@ def normalize_provider_name(provider_name: str, patient_name: str) -> str:
         return cleaned
     return pn
 
-def pubmed_fetch_for_terms(terms: List[str], max_items: int = 12) -> List[Dict[str, str]]:
+# NCBI E utilities. All calls go through one keep alive session instead of a new
+# connection per request. esummary JSON is large and compresses well; NCBI
+# honours gzip, and requests decodes it transparently.
+EUTILS_BASE = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+PUBMED_SESSION = requests.Session()
+PUBMED_SESSION.headers.update({"Accept-Encoding": "gzip, deflate"})
+# Throttled (429) and transient 5xx responses are retried with backoff instead of
+# silently dropping that query's results.
+PUBMED_WORKERS = int(os.getenv("PUBMED_WORKERS", "8"))
+PUBMED_SESSION.mount("https://", HTTPAdapter(pool_maxsize=PUBMED_WORKERS, max_retries=Retry(
+    total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",),
+)))
+# esearch queries fan out over this pool; the throttle below keeps them within NCBI's rate
+_PUBMED_EXECUTOR = ThreadPoolExecutor(max_workers=PUBMED_WORKERS, thread_name_prefix="pubmed")
+
+# With an API key NCBI allows 10 requests/s per key instead of 3/s per IP.
+NCBI_API_KEY = os.getenv("NCBI_API_KEY", "").strip()
+_EUTILS_INTERVAL = 0.1 if NCBI_API_KEY else 0.34
+_EUTILS_NEXT = 0.0
+_EUTILS_LOCK = threading.Lock()
+
+def eutils_params(**params: Any) -> Dict[str, Any]:
+    if NCBI_API_KEY:
+        params["api_key"] = NCBI_API_KEY
+    return params
+
+def eutils_wait() -> None:
+    """Space E-utilities request starts so concurrent callers stay under the NCBI rate limit."""
+    global _EUTILS_NEXT
+    with _EUTILS_LOCK:
+        now = time.monotonic()
+        start = max(now, _EUTILS_NEXT)
+        _EUTILS_NEXT = start + _EUTILS_INTERVAL
+    if start > now:
+        time.sleep(start - now)
+
+@lru_cache(maxsize=1024)
+def _esearch_ids(query: str) -> Tuple[str, ...]:
+    # Diagnoses repeat across analyses, so their queries do too. Failures
+    # raise and are not cached.
+    eutils_wait()
+    r = PUBMED_SESSION.get(
+        f"{EUTILS_BASE}/esearch.fcgi",
+        params=eutils_params(db="pubmed", term=query, retmax=12, retmode="json"),
+        timeout=10,
+    )
+    r.raise_for_status()
+    return tuple((r.json().get("esearchresult") or {}).get("idlist") or [])
+
+def pubmed_esearch(query: str) -> List[str]:
+    """PMIDs for one esearch query (memoized per process); [] on any failure."""
+    try:
+        return list(_esearch_ids(query))
+    except Exception:
+        return []
+
+# Canonical guideline searches per subspecialty, in query order. Keywords are
+# plain substrings of the lowercased term blob; each group is one compiled
+# alternation so the blob is scanned once per group rather than once per keyword.
+_SUBSPECIALTY_QUERIES: List[Tuple["re.Pattern[str]", List[str]]] = [
+    (re.compile("|".join(map(re.escape, words))), queries)
+    for words, queries in [
+        (["dry eye", "meibomian", "mgd", "blepharitis", "ocular surface", "rosacea"],
+         ["TFOS DEWS", "dry eye disease guideline ophthalmology"]),
+        (["cornea", "keratitis", "corneal", "ulcer", "ectasia", "keratoconus"],
+         ["infectious keratitis clinical guideline ophthalmology", "keratoconus global consensus"]),
+        (["cataract"],
+         ["cataract preferred practice pattern ophthalmology", "cataract guideline ophthalmology"]),
+        (["glaucoma", "ocular hypertension", "iop"],
+         ["glaucoma preferred practice pattern", "European Glaucoma Society guidelines"]),
+        (["strabismus", "amblyopia", "esotropia", "exotropia"],
+         ["amblyopia preferred practice pattern", "strabismus clinical practice guideline"]),
+        (["pediatric", "paediatric", "child", "infant"],
+         ["pediatric eye evaluations preferred practice pattern", "retinopathy of prematurity guideline"]),
+        (["optic neuritis", "papilledema", "neuro", "visual field defect", "sixth nerve", "third nerve", "fourth nerve"],
+         ["optic neuritis guideline", "papilledema evaluation guideline"]),
+        (["retina", "macular", "amd", "diabetic retinopathy", "retinal detachment", "uveitis", "vitreous"],
+         [
+             "diabetic retinopathy preferred practice pattern",
+             "age related macular degeneration preferred practice pattern",
+             "retinal detachment guideline",
+         ]),
+    ]
+]
+
+_AGE_PATTERNS = [
+    re.compile(r'\bage[:\s]+(\d{1,3})\b'),  # Age: 58
+    re.compile(r'(\d{1,3})\s*(?:y/?o|years?\s*old|yr)'),  # 58 y/o, 58yo, 58 years old
+    re.compile(r'\((\d{1,3})\)'),  # (58) - age in parentheses
+]
+_DOB_YEAR_PATTERNS = [
+    re.compile(r'(?:dob|born)[:\s]+(\d{4})[-/]\d{1,2}[-/]\d{1,2}'),  # DOB: 1965-05-12
+    re.compile(r'(?:dob|born)[:\s]+\d{1,2}[-/]\d{1,2}[-/](\d{4})'),  # DOB: 05/12/1965
+]
+
+def extract_patient_age(patient_block: str) -> Optional[int]:
+    """Patient age from an explicit age, else from the DOB year; None if neither parses."""
+    text = (patient_block or "").lower()
+    for pattern in _AGE_PATTERNS:
+        match = pattern.search(text)
+        if match and 0 < int(match.group(1)) < 120:
+            return int(match.group(1))
+    for pattern in _DOB_YEAR_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            age = datetime.now().year - int(match.group(1))
+            if 0 < age < 120:
+                return age
+    return None
+
+# Appended to every esearch query: records without an abstract carry no
+# signal for scoring, and adults never need pediatric literature, so NCBI
+# drops both before esummary instead of us filtering titles afterwards
+_PUBMED_ABSTRACT_FILTER = " AND hasabstract[text]"
+_PUBMED_ADULT_FILTER = " NOT (infant[MeSH] OR child[MeSH] OR pediatrics[MeSH] OR neonatal[Title])"
+
+def pubmed_fetch_for_terms(terms: List[str], max_items: int = 12, patient_age: Optional[int] = None) -> List[Dict[str, str]]:
     # NCBI E utilities. Keep it light to avoid rate limits.
     uniq_terms: List[str] = []
+    seen_terms = set()
     for t in (terms or []):
         t = (t or "").strip()
-        if t and t.lower() not in [x.lower() for x in uniq_terms]:
+        key = t.lower()
+        if t and key not in seen_terms:
+            seen_terms.add(key)
             uniq_terms.append(t)
 
     blob = " ".join(uniq_terms).lower()
 
     def add_queries_for_subspecialty(b: str) -> List[str]:
         q: List[str] = []
-        if any(k in b for k in ["dry eye", "meibomian", "mgd", "blepharitis", "ocular surface", "rosacea"]):
-            q += [
-                "TFOS DEWS" ,
-                "dry eye disease guideline ophthalmology",
-            ]
-        if any(k in b for k in ["cornea", "keratitis", "corneal", "ulcer", "ectasia", "keratoconus"]):
-            q += [
-                "infectious keratitis clinical guideline ophthalmology",
-                "keratoconus global consensus",
-            ]
-        if "cataract" in b:
-            q += ["cataract preferred practice pattern ophthalmology", "cataract guideline ophthalmology"]
-        if any(k in b for k in ["glaucoma", "ocular hypertension", "iop"]):
-            q += ["glaucoma preferred practice pattern", "European Glaucoma Society guidelines"]
-        if any(k in b for k in ["strabismus", "amblyopia", "esotropia", "exotropia"]):
-            q += ["amblyopia preferred practice pattern", "strabismus clinical practice guideline"]
-        if any(k in b for k in ["pediatric", "paediatric", "child", "infant"]):
-            q += ["pediatric eye evaluations preferred practice pattern", "retinopathy of prematurity guideline"]
-        if any(k in b for k in ["optic neuritis", "papilledema", "neuro", "visual field defect", "sixth nerve", "third nerve", "fourth nerve"]):
-            q += ["optic neuritis guideline", "papilledema evaluation guideline"]
-        if any(k in b for k in ["retina", "macular", "amd", "diabetic retinopathy", "retinal detachment", "uveitis", "vitreous"]):
-            q += [
-                "diabetic retinopathy preferred practice pattern",
-                "age related macular degeneration preferred practice pattern",
-                "retinal detachment guideline",
-            ]
+        for pattern, queries in _SUBSPECIALTY_QUERIES:
+            if pattern.search(b):
+                q += queries
         return q
 
     canonical_queries = add_queries_for_subspecialty(blob)
@@ -816,25 +916,25 @@ def pubmed_fetch_for_terms(terms: List[str], max_items: int = 12) -> List[Dict[s
         case_queries = ["ophthalmology clinical practice guideline"]
 
     queries = (canonical_queries[:6] + case_queries[:10])
+    suffix = _PUBMED_ABSTRACT_FILTER
+    if patient_age is not None and patient_age >= 18:
+        suffix += _PUBMED_ADULT_FILTER
+    queries = [f"({q}){suffix}" for q in queries]
 
+    # Queries run concurrently; PMIDs merge in query order, and once 40 are in
+    # hand the queries that have not started yet are cancelled
     pmids: List[str] = []
-    for q in queries:
-        try:
-            r = requests.get(
-                "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi",
-                params={"db": "pubmed", "term": q, "retmax": 12, "retmode": "json"},
-                timeout=10,
-            )
-            r.raise_for_status()
-            data = r.json()
-            ids = (data.get("esearchresult") or {}).get("idlist") or []
-            for pid in ids:
-                if pid not in pmids:
-                    pmids.append(pid)
-            if len(pmids) >= 40:
-                break
-        except Exception:
-            continue
+    seen_pmids = set()
+    futures = [_PUBMED_EXECUTOR.submit(pubmed_esearch, q) for q in queries]
+    for i, fut in enumerate(futures):
+        for pid in fut.result():
+            if pid not in seen_pmids:
+                seen_pmids.add(pid)
+                pmids.append(pid)
+        if len(pmids) >= 40:
+            for rest in futures[i + 1:]:
+                rest.cancel()
+            break
 
     if not pmids:
         return []
@@ -882,9 +982,10 @@ def pubmed_fetch_for_terms(terms: List[str], max_items: int = 12) -> List[Dict[s
         return score
 
     try:
-        r = requests.get(
-            "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi",
-            params={"db": "pubmed", "id": ",".join(pmids), "retmode": "json"},
+        eutils_wait()
+        r = PUBMED_SESSION.get(
+            f"{EUTILS_BASE}/esummary.fcgi",
+            params=eutils_params(db="pubmed", id=",".join(pmids), retmode="json"),
             timeout=10,
         )
         r.raise_for_status()
@@ -1542,7 +1643,7 @@ def run_analysis_job(job_id: str, note_text: str, specialty: str = "auto") -> No
             label = (dx.get("label") or "").strip()
             if label:
                 terms.append(label)
-    references = pubmed_fetch_for_terms(terms)
+    references = pubmed_fetch_for_terms(terms, patient_age=extract_patient_age(pb))
     canonical = canonical_reference_pool([dx.get('label') for dx in (analysis.get('diagnoses') or []) if isinstance(dx, dict)])
     analysis['references'] = merge_references(references, canonical)
 
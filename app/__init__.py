@@ -9,6 +9,7 @@ from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
 from config import config
+from app.utils.json_provider import OrjsonProvider
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -25,6 +26,7 @@ def create_app(config_name='default'):
                 template_folder='templates',
                 static_folder='static')
     app.config.from_object(config[config_name])
+    app.json = OrjsonProvider(app)
     
     # Initialize extensions
     db.init_app(app)
@@ -11,24 +11,40 @@ import threading
 import time
 import io
 import base64
+import copy
+import hashlib
+import html as html_lib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Set, Tuple, Union
 
-import PyPDF2
 import requests
-from flask import Blueprint, jsonify, request, send_file, current_app
+from flask import Blueprint, Response, jsonify, request, send_file, current_app, stream_with_context
 from flask_login import login_required, current_user
 
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
 except Exception:
     boto3 = None
+    TransferConfig = None
+    BotoConfig = None
 
 try:
     import fitz  # PyMuPDF
 except Exception:
     fitz = None
 
+try:
+    import PyPDF2  # text-layer fallback when PyMuPDF is missing
+except Exception:
+    PyPDF2 = None
+
 try:
     from PIL import Image
 except Exception:
@@ -50,24 +66,35 @@ if pytesseract is not None:
     except Exception:
         pass
 
+try:
+    import tesserocr
+except Exception:
+    tesserocr = None
+
 try:
     from openai import OpenAI
 except Exception:
     OpenAI = None
 
 try:
-    from reportlab.lib.pagesizes import letter as rl_letter
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_LEFT, TA_RIGHT, TA_JUSTIFY
-    from reportlab.lib import colors
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import pybase64
 except Exception:
-    SimpleDocTemplate = None
-    rl_letter = None
+    pybase64 = None
 
 api_bp = Blueprint('api', __name__)
+logger = logging.getLogger(__name__)
+
+# Package paths, resolved once
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+_STATIC_LETTERHEAD = os.path.join(_MODULE_DIR, "static", "img", "letterhead.png")
 
-# Job storage
+# Job storage. Entries are replaced, never mutated, so readers can take a
+# snapshot with a plain JOBS.get(); JOBS_LOCK only orders the writers.
 JOBS: Dict[str, Dict[str, Any]] = {}
 JOBS_LOCK = threading.Lock()
 JOB_DIR = os.getenv("JOB_DIR") or os.getenv("job_dir") or "/tmp/maneiro_jobs"
@@ -77,29 +104,138 @@ JOB_S3_PREFIX = (os.getenv("JOB_S3_PREFIX", "uploads/maneiro_jobs/") or "uploads
 if not JOB_S3_PREFIX.endswith("/"):
     JOB_S3_PREFIX += "/"
 
+# Heartbeat-only updates within this window stay local (memory + file)
+JOB_PERSIST_INTERVAL = float(os.getenv("JOB_PERSIST_INTERVAL", "1.0"))
+_HEARTBEAT_KEYS = frozenset({"heartbeat_at", "progress"})
+_LAST_PERSIST: Dict[str, Tuple[float, str]] = {}
+
+# Analysis jobs share one bounded pool so stale-job resumes can't pile up threads
+_ANALYSIS_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("MAX_ANALYSIS_WORKERS", "4")), thread_name_prefix="analysis")
+# Letter jobs are a single LLM call each; their own pool keeps them from queueing behind analyses
+_REPORT_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("MAX_REPORT_WORKERS", "8")), thread_name_prefix="report")
+# S3 job lookups probe the current and legacy keys at once rather than one round trip after another
+_S3_READ_EXECUTOR = ThreadPoolExecutor(max_workers=6, thread_name_prefix="s3-read")
+# Job snapshots queued for different jobs upload side by side (see _s3_writer_loop)
+_S3_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="s3-write")
+_ACTIVE_JOBS: Set[str] = set()
+_ACTIVE_JOBS_LOCK = threading.Lock()
+
+# Minimum seconds between AWS Transcribe lookups for one job; polls in between reuse the stored state
+TRANSCRIBE_POLL_INTERVAL = float(os.getenv("TRANSCRIBE_POLL_INTERVAL", "5"))
+_TRANSCRIBE_CHECKED: Dict[str, float] = {}
+# Jobs nobody has polled for this long were abandoned; their entries are swept
+_TRANSCRIBE_CHECKED_TTL = 3600.0
+
+# (inode, mtime_ns, size) of each job file as last written/read by this process
+_JOB_FILE_SIG: Dict[str, Tuple[int, int, int]] = {}
+
+# S3 job mirror runs on one background writer; latest snapshot per job wins
+_S3_PENDING: Dict[str, bytes] = {}
+_S3_COND = threading.Condition()
+_S3_INFLIGHT = 0
+_S3_WRITER: Optional[threading.Thread] = None
+
 
 # ============ Helper Functions ============
 
+_SAFE_ID_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
 def _job_path(job_id: str) -> str:
-    safe = re.sub(r"[^a-zA-Z0-9_]", "", job_id or "")
-    return os.path.join(JOB_DIR, f"{safe}.json")
+    return _job_path_in(JOB_DIR, job_id or "")
 
 
-def _ensure_job_dir() -> None:
+@lru_cache(maxsize=4096)
+def _job_path_in(job_dir: str, job_id: str) -> str:
+    safe = _SAFE_ID_RE.sub("", job_id)
+    return os.path.join(job_dir, f"{safe}.json")
+
+
+def _json_bytes(obj: Any) -> bytes:
+    """Serialize to UTF-8 JSON bytes (orjson when installed, stdlib otherwise)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _json_from_bytes(data: bytes) -> Any:
+    """Parse JSON bytes; tolerates invalid UTF-8 like the stdlib path did."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data.decode("utf-8", errors="ignore"))
+
+
+def _json_loads(text: str) -> Any:
+    """Parse a JSON string, via orjson when available."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def request_json() -> Dict[str, Any]:
+    """JSON object body of the current request, or {} (like get_json(silent=True) or {})."""
+    if not request.is_json:
+        return {}
     try:
-        os.makedirs(JOB_DIR, exist_ok=True)
-    except Exception:
-        pass
+        payload = _json_loads(request.get_data(cache=False))
+    except ValueError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
+def _stat_sig(st: os.stat_result) -> Tuple[int, int, int]:
+    # Every job write renames a fresh file into place, so the inode changes
+    # even when size and a coarse mtime tick do not
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _file_sig(path: str) -> Optional[Tuple[int, int, int]]:
     try:
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-    except Exception:
-        pass
+        return _stat_sig(os.stat(path))
+    except OSError:
+        return None
+
+
+# The (JOB_DIR, UPLOAD_DIR) pair last created, so per-call checks are one
+# comparison. Cleared when a job write fails, in case the dir was removed.
+_DIRS_READY: Optional[Tuple[str, str]] = None
+
+
+def _ensure_job_dir() -> None:
+    global _DIRS_READY
+    dirs = (JOB_DIR, UPLOAD_DIR)
+    if _DIRS_READY == dirs:
+        return
+    ok = True
+    for d in dirs:
+        try:
+            os.makedirs(d, exist_ok=True)
+        except Exception:
+            ok = False
+    if ok:
+        _DIRS_READY = dirs
+
+
+# Upload types the analysis pipeline accepts. Images go straight to Tesseract;
+# only PDFs are opened with PyMuPDF.
+_IMAGE_UPLOAD_EXTS = frozenset({".png", ".jpg", ".jpeg", ".webp"})
+_UPLOAD_EXTS = _IMAGE_UPLOAD_EXTS | {".pdf"}
+
+
+def _upload_ext(filename: str) -> str:
+    return os.path.splitext((filename or "").strip())[1].lower()
 
 
 def _upload_path(job_id: str, filename: str) -> str:
-    safe_id = re.sub(r"[^a-zA-Z0-9_]", "", job_id or "")
-    ext = os.path.splitext((filename or "").strip())[1].lower()
-    if ext not in (".pdf", ".png", ".jpg", ".jpeg", ".webp"):
+    safe_id = _SAFE_ID_RE.sub("", job_id or "")
+    ext = _upload_ext(filename)
+    if ext not in _UPLOAD_EXTS:
         ext = ".bin"
     return os.path.join(UPLOAD_DIR, f"{safe_id}{ext}")
 
@@ -116,10 +252,49 @@ def aws_ready() -> Tuple[bool, str]:
     return True, ""
 
 
+# Audio multipart parts; each in-flight part is buffered in memory, so the
+# worst case per upload is chunk size x concurrency (128 MB by default)
+AUDIO_UPLOAD_CHUNK_MB = int(os.getenv("AUDIO_UPLOAD_CHUNK_MB", "16"))
+AUDIO_UPLOAD_CONCURRENCY = int(os.getenv("AUDIO_UPLOAD_CONCURRENCY", "8"))
+
+
+@lru_cache(maxsize=1)
+def audio_transfer_config():
+    """Multipart settings for audio uploads: parts go up in parallel and retry individually."""
+    if TransferConfig is None:
+        return None
+    mb = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=8 * mb,
+        multipart_chunksize=AUDIO_UPLOAD_CHUNK_MB * mb,
+        max_concurrency=AUDIO_UPLOAD_CONCURRENCY,
+        use_threads=True,
+    )
+
+
+# SDK clients are built once per process (per config) so their connection
+# pools, and the TLS sessions in them, are reused across requests.
+# Construction is locked: boto3's default session is not thread-safe.
+_SDK_CLIENTS: Dict[Tuple[Any, ...], Any] = {}
+_SDK_CLIENTS_LOCK = threading.Lock()
+
+
+def _sdk_client(key: Tuple[Any, ...], factory: Callable[[], Any]) -> Any:
+    client = _SDK_CLIENTS.get(key)
+    if client is None:
+        with _SDK_CLIENTS_LOCK:
+            client = _SDK_CLIENTS.get(key)
+            if client is None:
+                client = _SDK_CLIENTS[key] = factory()
+    return client
+
+
 def aws_clients():
     region = os.getenv("AWS_REGION", "").strip() or None
-    s3 = boto3.client("s3", region_name=region)
-    transcribe = boto3.client("transcribe", region_name=region)
+    # Room for the multipart transfer threads plus concurrent job reads and writes
+    config = BotoConfig(max_pool_connections=32) if BotoConfig is not None else None
+    s3 = _sdk_client(("s3", region), lambda: boto3.client("s3", region_name=region, config=config))
+    transcribe = _sdk_client(("transcribe", region), lambda: boto3.client("transcribe", region_name=region))
     return s3, transcribe
 
 
@@ -132,12 +307,13 @@ def job_s3_enabled() -> bool:
 
 
 def job_s3_key(job_id: str) -> str:
-    safe = re.sub(r"[^a-zA-Z0-9_]", "", job_id or "")
+    safe = _SAFE_ID_RE.sub("", job_id or "")
     return f"{JOB_S3_PREFIX}{safe}.json"
 
 
-def job_s3_key_fallbacks(job_id: str) -> List[str]:
-    safe = re.sub(r"[^a-zA-Z0-9_]", "", job_id or "")
+@lru_cache(maxsize=4096)
+def job_s3_key_fallbacks(job_id: str) -> Tuple[str, ...]:
+    safe = _SAFE_ID_RE.sub("", job_id or "")
     keys = [f"{JOB_S3_PREFIX}{safe}.json"]
     legacy = "maneiro_jobs/"
     keys.append(f"{legacy}{safe}.json")
@@ -146,7 +322,7 @@ def job_s3_key_fallbacks(job_id: str) -> List[str]:
     for k in keys:
         if k not in out:
             out.append(k)
-    return out
+    return tuple(out)
 
 
 def s3_uri(bucket: str, key: str) -> str:
@@ -193,8 +369,7 @@ def fetch_transcribe_result(job_name: str) -> Tuple[str, str, str]:
     try:
         guess_key = f"{job_name}.json"
         obj = s3.get_object(Bucket=bucket, Key=guess_key)
-        body = obj["Body"].read()
-        data = json.loads(body.decode("utf-8", errors="ignore"))
+        data = _json_from_bytes(obj["Body"].read())
         txt = transcribe_json_to_text(data)
         if txt:
             return txt, "completed", ""
@@ -223,8 +398,7 @@ def fetch_transcribe_result(job_name: str) -> Tuple[str, str, str]:
         return "", status, "Unable to parse transcript key"
     try:
         obj = s3.get_object(Bucket=bucket, Key=key)
-        body = obj["Body"].read()
-        data = json.loads(body.decode("utf-8", errors="ignore"))
+        data = _json_from_bytes(obj["Body"].read())
         txt = transcribe_json_to_text(data)
         return txt, status, ""
     except Exception as e:
@@ -235,6 +409,18 @@ def now_utc_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+_TODAY_UTC: Tuple[int, str] = (-1, "")
+
+
+def today_utc_yyyymmdd() -> str:
+    """UTC date as YYYYMMDD, formatted once per day."""
+    global _TODAY_UTC
+    day = int(time.time() // 86400)
+    if _TODAY_UTC[0] != day:
+        _TODAY_UTC = (day, time.strftime("%Y%m%d", time.gmtime(day * 86400)))
+    return _TODAY_UTC[1]
+
+
 def parse_utc_iso(s: str) -> Optional[datetime]:
     try:
         if not s:
@@ -254,6 +440,56 @@ def clamp_text(s: str, limit: int) -> str:
     return (s or "")[:limit]
 
 
+_BR_RE = re.compile(r"<\s*br\s*/?\s*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+_MULTI_SPACE_RE = re.compile(r"\s{2,}")
+_REASON_REFERRAL_RE = re.compile(r"^Reason\s+for\s+Referral\s*:", re.IGNORECASE | re.MULTILINE)
+_REASON_REPORT_RE = re.compile(r"^Reason\s+for\s+Report\s*:", re.IGNORECASE | re.MULTILINE)
+# build_report: <br> and <p>/</p> become newlines, other tags go, in one pass
+_LETTER_MARKUP_RE = re.compile(r"(<\s*br\s*/?\s*>|<\s*/?p\s*>)|<[^>]+>", re.IGNORECASE)
+
+
+def _letter_markup_repl(m: "re.Match[str]") -> str:
+    return "\n" if m.group(1) else ""
+
+
+# signature_slug: strip titles, then collapse to an underscore slug
+_SIG_TITLE_RE = re.compile(r"\b(?:dr\.?|md|od|mba)\b")
+_SIG_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+
+def html_to_plain(html: str) -> str:
+    """Turn <br> into newlines and drop all other tags."""
+    if "<" not in (html or ""):
+        return html or ""
+    return _TAG_RE.sub("", _BR_RE.sub("\n", html))
+
+
+# html_to_prompt_text: list items become "- " lines, block ends become newlines
+_LI_OPEN_RE = re.compile(r"<\s*li\b[^>]*>", re.IGNORECASE)
+_BLOCK_END_RE = re.compile(r"<\s*(?:br\s*/?|/p|/li|/?ul|/?ol|/h[1-6]|/div)\s*>", re.IGNORECASE)
+_INLINE_SPACE_RE = re.compile(r"[ \t\r\f\v]+")
+
+
+def html_to_prompt_text(html: str, limit: int) -> str:
+    """Plain text of model-produced HTML, clipped to limit characters.
+
+    Markup is stripped before clipping, so the character budget goes to
+    clinical content and a cut can't land inside a tag.
+    """
+    text = html or ""
+    if "<" in text:
+        text = _LI_OPEN_RE.sub("- ", text)
+        text = _BLOCK_END_RE.sub("\n", text)
+        text = _TAG_RE.sub(" ", text)
+    if "&" in text:
+        text = html_lib.unescape(text)
+    text = _INLINE_SPACE_RE.sub(" ", text)
+    text = _BLANK_LINES_RE.sub("\n\n", "\n".join(line.strip() for line in text.split("\n")))
+    return clamp_text(text.strip(), limit)
+
+
 def transcribe_json_to_text(data: Dict[str, Any]) -> str:
     try:
         results = data.get("results") or {}
@@ -261,23 +497,28 @@ def transcribe_json_to_text(data: Dict[str, Any]) -> str:
         segments = speaker.get("segments") or []
         items = results.get("items") or []
         if segments and items:
-            by_time = {}
+            # Words keyed by start time; punctuation has no start time and drops out
+            by_time: Dict[str, List[str]] = {}
             for it in items:
                 st = it.get("start_time")
-                alts = it.get("alternatives") or []
-                content = (alts[0].get("content") if alts else "") or ""
-                if st and content:
-                    by_time.setdefault(st, []).append(content)
+                if not st:
+                    continue
+                alts = it.get("alternatives")
+                content = alts[0].get("content") if alts else None
+                if content:
+                    words_at = by_time.get(st)
+                    if words_at is None:
+                        by_time[st] = [content]
+                    else:
+                        words_at.append(content)
 
             lines = []
+            words_for = by_time.get
             for seg in segments:
                 label = (seg.get("speaker_label") or "Speaker").replace("spk_", "Speaker ")
-                seg_items = seg.get("items") or []
                 words = []
-                for sit in seg_items:
-                    st = sit.get("start_time")
-                    if st and st in by_time:
-                        words.extend(by_time.get(st) or [])
+                for sit in seg.get("items") or ():
+                    words.extend(words_for(sit.get("start_time"), ()))
                 line = (" ".join(words)).strip()
                 if line:
                     lines.append(f"{label}: {line}")
@@ -292,11 +533,31 @@ def transcribe_json_to_text(data: Dict[str, Any]) -> str:
         return ""
 
 
-def extract_pdf_text(file_storage) -> str:
-    reader = PyPDF2.PdfReader(file_storage)
+def _upload_source(source: Union[bytes, str]):
+    """File-like for in-memory bytes, or the path itself so readers stream from disk."""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return source
+
+
+def extract_pdf_text(source: Union[bytes, str]) -> str:
+    """Extract the text layer from PDF bytes or a path on disk."""
     parts: List[str] = []
-    for page in reader.pages:
-        parts.append(page.extract_text() or "")
+    if fitz is None:
+        reader = PyPDF2.PdfReader(_upload_source(source))
+        for page in reader.pages:
+            parts.append(page.extract_text() or "")
+        return "\n".join(parts).strip()
+
+    if isinstance(source, str):
+        doc = fitz.open(source, filetype="pdf")
+    else:
+        doc = fitz.open(stream=source, filetype="pdf")
+    try:
+        for page in doc:
+            parts.append(page.get_text("text") or "")
+    finally:
+        doc.close()
     return "\n".join(parts).strip()
 
 
@@ -309,59 +570,242 @@ def text_is_meaningful(text: str) -> bool:
     return ratio >= 0.25
 
 
-def ocr_pdf_bytes(pdf_bytes: bytes, max_pages: int = 12) -> Tuple[str, str]:
-    if fitz is None or Image is None or pytesseract is None:
-        return "", "OCR dependencies missing"
+# Clamp near-black and near-white pixels before OCR; applied with Image.point
+_OCR_LEVELS = [0 if x < 15 else (255 if x > 240 else x) for x in range(256)]
+
+_TESSDATA_DIRS = (
+    "/usr/share/tesseract-ocr/5/tessdata",
+    "/usr/share/tesseract-ocr/4.00/tessdata",
+    "/usr/share/tessdata",
+    "/usr/local/share/tessdata",
+    "/opt/homebrew/share/tessdata",
+)
+
+# In-process Tesseract engines, one per thread (the API is not thread-safe)
+# and reused across pages and requests
+_TESS_LOCAL = threading.local()
+_TESS_ERROR = ""
+_TESS_OK = False  # set once any engine has initialised in this process
+
+# Page recognition pool. Tesseract releases the GIL, so pages OCR in parallel.
+OCR_PAGE_WORKERS = int(os.getenv("OCR_PAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+_OCR_PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=OCR_PAGE_WORKERS, thread_name_prefix="ocr-page")
+
+# Pages are read at OCR_FIRST_DPI; only pages that come back weak (low mean
+# word confidence, or too little text) are re-rendered at OCR_RETRY_DPI
+OCR_FIRST_DPI = 150
+OCR_RETRY_DPI = 300
+OCR_MIN_CONFIDENCE = 70
+OCR_MIN_PAGE_CHARS = 100
+
+
+def _tessdata_dir() -> str:
+    env = os.getenv("TESSDATA_PREFIX", "").strip()
+    if env:
+        return env
+    for cand in _TESSDATA_DIRS:
+        if os.path.exists(os.path.join(cand, "eng.traineddata")):
+            return cand
+    return ""
+
+
+def _new_tess_engine():
+    path = _tessdata_dir()
+    return tesserocr.PyTessBaseAPI(path=path) if path else tesserocr.PyTessBaseAPI()
+
+
+def _tess_api():
+    """This thread's tesserocr engine, or None to fall back to the tesseract CLI."""
+    global _TESS_ERROR, _TESS_OK
+    engine = getattr(_TESS_LOCAL, "engine", None)
+    if engine is None and not _TESS_ERROR:
+        if tesserocr is None:
+            _TESS_ERROR = "tesserocr not available"
+        else:
+            try:
+                engine = _new_tess_engine()
+                _TESS_LOCAL.engine = engine
+                _TESS_OK = True
+            except Exception as e:
+                _TESS_ERROR = f"tesserocr init failed: {e}"
+    return engine
 
-    try:
-        _ = pytesseract.get_tesseract_version()
-    except Exception as e:
-        return "", f"OCR engine not available: {e}"
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    except Exception as e:
-        return "", f"Could not open PDF for OCR: {e}"
 
-    def prep(img):
+def _tess_available() -> bool:
+    """Whether tesserocr can start an engine, probed once without keeping one.
+
+    Readiness checks run on request and analysis threads; only the OCR page
+    pool should hold engines.
+    """
+    global _TESS_ERROR, _TESS_OK
+    if not _TESS_OK and not _TESS_ERROR:
+        if tesserocr is None:
+            _TESS_ERROR = "tesserocr not available"
+        else:
+            try:
+                _new_tess_engine().End()
+                _TESS_OK = True
+            except Exception as e:
+                _TESS_ERROR = f"tesserocr init failed: {e}"
+    return _TESS_OK
+
+
+def ocr_image(img, psm: int = 6) -> str:
+    """OCR one PIL image in-process via tesserocr, else through pytesseract."""
+    return ocr_image_conf(img, psm)[0]
+
+
+def ocr_image_conf(img, psm: int = 6) -> Tuple[str, Optional[int]]:
+    """OCR text plus Tesseract's mean word confidence (None from the CLI fallback)."""
+    engine = _tess_api()
+    if engine is not None:
+        engine.SetPageSegMode(psm)
+        engine.SetImage(img)
+        return engine.GetUTF8Text() or "", engine.MeanTextConf()
+    return pytesseract.image_to_string(img, config=f"--psm {psm}") or "", None
+
+
+def _ocr_page_image(page, dpi: int):
+    """Render a page straight to an 8-bit grayscale PIL image, levels clamped for OCR."""
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    # Read the pixmap in place (no samples copy); point() writes the only new buffer
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples_mv, "raw", "L", pix.stride, 1)
+    return img.point(_OCR_LEVELS)
+
+
+def _recognise_pages(
+    doc, indices: List[int], dpi: int, heartbeat: Optional[Callable[[], None]] = None
+) -> List[Tuple[str, Optional[int]]]:
+    """(text, confidence) for each page index, in order; a page that fails yields ("", 0).
+
+    MuPDF is not thread-safe, so pages render here one at a time while the
+    pool recognises the ones already rendered. `heartbeat` runs as each page
+    is collected, so long scans keep their job looking alive.
+    """
+    futures = []
+    for i in indices:
         try:
-            g = img.convert("L")
+            futures.append(_OCR_PAGE_EXECUTOR.submit(ocr_image_conf, _ocr_page_image(doc.load_page(i), dpi)))
         except Exception:
-            g = img
+            futures.append(None)
+    results: List[Tuple[str, Optional[int]]] = []
+    for fut in futures:
         try:
-            g = Image.eval(g, lambda x: 0 if x < 15 else (255 if x > 240 else x))
+            results.append(fut.result() if fut is not None else ("", 0))
         except Exception:
-            pass
-        return g
+            results.append(("", 0))
+        if heartbeat is not None:
+            heartbeat()
+    return results
 
-    parts: List[str] = []
+
+def _ocr_page_is_weak(text: str, conf: Optional[int]) -> bool:
+    if len(text.strip()) < OCR_MIN_PAGE_CHARS:
+        return True
+    return conf is not None and conf < OCR_MIN_CONFIDENCE
+
+
+def _ocr_pages(doc, indices: List[int], dpi: int, heartbeat: Optional[Callable[[], None]] = None) -> List[str]:
+    """OCR the given pages in order, re-reading weak pages at OCR_RETRY_DPI."""
+    results = _recognise_pages(doc, indices, dpi, heartbeat)
+    weak = [n for n, (text, conf) in enumerate(results) if _ocr_page_is_weak(text, conf)]
+    if weak and dpi < OCR_RETRY_DPI:
+        for n, retry in zip(weak, _recognise_pages(doc, [indices[n] for n in weak], OCR_RETRY_DPI, heartbeat)):
+            if retry[0].strip():
+                results[n] = retry
+    return [text for text, _ in results]
+
+
+# OCR text of recently seen PDFs, by content hash, next to the job files.
+# Retried and re-submitted uploads skip the OCR pass entirely.
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_MB", "64")) * 1024 * 1024
+
+
+def _ocr_cache_path(source: Union[bytes, str], max_pages: int, mode: str = "ocr") -> str:
+    h = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    else:
+        h.update(source)
+    key = h.hexdigest()
+    return os.path.join(JOB_DIR, "ocr_cache", key[:2], f"{key}_{mode}{max_pages}.txt")
+
+
+def _ocr_cache_get(path: str) -> Optional[str]:
     try:
-        pages = min(len(doc), max_pages)
-        for i in range(pages):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        os.utime(path)  # pruning goes by mtime, so a hit counts as a use
+        return text
+    except OSError:
+        return None
+
+
+def _ocr_cache_put(path: str, text: str) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        _prune_ocr_cache(os.path.dirname(os.path.dirname(path)))
+    except OSError:
+        pass
+
+
+def _prune_ocr_cache(root: str) -> None:
+    """Drop the least recently used entries once the cache outgrows OCR_CACHE_MAX_BYTES."""
+    entries = []
+    total = 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
             try:
-                page = doc.load_page(i)
-                pix = page.get_pixmap(dpi=220, alpha=False)
-                img = Image.open(io.BytesIO(pix.tobytes("png")))
-                img = prep(img)
-                txt = pytesseract.image_to_string(img, config="--psm 6") or ""
-                parts.append(txt)
-            except Exception:
-                parts.append("")
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= OCR_CACHE_MAX_BYTES:
+        return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= OCR_CACHE_MAX_BYTES:
+            break
 
-        joined = "\n".join(parts).strip()
-        if (not joined) or (len(joined) < 200):
-            retry_pages = min(pages, 3)
-            retry: List[str] = []
-            for i in range(retry_pages):
-                try:
-                    page = doc.load_page(i)
-                    pix = page.get_pixmap(dpi=300, alpha=False)
-                    img = Image.open(io.BytesIO(pix.tobytes("png")))
-                    img = prep(img)
-                    txt = pytesseract.image_to_string(img, config="--psm 6") or ""
-                    retry.append(txt)
-                except Exception:
-                    retry.append("")
-            parts = retry + parts[retry_pages:]
+
+def ocr_pdf_bytes(
+    pdf_bytes: Union[bytes, str], max_pages: int = 12, heartbeat: Optional[Callable[[], None]] = None
+) -> Tuple[str, str]:
+    """OCR a PDF given as bytes or as a path on disk (opened without loading it into RAM)."""
+    try:
+        cache_path = _ocr_cache_path(pdf_bytes, max_pages)
+    except OSError as e:
+        return "", f"Could not open PDF for OCR: {e}"
+    cached = _ocr_cache_get(cache_path)
+    if cached is not None:
+        return cached, ""
+
+    ok, msg = ocr_ready()
+    if not ok:
+        return "", msg
+    try:
+        if isinstance(pdf_bytes, str):
+            doc = fitz.open(pdf_bytes, filetype="pdf")
+        else:
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except Exception as e:
+        return "", f"Could not open PDF for OCR: {e}"
+
+    try:
+        pages = min(len(doc), max_pages)
+        parts = _ocr_pages(doc, list(range(pages)), OCR_FIRST_DPI, heartbeat=heartbeat)
     except Exception as e:
         return "", f"OCR failed: {e}"
     finally:
@@ -369,7 +813,88 @@ def ocr_pdf_bytes(pdf_bytes: bytes, max_pages: int = 12) -> Tuple[str, str]:
             doc.close()
         except Exception:
             pass
-    return "\n".join(parts).strip(), ""
+    text = "\n".join(parts).strip()
+    if text:
+        _ocr_cache_put(cache_path, text)
+    return text, ""
+
+
+def extract_or_ocr(
+    source: Union[bytes, str],
+    max_pages: int = 12,
+    on_ocr: Optional[Callable[[], None]] = None,
+    heartbeat: Optional[Callable[[], None]] = None,
+) -> Tuple[str, str, bool]:
+    """Text layer page by page, OCR'ing only scanned pages among the first `max_pages`.
+
+    A page is OCR'd when its own text layer is not meaningful and it carries
+    an image (inline images included), so typed pages of a hybrid PDF are
+    never rasterised. If the joined text layer is still not meaningful,
+    every text-poor page is OCR'd, whatever it draws with. `on_ocr`
+    runs just before any OCR starts and `heartbeat` after each OCR'd page.
+    Returns (text, error, ocr_attempted).
+    """
+    if fitz is None:
+        text = extract_pdf_text(source)
+        if text_is_meaningful(text):
+            return text, "", False
+        if on_ocr is not None:
+            on_ocr()
+        ocr_text, err = ocr_pdf_bytes(source, max_pages, heartbeat)
+        return ocr_text or text, err, True
+
+    try:
+        if isinstance(source, str):
+            doc = fitz.open(source, filetype="pdf")
+        else:
+            doc = fitz.open(stream=source, filetype="pdf")
+    except Exception as e:
+        return "", f"Could not open PDF: {e}", False
+
+    try:
+        parts: List[str] = []
+        scanned: List[int] = []
+        for i, page in enumerate(doc):
+            page_text = page.get_text("text") or ""
+            parts.append(page_text)
+            # get_image_info also sees inline (BI/ID/EI) images; get_images does not
+            if i < max_pages and not text_is_meaningful(page_text) and page.get_image_info():
+                scanned.append(i)
+        layer_text = "\n".join(parts).strip()
+        if not text_is_meaningful(layer_text):
+            scanned = [i for i, t in enumerate(parts[:max_pages]) if not text_is_meaningful(t)]
+        if not scanned:
+            return layer_text, "", False
+
+        try:
+            cache_path = _ocr_cache_path(source, max_pages, "mixed")
+        except OSError as e:
+            return layer_text, f"Could not open PDF for OCR: {e}", True
+        cached = _ocr_cache_get(cache_path)
+        if cached is not None:
+            return cached, "", True
+
+        ok, msg = ocr_ready()
+        if not ok:
+            # A usable text layer still beats failing the upload
+            return layer_text, ("" if text_is_meaningful(layer_text) else msg), True
+        if on_ocr is not None:
+            on_ocr()
+        try:
+            for i, ocr_text in zip(scanned, _ocr_pages(doc, scanned, OCR_FIRST_DPI, heartbeat=heartbeat)):
+                if ocr_text.strip():
+                    parts[i] = ocr_text
+        except Exception as e:
+            return layer_text, f"OCR failed: {e}", True
+    finally:
+        try:
+            doc.close()
+        except Exception:
+            pass
+    text = "\n".join(parts).strip()
+    if text:
+        _ocr_cache_put(cache_path, text)
+    return text, "", True
 
 
 def ocr_ready() -> Tuple[bool, str]:
@@ -377,6 +902,8 @@ def ocr_ready() -> Tuple[bool, str]:
         return False, "PyMuPDF not available"
     if Image is None:
         return False, "Pillow not available"
+    if _tess_available():
+        return True, ""
     if pytesseract is None:
         return False, "pytesseract not available"
     try:
@@ -399,17 +926,66 @@ def model_name() -> str:
     return (os.getenv("OPENAI_MODEL", "").strip() or "gpt-4.1")
 
 
+def triage_model_name() -> str:
+    """Smaller model for fax triage, which is classification and extraction, not writing."""
+    return (os.getenv("TRIAGE_MODEL", "").strip() or "gpt-4.1-mini")
+
+
+# Retries for 408/409/429/5xx, connection errors and timeouts. The OpenAI SDK
+# backs off exponentially with jitter and honours Retry-After.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+
+
 def get_client():
     ok, _ = client_ready()
     if not ok:
         return None
     key = os.getenv("OPENAI_API_KEY").strip()
-    return OpenAI(api_key=key, timeout=60)
+    return _sdk_client(("openai", key), lambda: OpenAI(api_key=key, timeout=60, max_retries=LLM_MAX_RETRIES))
+
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+def _first_json_object(text: str) -> str:
+    """The first balanced {...} in text (string-aware), else first "{" to last "}"."""
+    start = text.find("{")
+    if start < 0:
+        return ""
+    depth = 0
+    in_str = escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    end = text.rfind("}")
+    return text[start:end + 1] if end > start else ""
 
 
 def safe_json_loads(s: str) -> Tuple[Optional[Dict[str, Any]], str]:
     if not s:
         return None, "Empty model output"
+
+    # JSON mode / structured outputs: the reply is normally the bare object
+    try:
+        obj = _json_loads(s)
+        if isinstance(obj, dict):
+            return obj, ""
+    except Exception:
+        pass
     
     # Strip markdown code blocks if present
     text = s.strip()
@@ -425,47 +1001,237 @@ def safe_json_loads(s: str) -> Tuple[Optional[Dict[str, Any]], str]:
             text = text.rsplit("```", 1)[0].strip()
     
     try:
-        obj = json.loads(text)
+        obj = _json_loads(text)
         if isinstance(obj, dict):
             return obj, ""
     except Exception:
         pass
     
     # Fallback: extract first JSON object from text
-    m = re.search(r"\{.*\}", text, flags=re.DOTALL)
-    if m:
-        try:
-            obj = json.loads(m.group(0))
-            if isinstance(obj, dict):
-                return obj, ""
-        except Exception:
-            pass
+    candidate = _first_json_object(text)
+    if candidate:
+        # Last resort repairs trailing commas, the most common model slip
+        for attempt in (candidate, _TRAILING_COMMA_RE.sub(r"\1", candidate)):
+            try:
+                obj = _json_loads(attempt)
+                if isinstance(obj, dict):
+                    return obj, ""
+            except Exception:
+                pass
     return None, "Model did not return valid json"
 
 
-def llm_json(prompt: str, temperature: float = 0.2) -> Tuple[Optional[Dict[str, Any]], str]:
+class LLMCache:
+    """Exact-match cache of parsed llm_json results, keyed on a hash of the request.
+
+    Entries are stored serialized so every hit hands back a fresh object the
+    caller can mutate. Only exact prompt matches are served: clinical prompts
+    that differ in a single value (patient, eye, measurement) embed almost
+    identically, so similarity matching could return another patient's letter.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, prompt: str, temperature: float, instructions: str = "") -> str:
+        h = hashlib.sha256()
+        for part in (model, f"{temperature:.3f}", instructions, prompt):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            body = entry[1]
+        return _json_from_bytes(body)
+
+    def set(self, key: str, obj: Dict[str, Any]) -> None:
+        body = _json_bytes(obj)
+        with self._lock:
+            self._data[key] = (time.monotonic(), body)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+LLM_CACHE = LLMCache(
+    maxsize=int(os.getenv("LLM_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+)
+
+
+# Running per-worker token totals by call kind, reported on /llm_usage
+LLM_USAGE: Dict[str, Dict[str, int]] = {}
+_LLM_USAGE_LOCK = threading.Lock()
+
+
+def llm_usage_snapshot() -> Dict[str, Dict[str, int]]:
+    with _LLM_USAGE_LOCK:
+        return {kind: dict(totals) for kind, totals in LLM_USAGE.items()}
+
+
+def record_llm_usage(kind: str, usage: Any = None, cache_hit: bool = False) -> None:
+    """Add one call's token usage (an OpenAI usage object) to LLM_USAGE and log it.
+
+    cached_prompt counts prompt tokens the provider served from its prompt
+    cache; cache_hits counts calls answered from LLM_CACHE without a request.
+    """
+    counts = {"calls": 0, "prompt": 0, "cached_prompt": 0, "completion": 0, "cache_hits": int(cache_hit)}
+    if usage is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        counts.update(
+            calls=1,
+            prompt=getattr(usage, "prompt_tokens", 0) or 0,
+            cached_prompt=getattr(details, "cached_tokens", 0) or 0,
+            completion=getattr(usage, "completion_tokens", 0) or 0,
+        )
+        logger.info(
+            "llm %s tokens: prompt=%d cached=%d completion=%d",
+            kind, counts["prompt"], counts["cached_prompt"], counts["completion"],
+        )
+    with _LLM_USAGE_LOCK:
+        totals = LLM_USAGE.setdefault(kind, dict.fromkeys(counts, 0))
+        for field, n in counts.items():
+            totals[field] += n
+
+
+_JSON_SYSTEM_PROMPT = (
+    "You are a JSON API. Return ONLY valid JSON with no markdown formatting, no code fences, "
+    "no explanations. Start your response with { and end with }."
+)
+
+
+def _llm_json_call(
+    prompt: str,
+    temperature: float,
+    instructions: str,
+    schema: Optional[Dict[str, Any]] = None,
+    max_tokens: Optional[int] = None,
+    model: str = "",
+) -> Tuple[Optional[Dict[str, Any]], str]:
     client = get_client()
     if client is None:
         ok, msg = client_ready()
         return None, msg or "Client not available"
+    extra: Dict[str, Any] = {}
+    if schema:
+        extra["response_format"] = {"type": "json_schema", "json_schema": schema}
+    else:
+        extra["response_format"] = {"type": "json_object"}
+    if max_tokens:
+        extra["max_tokens"] = max_tokens
     try:
         res = client.chat.completions.create(
-            model=model_name(),
+            model=model or model_name(),
             messages=[
-                {"role": "system", "content": "You are a JSON API. Return ONLY valid JSON with no markdown formatting, no code fences, no explanations. Start your response with { and end with }."},
+                {"role": "system", "content": _JSON_SYSTEM_PROMPT},
+                *([{"role": "system", "content": instructions}] if instructions else []),
                 {"role": "user", "content": prompt},
             ],
             temperature=temperature,
+            **extra,
         )
+        record_llm_usage(schema["name"] if schema else "json", getattr(res, "usage", None))
         text = (res.choices[0].message.content or "").strip()
-        obj, err = safe_json_loads(text)
-        if err:
-            return None, err
-        return obj, ""
+        return safe_json_loads(text)
     except Exception as e:
         return None, f"LLM request failed: {type(e).__name__}: {e}"
 
 
+# One lock per cache key while its completion is in flight
+_LLM_INFLIGHT: Dict[str, threading.Lock] = {}
+_LLM_INFLIGHT_LOCK = threading.Lock()
+
+
+def llm_json(
+    prompt: str,
+    temperature: float = 0.2,
+    cache: bool = False,
+    instructions: str = "",
+    schema: Optional[Dict[str, Any]] = None,
+    max_tokens: Optional[int] = None,
+    model: str = "",
+) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Run a JSON-mode completion. With cache=True, identical requests reuse a prior result.
+
+    Fixed task instructions go in `instructions` and are sent as a second
+    system message ahead of the prompt, so the provider's prompt cache can
+    reuse the shared prefix. A `schema` (an OpenAI json_schema block) makes
+    the provider enforce the reply shape, so the instructions need not spell
+    it out; `max_tokens` caps the reply length and `model` overrides
+    OPENAI_MODEL. Cached calls are also
+    single-flight: an identical request that arrives while one is running
+    (a double-click, a retry) waits for that result instead of paying for a
+    second call.
+    """
+    if not cache:
+        return _llm_json_call(prompt, temperature, instructions, schema, max_tokens, model)
+
+    cache_key = LLMCache.key(model or model_name(), prompt, temperature, instructions)
+    hit = LLM_CACHE.get(cache_key)
+    if hit is not None:
+        record_llm_usage(schema["name"] if schema else "json", cache_hit=True)
+        return hit, ""
+    with _LLM_INFLIGHT_LOCK:
+        key_lock = _LLM_INFLIGHT.setdefault(cache_key, threading.Lock())
+    try:
+        with key_lock:
+            hit = LLM_CACHE.get(cache_key)
+            if hit is not None:
+                record_llm_usage(schema["name"] if schema else "json", cache_hit=True)
+                return hit, ""
+            obj, err = _llm_json_call(prompt, temperature, instructions, schema, max_tokens, model)
+            if obj is not None and not err:
+                LLM_CACHE.set(cache_key, obj)
+            return obj, err
+    finally:
+        with _LLM_INFLIGHT_LOCK:
+            if _LLM_INFLIGHT.get(cache_key) is key_lock and not key_lock.locked():
+                del _LLM_INFLIGHT[cache_key]
+
+
+def llm_text_stream(
+    prompt: str, temperature: float = 0.2, instructions: str = "", max_tokens: Optional[int] = None
+) -> Iterator[str]:
+    """Yield plain-text completion deltas as the model produces them.
+
+    Raises RuntimeError before the first delta if the client is unavailable.
+    """
+    client = get_client()
+    if client is None:
+        ok, msg = client_ready()
+        raise RuntimeError(msg or "Client not available")
+    messages = [{"role": "system", "content": instructions}] if instructions else []
+    messages.append({"role": "user", "content": prompt})
+    stream = client.chat.completions.create(
+        model=model_name(),
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
+        **({"max_tokens": max_tokens} if max_tokens else {}),
+    )
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            record_llm_usage("stream", chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
 ANALYZE_SCHEMA: Dict[str, Any] = {
     "provider_name": "",
     "patient_block": "",
@@ -477,10 +1243,8 @@ ANALYZE_SCHEMA: Dict[str, Any] = {
 }
 
 
-def analyze_prompt(note_text: str) -> str:
-    excerpt = clamp_text(note_text, 16000)
-    return f"""
-You are an expert clinical documentation analyst trained in all medical specialties. Analyze this document thoroughly.
+# Everything in the analysis prompt ahead of the document excerpt
+_ANALYZE_PROMPT_HEAD = """You are an expert clinical documentation analyst trained in all medical specialties. Analyze this document thoroughly.
 
 STEP 1 - DOCUMENT CLASSIFICATION
 Determine what type of document this is:
@@ -526,7 +1290,7 @@ Go BEYOND simple extraction:
 - Cross-reference findings with standard clinical guidelines
 
 Output VALID JSON only:
-{{
+{
   "document_type": "string - one of: encounter_note, referral_request, consultation_report, lab_results, prescription, insurance_form, correspondence, other",
   "detected_specialty": "string - primary medical specialty of this document",
   "provider_name": "string - the authoring/sending clinician name and credentials",
@@ -535,7 +1299,7 @@ Output VALID JSON only:
   "summary_html": "string - EXACTLY 4 sections, NO MORE. Format: <p><b>Visit Context:</b> Reason for visit, relevant history, referral source.</p><p><b>Examination:</b></p><ul><li>VA: OD [value], OS [value]</li><li>IOP: OD [value] mmHg, OS [value] mmHg</li><li>Pupils: [all pupil findings]</li><li>Anterior segment: [lids, conjunctiva, cornea, AC, iris, lens - include ALL findings like LPI status, NSC grade, etc.]</li><li>Posterior segment: [vitreous, macula, vessels, periphery, C/D ratio - include ALL findings]</li><li>Imaging: [OCT, VF, photos, Optomap findings if any]</li></ul><p><b>Key Findings:</b> 1-2 sentences highlighting what is clinically significant. Do NOT repeat measurements.</p><p><b>Clinical Impression:</b> Brief synthesis. Do NOT list diagnoses here. STOP HERE - do not add any more sections.</p>",
   "chief_complaint": "string - main reason for visit or referral in one sentence",
   "diagnoses": [
-    {{
+    {
       "number": 1,
       "icd10_code": "string - REQUIRED ICD-10-CM code (e.g., E11.9, I10, J45.20)",
       "icd10_description": "string - official ICD-10 description for the code",
@@ -544,42 +1308,42 @@ Output VALID JSON only:
       "severity": "string - mild/moderate/severe/not specified",
       "urgency": "string - routine/soon/urgent/emergent",
       "coding_notes": "string - any notes about code selection (optional)"
-    }}
+    }
   ],
   "suggested_diagnoses": [
-    {{
+    {
       "icd10_code": "string - suggested ICD-10-CM code",
       "label": "string - potential diagnosis suggested by findings",
       "supporting_findings": ["findings that suggest this"],
       "reasoning": "string - why this should be considered",
       "confidence": "string - low/medium/high"
-    }}
+    }
   ],
   "plan": [
-    {{
+    {
       "number": 1,
       "title": "string - action item title",
       "bullets": ["specific details"],
       "aligned_dx_numbers": [1],
       "timeline": "string - when this should happen"
-    }}
+    }
   ],
   "unaddressed_findings": [
-    {{
+    {
       "finding": "string - the finding that wasn't addressed",
       "potential_significance": "string - why this might matter",
       "suggested_action": "string - what could be done"
-    }}
+    }
   ],
-  "referral_info": {{
+  "referral_info": {
     "is_referral": true/false,
     "referral_direction": "string - 'requesting' or 'responding'",
     "referring_to": "string - specialist/subspecialty being referred to",
     "referring_from": "string - who is making the referral",
     "reason_for_referral": "string - specific reason",
     "requested_service": "string - what they want done"
-  }},
-  "vital_signs": {{
+  },
+  "vital_signs": {
     "blood_pressure": "string - systolic/diastolic if available",
     "heart_rate": "string - bpm if available",
     "respiratory_rate": "string - if available",
@@ -588,25 +1352,25 @@ Output VALID JSON only:
     "height": "string - if available",
     "bmi": "string - if available",
     "o2_saturation": "string - if available"
-  }},
-  "clinical_values": {{
+  },
+  "clinical_values": {
     "labs": ["string - any lab values mentioned with results"],
     "imaging": ["string - any imaging findings"],
     "specialty_measurements": ["string - specialty-specific measurements (VA, IOP, EF%, FEV1, HbA1c, etc.)"]
-  }},
+  },
   "medications": [
-    {{
+    {
       "name": "string - medication name",
       "dose": "string - dose if specified",
       "frequency": "string - frequency if specified",
       "status": "string - current/new/discontinued/changed"
-    }}
+    }
   ],
   "allergies": ["string - any allergies mentioned"],
   "warnings": ["any critical findings or red flags that need immediate attention"],
   "clinical_pearls": ["brief insights that might help the receiving clinician"],
   "follow_up": "string - recommended follow-up timing"
-}}
+}
 
 ICD-10 CODING RULES (CRITICAL):
 1. EVERY diagnosis MUST have an icd10_code - never leave blank
@@ -644,8 +1408,23 @@ CLINICAL REASONING RULES:
 7. Never make up findings - only analyze what's actually documented
 
 Document to analyze:
-{excerpt}
-""".strip()
+"""
+
+
+def analyze_prompt(note_text: str) -> str:
+    return (_ANALYZE_PROMPT_HEAD + clamp_text(note_text, 16000)).rstrip()
+
+
+_AGE_PATTERNS = [
+    re.compile(r'\bage[:\s]+(\d{1,3})\b'),  # Age: 58
+    re.compile(r'(\d{1,3})\s*(?:y/?o|years?\s*old|yr)'),  # 58 y/o, 58yo, 58 years old
+    re.compile(r'\((\d{1,3})\)'),  # (58) - age in parentheses
+]
+_DOB_PATTERNS = [
+    re.compile(r'dob[:\s]+(\d{4})[-/](\d{1,2})[-/](\d{1,2})'),  # DOB: 1965-05-12
+    re.compile(r'dob[:\s]+(\d{1,2})[-/](\d{1,2})[-/](\d{4})'),  # DOB: 05/12/1965
+    re.compile(r'born[:\s]+(\d{4})[-/](\d{1,2})[-/](\d{1,2})'),  # Born: 1965-05-12
+]
 
 
 def extract_patient_age(patient_block: str) -> Optional[int]:
@@ -663,28 +1442,16 @@ def extract_patient_age(patient_block: str) -> Optional[int]:
     text = patient_block.lower()
     
     # Try explicit age patterns first
-    age_patterns = [
-        r'\bage[:\s]+(\d{1,3})\b',  # Age: 58
-        r'(\d{1,3})\s*(?:y/?o|years?\s*old|yr)',  # 58 y/o, 58yo, 58 years old
-        r'\((\d{1,3})\)',  # (58) - age in parentheses
-    ]
-    
-    for pattern in age_patterns:
-        match = re.search(pattern, text)
+    for pattern in _AGE_PATTERNS:
+        match = pattern.search(text)
         if match:
             age = int(match.group(1))
             if 0 < age < 120:  # Sanity check
                 return age
     
     # Try to calculate from DOB
-    dob_patterns = [
-        r'dob[:\s]+(\d{4})[-/](\d{1,2})[-/](\d{1,2})',  # DOB: 1965-05-12
-        r'dob[:\s]+(\d{1,2})[-/](\d{1,2})[-/](\d{4})',  # DOB: 05/12/1965
-        r'born[:\s]+(\d{4})[-/](\d{1,2})[-/](\d{1,2})',  # Born: 1965-05-12
-    ]
-    
-    for pattern in dob_patterns:
-        match = re.search(pattern, text)
+    for pattern in _DOB_PATTERNS:
+        match = pattern.search(text)
         if match:
             groups = match.groups()
             try:
@@ -702,16 +1469,25 @@ def extract_patient_age(patient_block: str) -> Optional[int]:
     return None
 
 
+PEDIATRIC_KEYWORDS = [
+    'pediatric', 'paediatric', 'child', 'children', 'infant',
+    'neonatal', 'neonate', 'newborn', 'adolescent', 'juvenile',
+    'retinopathy of prematurity', 'rop', 'amblyopia', 'strabismus',
+    'congenital', 'childhood'
+]
+# Keywords match from a word start and may take a suffix ("Pediatrics",
+# "neonates", "congenitally"); the acronym "rop" must be a whole word so it
+# does not match inside "European"
+_PEDIATRIC_RE = re.compile(
+    r"\b(?:rop\b|(?:" + "|".join(re.escape(k) for k in PEDIATRIC_KEYWORDS if k != "rop") + r")\w*)",
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=1024)
 def is_pediatric_reference(title: str) -> bool:
     """Check if a reference title indicates pediatric content."""
-    title_lower = (title or "").lower()
-    pediatric_keywords = [
-        'pediatric', 'paediatric', 'child', 'children', 'infant', 
-        'neonatal', 'neonate', 'newborn', 'adolescent', 'juvenile',
-        'retinopathy of prematurity', 'rop', 'amblyopia', 'strabismus',
-        'congenital', 'childhood'
-    ]
-    return any(kw in title_lower for kw in pediatric_keywords)
+    return bool(_PEDIATRIC_RE.search(title or ""))
 
 
 def pubmed_fetch_for_terms(terms: List[str], max_items: int = 12, patient_age: Optional[int] = None, detected_specialty: str = "") -> List[Dict[str, str]]:
@@ -733,15 +1509,33 @@ def canonical_reference_pool(labels, patient_age: Optional[int] = None, detected
     - NEJM, Lancet, JAMA key papers
     
     Filters out pediatric references if patient is adult (age >= 18).
+    The pool depends only on the normalized labels and adulthood, so it is
+    memoized; callers get fresh dicts they are free to mutate.
     """
-    blob = " ".join([str(x or "") for x in (labels or [])]).lower()
-    specialty = (detected_specialty or "").lower()
-    pool = []
-    
+    labels_key = tuple(dict.fromkeys(str(x).strip().casefold() for x in (labels or []) if x))
     is_adult = patient_age is not None and patient_age >= 18
-    is_pediatric_patient = patient_age is not None and patient_age < 18
+    return [dict(r) for r in _canonical_reference_pool_cached(labels_key, is_adult)]
+
+
+@lru_cache(maxsize=None)
+def _keyword_re(words: Tuple[str, ...]) -> "re.Pattern[str]":
+    return re.compile("|".join(map(re.escape, words)))
+
+
+def _mentions(blob: str, *words: str) -> bool:
+    """True if any of the words occurs in blob (substring match), via one compiled alternation."""
+    return _keyword_re(words).search(blob) is not None
+
+
+@lru_cache(maxsize=512)
+def _canonical_reference_pool_cached(labels_key: Tuple[str, ...], is_adult: bool) -> Tuple[Dict[str, str], ...]:
+    blob = " ".join(labels_key)
+    pool = []
 
     def add(pmid, citation, url="", source=""):
+        # Drop pediatric guidance for adults here rather than filtering the pool afterwards
+        if is_adult and is_pediatric_reference(citation):
+            return
         pool.append({
             "pmid": (pmid or ""),
             "citation": (citation or ""),
@@ -750,178 +1544,181 @@ def canonical_reference_pool(labels, patient_age: Optional[int] = None, detected
         })
 
     # ==================== CARDIOLOGY ====================
-    if any(k in blob for k in ["hypertension", "high blood pressure", "htn", "elevated bp"]):
+    if _mentions(blob, "hypertension", "high blood pressure", "htn", "elevated bp"):
         add("29133354", "2017 ACC/AHA Hypertension Guideline. J Am Coll Cardiol. 2018.", "https://pubmed.ncbi.nlm.nih.gov/29133354/", "ACC/AHA Guideline")
         add("", "AHA Hypertension Guidelines", "https://www.heart.org/en/health-topics/high-blood-pressure", "AHA")
     
-    if any(k in blob for k in ["heart failure", "chf", "hfref", "hfpef", "cardiomyopathy", "ef%", "ejection fraction"]):
+    if _mentions(blob, "heart failure", "chf", "hfref", "hfpef", "cardiomyopathy", "ef%", "ejection fraction"):
         add("35363499", "2022 AHA/ACC/HFSA Heart Failure Guideline. Circulation. 2022.", "https://pubmed.ncbi.nlm.nih.gov/35363499/", "ACC/AHA Guideline")
         add("", "ACCF/AHA Heart Failure Guidelines", "https://www.acc.org/guidelines", "ACC Guideline")
     
-    if any(k in blob for k in ["atrial fibrillation", "afib", "a-fib", "af", "flutter"]):
+    if _mentions(blob, "atrial fibrillation", "afib", "a-fib", "af", "flutter"):
         add("30686041", "2019 AHA/ACC/HRS Atrial Fibrillation Guideline. Circulation. 2019.", "https://pubmed.ncbi.nlm.nih.gov/30686041/", "ACC/AHA Guideline")
         add("33197159", "2020 ESC AF Guidelines. Eur Heart J. 2021.", "https://pubmed.ncbi.nlm.nih.gov/33197159/", "ESC Guideline")
     
-    if any(k in blob for k in ["coronary artery disease", "cad", "angina", "ischemic heart", "mi", "myocardial infarction", "stemi", "nstemi"]):
+    if _mentions(blob, "coronary artery disease", "cad", "angina", "ischemic heart", "mi", "myocardial infarction", "stemi", "nstemi"):
         add("34756653", "2021 ACC/AHA Chest Pain Guideline. Circulation. 2021.", "https://pubmed.ncbi.nlm.nih.gov/34756653/", "ACC/AHA Guideline")
         add("", "ACC/AHA Chronic Coronary Disease Guideline", "https://www.acc.org/guidelines", "ACC Guideline")
     
-    if any(k in blob for k in ["lipid", "cholesterol", "hyperlipidemia", "ldl", "statin"]):
+    if _mentions(blob, "lipid", "cholesterol", "hyperlipidemia", "ldl", "statin"):
         add("30586774", "2018 ACC/AHA Cholesterol Guideline. Circulation. 2019.", "https://pubmed.ncbi.nlm.nih.gov/30586774/", "ACC/AHA Guideline")
 
     # ==================== ENDOCRINOLOGY ====================
-    if any(k in blob for k in ["diabetes", "dm", "hba1c", "a1c", "hyperglycemia", "insulin"]):
+    if _mentions(blob, "diabetes", "dm", "hba1c", "a1c", "hyperglycemia", "insulin"):
         add("", "ADA Standards of Care in Diabetes 2024", "https://diabetesjournals.org/care/issue/47/Supplement_1", "ADA Guideline")
         add("36507645", "ADA Standards of Care 2023. Diabetes Care. 2023.", "https://pubmed.ncbi.nlm.nih.gov/36507645/", "ADA Guideline")
     
-    if any(k in blob for k in ["thyroid", "hypothyroid", "hyperthyroid", "tsh", "graves", "hashimoto"]):
+    if _mentions(blob, "thyroid", "hypothyroid", "hyperthyroid", "tsh", "graves", "hashimoto"):
         add("24243587", "ATA Guidelines for Hypothyroidism. Thyroid. 2014.", "https://pubmed.ncbi.nlm.nih.gov/24243587/", "ATA Guideline")
         add("27521067", "ATA Guidelines for Hyperthyroidism. Thyroid. 2016.", "https://pubmed.ncbi.nlm.nih.gov/27521067/", "ATA Guideline")
     
-    if any(k in blob for k in ["osteoporosis", "bone density", "dexa", "fracture risk"]):
+    if _mentions(blob, "osteoporosis", "bone density", "dexa", "fracture risk"):
         add("", "AACE Osteoporosis Guidelines", "https://www.aace.com/disease-state-resources/bone-and-parathyroid/clinical-practice-guidelines", "AACE Guideline")
 
     # ==================== PULMONOLOGY ====================
-    if any(k in blob for k in ["copd", "chronic obstructive", "emphysema", "chronic bronchitis"]):
+    if _mentions(blob, "copd", "chronic obstructive", "emphysema", "chronic bronchitis"):
         add("", "GOLD COPD Guidelines 2024", "https://goldcopd.org/", "GOLD Guideline")
         add("35537657", "GOLD 2023 Report. Am J Respir Crit Care Med. 2023.", "https://pubmed.ncbi.nlm.nih.gov/35537657/", "GOLD Guideline")
     
-    if any(k in blob for k in ["asthma", "wheezing", "bronchospasm"]):
+    if _mentions(blob, "asthma", "wheezing", "bronchospasm"):
         add("", "GINA Asthma Guidelines 2024", "https://ginasthma.org/", "GINA Guideline")
         add("36710336", "GINA 2023 Report. Eur Respir J. 2023.", "https://pubmed.ncbi.nlm.nih.gov/36710336/", "GINA Guideline")
     
-    if any(k in blob for k in ["pulmonary embolism", "pe", "dvt", "vte", "deep vein thrombosis"]):
+    if _mentions(blob, "pulmonary embolism", "pe", "dvt", "vte", "deep vein thrombosis"):
         add("27288144", "ACCP Antithrombotic Guidelines. Chest. 2016.", "https://pubmed.ncbi.nlm.nih.gov/27288144/", "ACCP Guideline")
     
-    if any(k in blob for k in ["sleep apnea", "osa", "cpap", "ahi"]):
+    if _mentions(blob, "sleep apnea", "osa", "cpap", "ahi"):
         add("", "AASM Sleep Apnea Guidelines", "https://aasm.org/clinical-resources/practice-standards/", "AASM Guideline")
 
     # ==================== GASTROENTEROLOGY ====================
-    if any(k in blob for k in ["gerd", "reflux", "heartburn", "ppi"]):
+    if _mentions(blob, "gerd", "reflux", "heartburn", "ppi"):
         add("33436068", "ACG GERD Guidelines. Am J Gastroenterol. 2022.", "https://pubmed.ncbi.nlm.nih.gov/33436068/", "ACG Guideline")
     
-    if any(k in blob for k in ["ibs", "irritable bowel", "constipation", "diarrhea"]):
+    if _mentions(blob, "ibs", "irritable bowel", "constipation", "diarrhea"):
         add("32883967", "ACG IBS Guidelines. Am J Gastroenterol. 2021.", "https://pubmed.ncbi.nlm.nih.gov/32883967/", "ACG Guideline")
     
-    if any(k in blob for k in ["hepatitis", "cirrhosis", "liver", "fatty liver", "nafld", "nash"]):
+    if _mentions(blob, "hepatitis", "cirrhosis", "liver", "fatty liver", "nafld", "nash"):
         add("35184914", "AASLD NAFLD Guidance. Hepatology. 2022.", "https://pubmed.ncbi.nlm.nih.gov/35184914/", "AASLD Guidance")
 
     # ==================== NEUROLOGY ====================
-    if any(k in blob for k in ["stroke", "tia", "cerebrovascular", "cva"]):
+    if _mentions(blob, "stroke", "tia", "cerebrovascular", "cva"):
         add("30879893", "AHA/ASA Stroke Guidelines. Stroke. 2019.", "https://pubmed.ncbi.nlm.nih.gov/30879893/", "AHA/ASA Guideline")
     
-    if any(k in blob for k in ["migraine", "headache", "tension headache"]):
+    if _mentions(blob, "migraine", "headache", "tension headache"):
         add("33355936", "AAN Migraine Prevention Guideline. Neurology. 2021.", "https://pubmed.ncbi.nlm.nih.gov/33355936/", "AAN Guideline")
     
-    if any(k in blob for k in ["epilepsy", "seizure", "anticonvulsant"]):
+    if _mentions(blob, "epilepsy", "seizure", "anticonvulsant"):
         add("", "AAN/AES Epilepsy Guidelines", "https://www.aan.com/Guidelines/", "AAN Guideline")
     
-    if any(k in blob for k in ["parkinson", "tremor", "movement disorder"]):
+    if _mentions(blob, "parkinson", "tremor", "movement disorder"):
         add("", "AAN Parkinson Disease Guidelines", "https://www.aan.com/Guidelines/", "AAN Guideline")
     
-    if any(k in blob for k in ["dementia", "alzheimer", "cognitive impairment", "mci"]):
+    if _mentions(blob, "dementia", "alzheimer", "cognitive impairment", "mci"):
         add("", "AAN Dementia Guidelines", "https://www.aan.com/Guidelines/", "AAN Guideline")
 
     # ==================== PSYCHIATRY ====================
-    if any(k in blob for k in ["depression", "major depressive", "mdd", "antidepressant"]):
+    if _mentions(blob, "depression", "major depressive", "mdd", "antidepressant"):
         add("", "APA Depression Treatment Guidelines", "https://psychiatryonline.org/guidelines", "APA Guideline")
     
-    if any(k in blob for k in ["anxiety", "gad", "panic", "anxiolytic"]):
+    if _mentions(blob, "anxiety", "gad", "panic", "anxiolytic"):
         add("", "APA Anxiety Disorders Guidelines", "https://psychiatryonline.org/guidelines", "APA Guideline")
     
-    if any(k in blob for k in ["bipolar", "mania", "mood stabilizer"]):
+    if _mentions(blob, "bipolar", "mania", "mood stabilizer"):
         add("", "APA Bipolar Disorder Guidelines", "https://psychiatryonline.org/guidelines", "APA Guideline")
 
     # ==================== RHEUMATOLOGY ====================
-    if any(k in blob for k in ["rheumatoid arthritis", "ra", "dmard", "methotrexate"]):
+    if _mentions(blob, "rheumatoid arthritis", "ra", "dmard", "methotrexate"):
         add("32319231", "ACR RA Treatment Guideline. Arthritis Care Res. 2021.", "https://pubmed.ncbi.nlm.nih.gov/32319231/", "ACR Guideline")
     
-    if any(k in blob for k in ["osteoarthritis", "oa", "degenerative joint"]):
+    if _mentions(blob, "osteoarthritis", "oa", "degenerative joint"):
         add("31908163", "ACR OA Guidelines. Arthritis Rheumatol. 2020.", "https://pubmed.ncbi.nlm.nih.gov/31908163/", "ACR Guideline")
     
-    if any(k in blob for k in ["gout", "uric acid", "hyperuricemia"]):
+    if _mentions(blob, "gout", "uric acid", "hyperuricemia"):
         add("32390306", "ACR Gout Guidelines. Arthritis Care Res. 2020.", "https://pubmed.ncbi.nlm.nih.gov/32390306/", "ACR Guideline")
     
-    if any(k in blob for k in ["lupus", "sle", "systemic lupus"]):
+    if _mentions(blob, "lupus", "sle", "systemic lupus"):
         add("", "ACR/EULAR Lupus Guidelines", "https://www.rheumatology.org/Practice-Quality/Clinical-Support/Clinical-Practice-Guidelines", "ACR Guideline")
 
     # ==================== INFECTIOUS DISEASE ====================
-    if any(k in blob for k in ["pneumonia", "cap", "community acquired"]):
+    if _mentions(blob, "pneumonia", "cap", "community acquired"):
         add("31573350", "ATS/IDSA CAP Guidelines. Am J Respir Crit Care Med. 2019.", "https://pubmed.ncbi.nlm.nih.gov/31573350/", "ATS/IDSA Guideline")
     
-    if any(k in blob for k in ["uti", "urinary tract infection", "pyelonephritis"]):
+    if _mentions(blob, "uti", "urinary tract infection", "pyelonephritis"):
         add("21292654", "IDSA UTI Guidelines. Clin Infect Dis. 2011.", "https://pubmed.ncbi.nlm.nih.gov/21292654/", "IDSA Guideline")
     
-    if any(k in blob for k in ["cellulitis", "skin infection", "abscess"]):
+    if _mentions(blob, "cellulitis", "skin infection", "abscess"):
         add("25091305", "IDSA Skin Infection Guidelines. Clin Infect Dis. 2014.", "https://pubmed.ncbi.nlm.nih.gov/25091305/", "IDSA Guideline")
 
     # ==================== NEPHROLOGY ====================
-    if any(k in blob for k in ["chronic kidney", "ckd", "renal insufficiency", "egfr", "creatinine"]):
+    if _mentions(blob, "chronic kidney", "ckd", "renal insufficiency", "egfr", "creatinine"):
         add("", "KDIGO CKD Guidelines", "https://kdigo.org/guidelines/", "KDIGO Guideline")
     
-    if any(k in blob for k in ["aki", "acute kidney injury", "acute renal"]):
+    if _mentions(blob, "aki", "acute kidney injury", "acute renal"):
         add("", "KDIGO AKI Guidelines", "https://kdigo.org/guidelines/", "KDIGO Guideline")
 
     # ==================== DERMATOLOGY ====================
-    if any(k in blob for k in ["psoriasis", "plaque psoriasis"]):
+    if _mentions(blob, "psoriasis", "plaque psoriasis"):
         add("30772098", "AAD Psoriasis Guidelines. J Am Acad Dermatol. 2019.", "https://pubmed.ncbi.nlm.nih.gov/30772098/", "AAD Guideline")
     
-    if any(k in blob for k in ["eczema", "atopic dermatitis", "dermatitis"]):
+    if _mentions(blob, "eczema", "atopic dermatitis", "dermatitis"):
         add("35183936", "AAD Atopic Dermatitis Guidelines. J Am Acad Dermatol. 2023.", "https://pubmed.ncbi.nlm.nih.gov/35183936/", "AAD Guideline")
     
-    if any(k in blob for k in ["acne", "acne vulgaris"]):
+    if _mentions(blob, "acne", "acne vulgaris"):
         add("", "AAD Acne Guidelines", "https://www.aad.org/member/clinical-quality/guidelines", "AAD Guideline")
 
     # ==================== OPHTHALMOLOGY ====================
     # Dry eye - TFOS DEWS is THE canonical guideline
-    if any(k in blob for k in ["dry eye", "meibomian", "mgd", "blepharitis", "ocular surface", "tear", "keratoconjunctivitis sicca", "aqueous deficient", "evaporative", "lid wiper"]):
+    if _mentions(blob, "dry eye", "meibomian", "mgd", "blepharitis", "ocular surface", "tear", "keratoconjunctivitis sicca", "aqueous deficient", "evaporative", "lid wiper"):
         add("39680594", "TFOS DEWS III Report. Ocul Surf. 2024;35:1-257.", "https://pubmed.ncbi.nlm.nih.gov/39680594/", "TFOS DEWS III")
         add("28797892", "TFOS DEWS II Report. Ocul Surf. 2017;15(3):269-649.", "https://pubmed.ncbi.nlm.nih.gov/28797892/", "TFOS DEWS II")
 
     # Glaucoma - AAO PPP and EGS are canonical
-    if any(k in blob for k in ["glaucoma", "intraocular pressure", "iop", "ocular hypertension", "optic nerve", "rnfl", "visual field", "cup to disc", "c/d ratio", "trabeculectomy", "slt", "migs"]):
+    if _mentions(blob, "glaucoma", "intraocular pressure", "iop", "ocular hypertension", "optic nerve", "rnfl", "visual field", "cup to disc", "c/d ratio", "trabeculectomy", "slt", "migs"):
         add("34933745", "AAO PPP: Primary Open-Angle Glaucoma. Ophthalmology. 2021;128(1):P51-P124.", "https://pubmed.ncbi.nlm.nih.gov/34933745/", "AAO PPP")
         add("34675001", "European Glaucoma Society Guidelines, 5th Ed. Br J Ophthalmol. 2021;105(Suppl 1):1-169.", "https://pubmed.ncbi.nlm.nih.gov/34675001/", "EGS Guideline")
 
     # Diabetic retinopathy - AAO PPP
-    if any(k in blob for k in ["diabetic retinopathy", "diabetic macular", "dme", "npdr", "pdr", "proliferative", "anti-vegf", "panretinal"]):
+    if _mentions(blob, "diabetic retinopathy", "diabetic macular", "dme", "npdr", "pdr", "proliferative", "anti-vegf", "panretinal"):
         add("34023436", "AAO PPP: Diabetic Retinopathy. Ophthalmology. 2020;127(1):P66-P145.", "https://pubmed.ncbi.nlm.nih.gov/34023436/", "AAO PPP")
 
     # AMD - AAO PPP  
-    if any(k in blob for k in ["macular degeneration", "amd", "drusen", "cnv", "geographic atrophy", "wet amd", "dry amd", "anti-vegf"]):
+    if _mentions(blob, "macular degeneration", "amd", "drusen", "cnv", "geographic atrophy", "wet amd", "dry amd", "anti-vegf"):
         add("29716768", "AAO PPP: Age-Related Macular Degeneration. Ophthalmology. 2020;127(1):P1-P65.", "https://pubmed.ncbi.nlm.nih.gov/29716768/", "AAO PPP")
 
     # Cataract - AAO PPP
-    if any(k in blob for k in ["cataract", "lens opacity", "phacoemulsification", "iol", "posterior capsule", "nuclear sclerosis"]):
+    if _mentions(blob, "cataract", "lens opacity", "phacoemulsification", "iol", "posterior capsule", "nuclear sclerosis"):
         add("34780842", "AAO PPP: Cataract in the Adult Eye. Ophthalmology. 2022;129(4):P52-P142.", "https://pubmed.ncbi.nlm.nih.gov/34780842/", "AAO PPP")
 
     # Uveitis
-    if any(k in blob for k in ["uveitis", "iritis", "anterior uveitis", "posterior uveitis", "panuveitis", "vitritis"]):
+    if _mentions(blob, "uveitis", "iritis", "anterior uveitis", "posterior uveitis", "panuveitis", "vitritis"):
         add("15652825", "SUN Working Group: Classification of Uveitis. Am J Ophthalmol. 2005;140(3):509-516.", "https://pubmed.ncbi.nlm.nih.gov/15652825/", "SUN Classification")
 
     # Cornea
-    if any(k in blob for k in ["keratitis", "corneal ulcer", "keratoconus", "fuchs", "corneal dystrophy", "pterygium"]):
+    if _mentions(blob, "keratitis", "corneal ulcer", "keratoconus", "fuchs", "corneal dystrophy", "pterygium"):
         add("", "AAO PPP: Bacterial Keratitis. Ophthalmology.", "https://www.aao.org/education/preferred-practice-pattern", "AAO PPP")
 
     # ==================== ORTHOPEDICS ====================
-    if any(k in blob for k in ["low back pain", "lumbago", "lumbar"]):
+    if _mentions(blob, "low back pain", "lumbago", "lumbar"):
         add("", "ACP Low Back Pain Guidelines", "https://www.acponline.org/clinical-information/guidelines", "ACP Guideline")
     
-    if any(k in blob for k in ["neck pain", "cervical"]):
+    if _mentions(blob, "neck pain", "cervical"):
         add("", "AAFP Neck Pain Guidelines", "https://www.aafp.org/family-physician/patient-care/clinical-recommendations.html", "AAFP Guideline")
 
     # ==================== UROLOGY ====================
-    if any(k in blob for k in ["bph", "benign prostatic", "prostate enlargement", "luts"]):
+    if _mentions(blob, "bph", "benign prostatic", "prostate enlargement", "luts"):
         add("", "AUA BPH Guidelines", "https://www.auanet.org/guidelines", "AUA Guideline")
     
-    if any(k in blob for k in ["overactive bladder", "oab", "urge incontinence"]):
+    if _mentions(blob, "overactive bladder", "oab", "urge incontinence"):
         add("", "AUA OAB Guidelines", "https://www.auanet.org/guidelines", "AUA Guideline")
 
     # ==================== PREVENTIVE CARE ====================
-    if any(k in blob for k in ["screening", "preventive", "wellness", "annual exam"]):
+    if _mentions(blob, "screening", "preventive", "wellness", "annual exam"):
         add("", "USPSTF Recommendations", "https://www.uspreventiveservicestaskforce.org/uspstf/recommendation-topics", "USPSTF")
 
-    return pool[:12]  # Return top 12 most relevant
+    return tuple(pool[:12])  # Return top 12 most relevant
+
+
+_WS_RE = re.compile(r"\s+")
 
 
 def merge_references(pubmed_refs, canonical_refs, max_total=18):
@@ -929,7 +1726,7 @@ def merge_references(pubmed_refs, canonical_refs, max_total=18):
     merged = []
 
     def norm_cit(s):
-        return re.sub(r"\s+", " ", (s or "").strip().lower())
+        return _WS_RE.sub(" ", (s or "").strip().casefold())
 
     def key_for(r):
         pmid = (r.get("pmid") or "").strip()
@@ -981,9 +1778,14 @@ def merge_references(pubmed_refs, canonical_refs, max_total=18):
     return numbered
 
 
-def assign_citations_prompt(analysis: Dict[str, Any]) -> str:
-    return f"""
-You are a clinician assistant. You are given an analysis object and a numbered reference list.
+def _prompt_json(obj: Union[Dict[str, Any], str]) -> str:
+    """JSON text to inline in a prompt; an already-serialized string passes through."""
+    if isinstance(obj, str):
+        return obj
+    return _json_bytes(obj).decode("utf-8")
+
+
+_CITATIONS_PROMPT_HEAD = """You are a clinician assistant. You are given an analysis object and a numbered reference list.
 Assign appropriate reference numbers to each diagnosis and plan item.
 
 Output VALID JSON only with this schema:
@@ -1000,34 +1802,22 @@ Rules:
 3 There must always be at least one reference number used somewhere in diagnoses or plan.
 
 Analysis:
-{json.dumps(analysis, ensure_ascii=False)}
-""".strip()
+"""
 
 
-def letter_prompt(form: Dict[str, Any], analysis: Dict[str, Any]) -> str:
-    reason_label = (form.get("reason_label") or "Reason for Report").strip() or "Reason for Report"
-    out_lang = (form.get("output_language") or "").strip()
-    out_lang_line = f"Write the letter in {out_lang}." if out_lang and out_lang.lower() not in {"auto", "match", "match input"} else ""
-    recipient_type = (form.get("recipient_type") or "").lower()
-    include_icd10 = recipient_type in ["insurance", "physician", "specialist"]
-    
-    icd10_instruction = ""
-    if include_icd10:
-        icd10_instruction = """
-ICD-10 CODES:
-- Include ICD-10 codes in the Assessment section next to each diagnosis
-- Format as: "Diagnosis Name (ICD-10: X##.##)"
-- This is REQUIRED for insurance letters and helpful for physician letters
-"""
-    
-    return f"""
-You are a senior clinician writing a professional referral or report letter. Your goal is to communicate effectively while building collegial relationships.
+def assign_citations_prompt(analysis: Union[Dict[str, Any], str]) -> str:
+    return (_CITATIONS_PROMPT_HEAD + _prompt_json(analysis)).rstrip()
+
+
+# Fixed letter-writing instructions. Sent ahead of the per-letter request as
+# their own system message so the prompt prefix is identical across letters.
+LETTER_INSTRUCTIONS = """You are a senior clinician writing a professional referral or report letter. Your goal is to communicate effectively while building collegial relationships.
 
 Output VALID JSON only with this schema:
-{{
+{
   "letter_plain": "string - the complete letter in plain text format",
   "letter_html": "string - the letter formatted with HTML tags"
-}}
+}
 
 TONE AND RELATIONSHIP:
 - Write as one clinician to another - collegial, respectful, and collaborative
@@ -1043,14 +1833,11 @@ The special_requests field is an INTENT SIGNAL from the referring provider.
 - WEAVE the intent naturally into the referral narrative and closing
 - Let it inform what you emphasize without explicitly stating it
 
-Language:
-{out_lang_line}
+LETTER SETTINGS:
+- The request after these instructions gives the clinic context, output language, sender and any ICD-10 requirements, then the reason label, form and analysis for this letter
+- The authoring provider for the header is from_doctor in the sender block
+- Follow those settings exactly
 
-Clinic context:
-clinic_name: {os.getenv("CLINIC_NAME","")}
-clinic_address: {os.getenv("CLINIC_ADDRESS","")}
-clinic_phone: {os.getenv("CLINIC_PHONE","")}
-{icd10_instruction}
 LETTER STRUCTURE:
 
 1. HEADER (one item per line):
@@ -1064,7 +1851,7 @@ Sex: <sex>
 PHN: <phn if available>
 Phone: <phone if available>
 
-{reason_label}: <diagnosis plus referral focus, written naturally>
+<reason_label>: <diagnosis plus referral focus, written naturally>
 
 2. SALUTATION:
 Dear <recipient name or "Colleague">,
@@ -1095,15 +1882,59 @@ RULES:
 - Keep exam findings detailed but relevant to the referral
 - Make the letter feel personal and collegial, not templated
 - For insurance letters: Include ICD-10 codes, be thorough about medical necessity
+"""
+
+_LETTER_ICD10_INSTRUCTION = """
+ICD-10 CODES:
+- Include ICD-10 codes in the Assessment section next to each diagnosis
+- Format as: "Diagnosis Name (ICD-10: X##.##)"
+- This is REQUIRED for insurance letters and helpful for physician letters
+"""
+
+
+# Form fields that stay the same across one provider's letters. They go ahead
+# of the per-letter fields so consecutive requests share a longer prefix.
+_LETTER_SENDER_KEYS = ("from_doctor", "provider_name", "output_language", "signature_present")
+
+
+def letter_prompt(form: Dict[str, Any], analysis: Union[Dict[str, Any], str]) -> str:
+    """Per-letter request, most stable parts first; pair with LETTER_INSTRUCTIONS."""
+    reason_label = (form.get("reason_label") or "Reason for Report").strip() or "Reason for Report"
+    out_lang = (form.get("output_language") or "").strip()
+    out_lang_line = f"Write the letter in {out_lang}." if out_lang and out_lang.lower() not in {"auto", "match", "match input"} else ""
+    recipient_type = (form.get("recipient_type") or "").lower()
+    include_icd10 = recipient_type in ["insurance", "physician", "specialist"]
+    icd10_instruction = _LETTER_ICD10_INSTRUCTION if include_icd10 else ""
+
+    sender = {k: form[k] for k in _LETTER_SENDER_KEYS if k in form}
+    letter_form = {k: v for k, v in form.items() if k not in sender}
+
+    return f"""
+Clinic context:
+clinic_name: {os.getenv("CLINIC_NAME","")}
+clinic_address: {os.getenv("CLINIC_ADDRESS","")}
+clinic_phone: {os.getenv("CLINIC_PHONE","")}
+
+Language:
+{out_lang_line}
+
+Sender:
+{_prompt_json(sender)}
+{icd10_instruction}
+Letter settings:
+reason_label: {reason_label}
 
 Form:
-{json.dumps(form, ensure_ascii=False)}
+{_prompt_json(letter_form)}
 
 Analysis:
-{json.dumps(analysis, ensure_ascii=False)}
+{_prompt_json(analysis)}
 """.strip()
 
 
+_KIND_REGARDS_RE = re.compile(r"\bkind regards\b", re.IGNORECASE)
+
+
 def finalize_signoff(letter_plain: str, provider_name: str, has_signature: bool) -> str:
     txt = (letter_plain or "").rstrip()
     if not txt:
@@ -1122,7 +1953,7 @@ def finalize_signoff(letter_plain: str, provider_name: str, has_signature: bool)
         return txt
     if txt.lower().endswith("kind regards,"):
         return txt + "\n" + prov
-    if re.search(r"\bkind regards\b", txt, flags=re.IGNORECASE):
+    if _KIND_REGARDS_RE.search(txt):
         return txt + "\n" + prov
     return txt + "\n\nKind regards,\n" + prov
 
@@ -1131,83 +1962,209 @@ def new_job_id() -> str:
     return f"job_{int(time.time() * 1000)}_{os.urandom(4).hex()}"
 
 
+def _s3_put_job(job_id: str, body: bytes) -> None:
+    global _S3_INFLIGHT
+    try:
+        bucket = os.getenv("AWS_S3_BUCKET", "").strip()
+        s3, _ = aws_clients()
+        if s3 is not None:
+            s3.put_object(Bucket=bucket, Key=job_s3_key(job_id), Body=body, ContentType="application/json")
+    except Exception:
+        pass
+    finally:
+        with _S3_COND:
+            _S3_INFLIGHT -= 1
+            _S3_COND.notify_all()
+
+
+def _s3_writer_loop() -> None:
+    """Drain _S3_PENDING forever, uploading each batch of jobs concurrently."""
+    global _S3_INFLIGHT
+    while True:
+        with _S3_COND:
+            while not _S3_PENDING:
+                _S3_COND.wait()
+            batch = list(_S3_PENDING.items())
+            _S3_PENDING.clear()
+            _S3_INFLIGHT += len(batch)
+        if len(batch) == 1:
+            _s3_put_job(*batch[0])
+            continue
+        # One snapshot per job, so the puts are independent; waiting for the
+        # batch keeps a job's next snapshot from overtaking this one
+        for fut in [_S3_WRITE_EXECUTOR.submit(_s3_put_job, job_id, body) for job_id, body in batch]:
+            fut.result()
+
+
+def _queue_s3_write(job_id: str, body: bytes) -> None:
+    """Queue a job snapshot for S3; a newer snapshot replaces one still pending."""
+    global _S3_WRITER
+    with _S3_COND:
+        _S3_PENDING[job_id] = body
+        if _S3_WRITER is None or not _S3_WRITER.is_alive():
+            _S3_WRITER = threading.Thread(target=_s3_writer_loop, name="job-s3-writer", daemon=True)
+            _S3_WRITER.start()
+        _S3_COND.notify_all()
+
+
+def flush_job_writes(timeout: float = 5.0) -> bool:
+    """Block until queued S3 job writes are done. Returns False on timeout."""
+    deadline = time.monotonic() + timeout
+    with _S3_COND:
+        while _S3_PENDING or _S3_INFLIGHT:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _S3_COND.wait(remaining)
+    return True
+
+
+def _should_persist(job_id: str, job: Dict[str, Any], updates: Dict[str, Any]) -> bool:
+    """Return False for heartbeat-only ticks that can stay in memory. Call under JOBS_LOCK."""
+    now = time.monotonic()
+    stage = job.get("stage") or ""
+    status = job.get("status") or ""
+    last = _LAST_PERSIST.get(job_id)
+    if status in ("complete", "error"):
+        _LAST_PERSIST.pop(job_id, None)
+        return True
+    if last is not None and set(updates) <= _HEARTBEAT_KEYS and stage == last[1] and now - last[0] < JOB_PERSIST_INTERVAL:
+        return False
+    _LAST_PERSIST[job_id] = (now, stage)
+    return True
+
+
 def set_job(job_id: str, **updates: Any) -> None:
-    """Update job state with guaranteed file write for cross-worker visibility."""
+    """Update job state, written through to the job file for cross-worker visibility.
+
+    Writes are debounced: heartbeat/progress-only updates inside
+    JOB_PERSIST_INTERVAL of the last write for the same stage stay in this
+    worker's memory (its own get_job still sees them). Status and stage
+    transitions always reach the file and S3, so other workers lag by at
+    most one interval on progress and never on state. The S3 PUT itself runs
+    on a background writer (see _queue_s3_write) so callers never wait on it.
+    """
+    global _DIRS_READY
     _ensure_job_dir()
     path = _job_path(job_id)
     
     with JOBS_LOCK:
-        job = JOBS.get(job_id) or {}
-        job.update(updates)
+        job = {**(JOBS.get(job_id) or {}), **updates}
         JOBS[job_id] = job
-    
-    # ALWAYS write to file for cross-worker visibility
+        if not _should_persist(job_id, job, updates):
+            return
+
+    # `job` is a private snapshot now, so it can be serialized outside the lock
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(job, f, ensure_ascii=False)
+        body = _json_bytes(job)
+    except Exception:
+        return
+
+    # Write then rename so other workers never read a half-written job
+    try:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+            f.flush()
+            # Signed before the rename (which keeps the inode), so a file
+            # another worker renames in meanwhile is never taken for ours
+            sig = _stat_sig(os.fstat(f.fileno()))
+        os.replace(tmp_path, path)
+        with JOBS_LOCK:
+            if JOBS.get(job_id) is job:
+                _JOB_FILE_SIG[job_id] = sig
+            else:
+                _JOB_FILE_SIG.pop(job_id, None)
     except Exception as e:
-        # Log but don't fail - S3 is backup
-        pass
+        # Log but don't fail - S3 is backup. Re-check the dirs next time.
+        _DIRS_READY = None
 
-    # Also write to S3 if enabled (async-safe, no current_user needed)
+    # Also mirror to S3 if enabled; the upload runs on the background writer
     if job_s3_enabled():
-        bucket = os.getenv("AWS_S3_BUCKET", "").strip()
         try:
-            s3, _ = aws_clients()
-            if s3 is not None:
-                body = json.dumps(job, ensure_ascii=False).encode("utf-8")
-                key = job_s3_key(job_id)
-                s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json")
+            _queue_s3_write(job_id, body)
         except Exception:
             pass
 
 
-def get_job(job_id: str) -> Dict[str, Any]:
-    """Get job state - checks file first for cross-worker consistency, then S3, then cache."""
+def _s3_job_body(s3, bucket: str, key: str) -> bytes:
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except Exception:
+        return b""
+
+
+def get_job(job_id: str) -> Mapping[str, Any]:
+    """Get job state - cache if the file is unchanged, then file, then S3, then cache.
+
+    The file stays authoritative across workers: the in-memory copy is only
+    returned while the job file still has the signature this process last
+    wrote or read, so another worker's write always forces a re-read.
+    Snapshots are never mutated in place, so callers get a read-only view
+    of one instead of a copy; use set_job to change a job.
+    """
     _ensure_job_dir()
     path = _job_path(job_id)
-    
-    # 1. Check file FIRST (authoritative for cross-worker)
+    sig = _file_sig(path)
+
+    # 1. In-memory cache, valid while the file is unchanged
+    if sig is not None:
+        job = JOBS.get(job_id)
+        if job is not None and _JOB_FILE_SIG.get(job_id) == sig:
+            return MappingProxyType(job)
+
+    # 2. Check file (authoritative for cross-worker)
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            job = json.load(f) or {}
+        with open(path, "rb") as f:
+            sig = _stat_sig(os.fstat(f.fileno()))
+            job = _json_from_bytes(f.read()) or {}
         if isinstance(job, dict) and job:
             with JOBS_LOCK:
                 JOBS[job_id] = job
-            return dict(job)
+                _JOB_FILE_SIG[job_id] = sig
+            return MappingProxyType(job)
     except Exception:
         pass
 
-    # 2. Check S3 if enabled (backup authoritative source)
+    # 3. Check S3 if enabled (backup authoritative source)
     if job_s3_enabled():
         bucket = os.getenv("AWS_S3_BUCKET", "").strip()
         try:
             s3, _ = aws_clients()
             if s3 is not None:
-                for key in job_s3_key_fallbacks(job_id):
+                # All candidate keys are fetched together; the first in
+                # priority order that holds a job wins
+                futures = [
+                    _S3_READ_EXECUTOR.submit(_s3_job_body, s3, bucket, key)
+                    for key in job_s3_key_fallbacks(job_id)
+                ]
+                for i, fut in enumerate(futures):
+                    body = fut.result()
+                    if not body:
+                        continue
                     try:
-                        obj = s3.get_object(Bucket=bucket, Key=key)
-                        body = obj["Body"].read()
-                        job = json.loads(body.decode("utf-8", errors="ignore")) or {}
-                        if isinstance(job, dict) and job:
-                            with JOBS_LOCK:
-                                JOBS[job_id] = job
-                            # Write to file for future local reads
-                            try:
-                                with open(path, "w", encoding="utf-8") as f:
-                                    json.dump(job, f, ensure_ascii=False)
-                            except Exception:
-                                pass
-                            return dict(job)
+                        job = _json_from_bytes(body) or {}
                     except Exception:
                         continue
+                    if isinstance(job, dict) and job:
+                        for rest in futures[i + 1:]:
+                            rest.cancel()
+                        with JOBS_LOCK:
+                            JOBS[job_id] = job
+                        # Write to file for future local reads
+                        try:
+                            with open(path, "wb") as f:
+                                f.write(body)
+                        except Exception:
+                            pass
+                        return MappingProxyType(job)
         except Exception:
             pass
     
-    # 3. Fall back to memory cache (same worker only)
-    with JOBS_LOCK:
-        if job_id in JOBS:
-            return dict(JOBS.get(job_id) or {})
+    # 4. Fall back to memory cache (same worker only)
+    job = JOBS.get(job_id)
+    if job is not None:
+        return MappingProxyType(job)
     
     return {}
 
@@ -1229,8 +2186,7 @@ def run_analysis_job(job_id: str, note_text: str) -> None:
     analysis.update(obj)
 
     pb = (analysis.get("patient_block") or "")
-    pb_plain = re.sub(r"<\s*br\s*/?\s*>", "\n", pb, flags=re.IGNORECASE)
-    pb_plain = re.sub(r"<[^>]+>", "", pb_plain)
+    pb_plain = html_to_plain(pb)
     pb_lines = [ln.strip() for ln in pb_plain.splitlines() if ln.strip()]
     patient_name = ""
     if pb_lines:
@@ -1249,7 +2205,7 @@ def run_analysis_job(job_id: str, note_text: str) -> None:
         low_px = patient_name.lower()
         if low_px in low_prov:
             prov2 = re.sub(re.escape(patient_name), "", prov, flags=re.IGNORECASE).strip()
-            prov2 = re.sub(r"\s{2,}", " ", prov2).strip(" ,")
+            prov2 = _MULTI_SPACE_RE.sub(" ", prov2).strip(" ,")
             analysis["provider_name"] = prov2
 
     # Extract patient age for reference filtering
@@ -1277,11 +2233,15 @@ def run_analysis_job(job_id: str, note_text: str) -> None:
     canonical = canonical_reference_pool([dx.get('label') for dx in (analysis.get('diagnoses') or []) if isinstance(dx, dict)], patient_age=patient_age, detected_specialty=detected_specialty)
     analysis['references'] = merge_references(references, canonical)
 
-    # Stage 4: Assigning citations
-    set_job(job_id, stage="citations", stage_label="Assigning citations...", progress=80, heartbeat_at=now_utc_iso())
+    # Stage 4: Assigning citations. The analysis is final apart from the refs,
+    # so publish it for the page to render while the citation call runs. The
+    # refs are then written into `analysis` in place, so the job gets a copy.
+    set_job(job_id, stage="citations", stage_label="Assigning citations...", progress=80, partial=copy.deepcopy(analysis), heartbeat_at=now_utc_iso())
 
     if analysis.get('references'):
-        cites_obj, cites_err = llm_json(assign_citations_prompt(analysis), temperature=0.0)
+        # Deterministic at temperature 0, so a re-run of the same analysis
+        # (resume, re-upload) reuses the earlier assignment
+        cites_obj, cites_err = llm_json(assign_citations_prompt(analysis), temperature=0.0, cache=True)
         if not cites_err and cites_obj:
             dx_map = {int(x.get("number")): x.get("refs") for x in (cites_obj.get("diagnoses") or []) if isinstance(x, dict) and str(x.get("number", "")).isdigit()}
             pl_map = {int(x.get("number")): x.get("refs") for x in (cites_obj.get("plan") or []) if isinstance(x, dict) and str(x.get("number", "")).isdigit()}
@@ -1293,74 +2253,71 @@ def run_analysis_job(job_id: str, note_text: str) -> None:
                     pl["refs"] = pl_map.get(pl["number"], [])
 
     # Stage 5: Complete
-    set_job(job_id, status="complete", stage="complete", stage_label="Complete", progress=100, data=analysis, updated_at=now_utc_iso())
+    set_job(job_id, status="complete", stage="complete", stage_label="Complete", progress=100, data=analysis, partial=None, updated_at=now_utc_iso())
 
 
-def run_analysis_upload_job(job_id: str, filename: str, data: bytes, force_ocr: bool = False) -> None:
+def run_analysis_upload_job(job_id: str, filename: str, force_ocr: bool = False) -> None:
     # Stage 0: Extracting text
-    set_job(job_id, status="processing", stage="extracting", stage_label="Extracting text...", progress=5, updated_at=now_utc_iso())
-    set_job(job_id, heartbeat_at=now_utc_iso())
+    set_job(job_id, status="processing", stage="extracting", stage_label="Extracting text...", progress=5, updated_at=now_utc_iso(), heartbeat_at=now_utc_iso())
 
+    # The upload lives on disk (see analyze_start); the PDF/OCR readers open it
+    # by path, so the file is never held in memory as a whole
+    job = get_job(job_id) or {}
+    source = (job.get("upload_path") or "").strip()
     try:
-        if (not data) and job_id:
-            job = get_job(job_id)
-            up = (job.get("upload_path") or "").strip()
-            if up and os.path.exists(up):
-                with open(up, "rb") as f:
-                    data = f.read()
-                filename = (job.get("upload_name") or filename or "")
-                if isinstance(job.get("force_ocr"), bool):
-                    force_ocr = bool(job.get("force_ocr"))
-    except Exception:
-        pass
+        os.stat(source)
+    except OSError as e:
+        set_job(job_id, status="error", error=f"Failed to read uploaded file: {e}", updated_at=now_utc_iso())
+        return
+    filename = (job.get("upload_name") or filename or "")
+    if isinstance(job.get("force_ocr"), bool):
+        force_ocr = bool(job.get("force_ocr"))
 
-    name = (filename or "").lower()
+    ext = _upload_ext(filename)
     note_text = ""
     ocr_attempted = False
 
     try:
-        job = get_job(job_id)
-        upload_path = (job.get("upload_path") or "").strip() if isinstance(job, dict) else ""
-        if upload_path and not data:
-            try:
-                with open(upload_path, "rb") as f:
-                    data = f.read()
-            except Exception as e:
-                set_job(job_id, status="error", error=f"Failed to read uploaded file: {e}", updated_at=now_utc_iso())
-                return
+        if ext == ".pdf":
+            def ocr_stage() -> None:
+                set_job(job_id, stage="ocr", stage_label="Running OCR...", progress=8, heartbeat_at=now_utc_iso())
 
-        if name.endswith(".pdf"):
-            try:
-                note_text = extract_pdf_text(io.BytesIO(data))
-            except Exception:
-                note_text = ""
+            def ocr_heartbeat() -> None:
+                # Long scans must not look stale to the 90 s resume check in
+                # /analyze_status; set_job debounces these ticks
+                set_job(job_id, heartbeat_at=now_utc_iso())
 
-            if force_ocr or (not text_is_meaningful(note_text)):
-                # Stage: OCR in progress
-                set_job(job_id, stage="ocr", stage_label="Running OCR...", progress=8, heartbeat_at=now_utc_iso())
+            if force_ocr:
+                # Handwritten uploads OCR every page; the text layer is only
+                # parsed if OCR comes back empty
+                ocr_stage()
                 ocr_attempted = True
-                ocr_text, ocr_err = ocr_pdf_bytes(data)
-                if ocr_err:
-                    set_job(job_id, status="error", error=ocr_err, updated_at=now_utc_iso())
-                    return
-                if ocr_text:
-                    note_text = ocr_text
-
-            set_job(job_id, heartbeat_at=now_utc_iso())
+                note_text, ocr_err = ocr_pdf_bytes(source, heartbeat=ocr_heartbeat)
+                if not note_text and not ocr_err:
+                    try:
+                        note_text = extract_pdf_text(source)
+                    except Exception:
+                        note_text = ""
+            else:
+                # Typed pages keep their text layer; only scanned pages are OCR'd
+                note_text, ocr_err, ocr_attempted = extract_or_ocr(source, on_ocr=ocr_stage, heartbeat=ocr_heartbeat)
+            if ocr_err:
+                set_job(job_id, status="error", error=ocr_err, updated_at=now_utc_iso())
+                return
 
-        elif name.endswith((".png", ".jpg", ".jpeg", ".webp")):
+        elif ext in _IMAGE_UPLOAD_EXTS:
             set_job(job_id, stage="ocr", stage_label="Running OCR on image...", progress=8, heartbeat_at=now_utc_iso())
             ocr_attempted = True
-            if Image is None or pytesseract is None:
+            if Image is None or (tesserocr is None and pytesseract is None):
                 set_job(job_id, status="error", error="Image OCR dependencies missing", updated_at=now_utc_iso())
                 return
             try:
-                img = Image.open(io.BytesIO(data))
-                note_text = (pytesseract.image_to_string(img) or "").strip()
+                # On the OCR pool, so only its threads ever hold a tesserocr engine
+                with Image.open(source) as img:
+                    note_text = _OCR_PAGE_EXECUTOR.submit(ocr_image, img, 3).result().strip()
             except Exception as e:
                 set_job(job_id, status="error", error=f"Image OCR failed: {e}", updated_at=now_utc_iso())
                 return
-            set_job(job_id, heartbeat_at=now_utc_iso())
         else:
             set_job(job_id, status="error", error="Unsupported file type", updated_at=now_utc_iso())
             return
@@ -1375,9 +2332,51 @@ def run_analysis_upload_job(job_id: str, filename: str, data: bytes, force_ocr:
         set_job(job_id, status="error", error=msg, updated_at=now_utc_iso())
         return
 
+    # run_analysis_job's first update carries the next heartbeat
     run_analysis_job(job_id, note_text)
 
 
+def start_background_job(target, job_id: str, *args: Any, executor: Optional[ThreadPoolExecutor] = None) -> bool:
+    """Run an analysis job off the request thread (on `executor`, default the analysis pool).
+
+    Every route that kicks off work goes through here, so the scheduling
+    policy lives in one place. Jobs stay on threads: the OpenAI client,
+    PyMuPDF and tesseract are all blocking, and gunicorn runs sync workers.
+    Jobs queue on a bounded pool, and a job id already queued or running
+    in this process is not scheduled twice. Returns False when skipped.
+    """
+    with _ACTIVE_JOBS_LOCK:
+        if job_id in _ACTIVE_JOBS:
+            return False
+        _ACTIVE_JOBS.add(job_id)
+
+    def _run() -> None:
+        try:
+            target(job_id, *args)
+        finally:
+            with _ACTIVE_JOBS_LOCK:
+                _ACTIVE_JOBS.discard(job_id)
+
+    try:
+        (executor or _ANALYSIS_EXECUTOR).submit(_run)
+    except Exception:
+        with _ACTIVE_JOBS_LOCK:
+            _ACTIVE_JOBS.discard(job_id)
+        raise
+    return True
+
+
+def job_status_response(job: Mapping[str, Any], next_poll_ms: Optional[int] = None):
+    """JSON status reply with an ETag so unchanged polls come back as 304."""
+    body = {"ok": True, **job}
+    if next_poll_ms is not None:
+        body["next_poll_ms"] = next_poll_ms
+    resp = jsonify(body)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+
 # ============ API Routes ============
 
 @api_bp.route("/analyze_start", methods=["POST"])
@@ -1388,17 +2387,16 @@ def analyze_start():
         return jsonify({"ok": False, "error": "No file uploaded"}), 400
 
     filename = (getattr(file, "filename", "") or "").lower()
-    data = file.read()
 
     job_id = new_job_id()
     force_ocr = (request.form.get("handwritten") or "").strip() in {"1", "true", "yes", "on"}
     _ensure_job_dir()
     upath = _upload_path(job_id, filename)
+    # Stream the upload straight to disk; the job reads it back from upload_path
     try:
-        with open(upath, "wb") as f:
-            f.write(data)
-    except Exception:
-        upath = ""
+        file.save(upath)
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Failed to save upload: {e}"}), 500
 
     # Set processing immediately to avoid UI flicker between waiting/extracting
     set_job(
@@ -1413,8 +2411,7 @@ def analyze_start():
         upload_name=filename,
         force_ocr=force_ocr,
     )
-    t = threading.Thread(target=run_analysis_upload_job, args=(job_id, filename, data, force_ocr), daemon=True)
-    t.start()
+    start_background_job(run_analysis_upload_job, job_id, filename, force_ocr)
 
     return jsonify({"ok": True, "job_id": job_id}), 200
 
@@ -1440,33 +2437,69 @@ def analyze_status():
                 up = (job.get("upload_path") or "").strip()
                 if up and os.path.exists(up) and not job.get("resume_started"):
                     set_job(job_id, resume_started=True, updated_at=now_utc_iso(), heartbeat_at=now_utc_iso())
-                    t = threading.Thread(target=run_analysis_upload_job, args=(job_id, job.get("upload_name") or "", b"", bool(job.get("force_ocr"))), daemon=True)
-                    t.start()
+                    start_background_job(run_analysis_upload_job, job_id, job.get("upload_name") or "", bool(job.get("force_ocr")))
                     job = get_job(job_id)
     except Exception:
         pass
-    return jsonify({"ok": True, **job}), 200
+    return job_status_response(job)
 
 
 @api_bp.route("/analyze_text_start", methods=["POST"])
 @login_required
 def analyze_text_start():
-    payload = request.get_json(silent=True) or {}
+    payload = request_json()
     note_text = (payload.get("text") or "").strip()
     if not note_text:
         return jsonify({"ok": False, "error": "Missing text"}), 400
     job_id = new_job_id()
     set_job(job_id, status="waiting", stage="received", stage_label="Received", progress=0, updated_at=now_utc_iso())
-    t = threading.Thread(target=run_analysis_job, args=(job_id, note_text), daemon=True)
-    t.start()
+    start_background_job(run_analysis_job, job_id, note_text)
     return jsonify({"ok": True, "job_id": job_id}), 200
 
 
+# Browser-direct audio uploads (see /transcribe_presign)
+AUDIO_UPLOAD_MAX_BYTES = int(os.getenv("AUDIO_UPLOAD_MAX_BYTES", str(500 * 1024 * 1024)))
+_AUDIO_EXTS = frozenset({".webm", ".ogg", ".mp3", ".mp4", ".m4a", ".wav", ".flac"})
+_AUDIO_KEY_RE = re.compile(r"^uploads/[0-9a-f]{32}\.[a-z0-9]+$")
+
+
+def _audio_upload_key(ext: str) -> str:
+    ext = (ext or "").lower()
+    if ext not in _AUDIO_EXTS:
+        ext = ".webm"
+    return f"uploads/{uuid.uuid4().hex}{ext}"
+
+
+@api_bp.route("/transcribe_presign", methods=["POST"])
+@login_required
+def transcribe_presign():
+    """Presigned S3 POST so the browser uploads audio without proxying it through a worker."""
+    payload = request_json()
+    ok, msg = aws_ready()
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 200
+    bucket = os.getenv("AWS_S3_BUCKET", "").strip()
+    key = _audio_upload_key(payload.get("ext") or request.form.get("ext") or "")
+    s3, _ = aws_clients()
+    try:
+        post = s3.generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Conditions=[["content-length-range", 1, AUDIO_UPLOAD_MAX_BYTES]],
+            ExpiresIn=300,
+        )
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 200
+    return jsonify({"ok": True, "key": key, "url": post["url"], "fields": post["fields"]}), 200
+
+
 @api_bp.route("/transcribe_start", methods=["POST"])
 @login_required
 def transcribe_start():
     audio = request.files.get("audio")
-    if not audio:
+    # Audio already uploaded via /transcribe_presign arrives as its S3 key
+    key = (request.form.get("key") or "").strip()
+    if not audio and not _AUDIO_KEY_RE.match(key):
         return jsonify({"ok": False, "error": "No audio uploaded"}), 400
     language = (request.form.get("language") or "auto").strip()
     mode = (request.form.get("mode") or "dictation").strip()
@@ -1474,16 +2507,17 @@ def transcribe_start():
     if not ok:
         return jsonify({"ok": False, "error": msg}), 200
 
-    bucket = os.getenv("AWS_S3_BUCKET", "").strip()
-    ext = os.path.splitext((getattr(audio, "filename", "") or ""))[1].lower()
-    if not ext:
-        ext = ".webm"
-    key = f"uploads/{uuid.uuid4().hex}{ext}"
-    s3, _ = aws_clients()
-    try:
-        s3.upload_fileobj(audio.stream, bucket, key)
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 200
+    if audio:
+        bucket = os.getenv("AWS_S3_BUCKET", "").strip()
+        ext = os.path.splitext((getattr(audio, "filename", "") or ""))[1].lower()
+        if not ext:
+            ext = ".webm"
+        key = f"uploads/{uuid.uuid4().hex}{ext}"
+        s3, _ = aws_clients()
+        try:
+            s3.upload_fileobj(audio.stream, bucket, key, Config=audio_transfer_config())
+        except Exception as e:
+            return jsonify({"ok": False, "error": str(e)}), 200
 
     job_name = new_job_id()
     started, err = start_transcribe_job(job_name, key, language, mode=mode)
@@ -1504,30 +2538,37 @@ def transcribe_status():
         return jsonify({"ok": False, "error": "Unknown job_id"}), 404
 
     if (job.get("status") or "") in ("complete", "error"):
-        return jsonify({"ok": True, **job}), 200
+        _TRANSCRIBE_CHECKED.pop(job_id, None)
+        return job_status_response(job)
+
+    now = time.monotonic()
+    if now - _TRANSCRIBE_CHECKED.get(job_id, 0.0) < TRANSCRIBE_POLL_INTERVAL:
+        return job_status_response(job, next_poll_ms=int(TRANSCRIBE_POLL_INTERVAL * 1000))
+    for stale_id, checked in list(_TRANSCRIBE_CHECKED.items()):
+        if now - checked > _TRANSCRIBE_CHECKED_TTL:
+            _TRANSCRIBE_CHECKED.pop(stale_id, None)
+    _TRANSCRIBE_CHECKED[job_id] = now
 
     txt, status, err = fetch_transcribe_result(job_id)
     if err and status == "failed":
+        _TRANSCRIBE_CHECKED.pop(job_id, None)
         set_job(job_id, status="error", error=err, updated_at=now_utc_iso())
-        return jsonify({"ok": True, **get_job(job_id)}), 200
+        return job_status_response(get_job(job_id))
     if status == "completed" and txt:
+        _TRANSCRIBE_CHECKED.pop(job_id, None)
         set_job(job_id, status="complete", transcript=txt, updated_at=now_utc_iso())
-        return jsonify({"ok": True, **get_job(job_id)}), 200
-    set_job(job_id, status="transcribing", updated_at=now_utc_iso())
-    return jsonify({"ok": True, **get_job(job_id)}), 200
-
+        return job_status_response(get_job(job_id))
+    if job.get("status") != "transcribing":
+        set_job(job_id, status="transcribing", updated_at=now_utc_iso())
+        job = get_job(job_id)
+    return job_status_response(job, next_poll_ms=int(TRANSCRIBE_POLL_INTERVAL * 1000))
 
-@api_bp.route("/generate_report", methods=["POST"])
-@login_required
-def generate_report():
-    payload = request.get_json(silent=True) or {}
-    form = payload.get("form") or {}
-    analysis = payload.get("analysis") or {}
 
+def build_report(form: Dict[str, Any], analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """Write the referral/report letter; returns the /generate_report response body."""
     pb_html = (analysis.get("patient_block") or "")
-    pb_plain = re.sub(r"<\s*br\s*/?\s*>", "\n", pb_html, flags=re.IGNORECASE)
-    pb_plain = re.sub(r"<[^>]+>", "", pb_plain)
-    pb_plain = re.sub(r"\n{3,}", "\n\n", pb_plain).strip()
+    pb_plain = html_to_plain(pb_html)
+    pb_plain = _BLANK_LINES_RE.sub("\n\n", pb_plain).strip()
     analysis["patient_block_plain"] = pb_plain
 
     form = dict(form) if isinstance(form, dict) else {}
@@ -1541,19 +2582,21 @@ def generate_report():
     else:
         form["reason_for_referral_combined"] = rf or rd
 
-    obj, err = llm_json(letter_prompt(form, analysis))
+    # Not cached: letters are drafted at temperature 0.2 and asking again
+    # should give the clinician a fresh draft
+    obj, err = llm_json(letter_prompt(form, analysis), instructions=LETTER_INSTRUCTIONS)
     if err or not obj:
-        return jsonify({"ok": False, "error": err or "Generation failed"}), 200
+        return {"ok": False, "error": err or "Generation failed"}
 
     letter_plain = (obj.get("letter_plain") or "").strip()
     letter_html = (obj.get("letter_html") or "").strip()
     if letter_plain:
-        letter_plain = re.sub(r"<\s*br\s*/?\s*>", "\n", letter_plain, flags=re.IGNORECASE)
-        letter_plain = re.sub(r"<\s*/?p\s*>", "\n", letter_plain, flags=re.IGNORECASE)
-        letter_plain = re.sub(r"<[^>]+>", "", letter_plain)
-        letter_plain = re.sub(r"\n{3,}", "\n\n", letter_plain).strip()
+        # Usually already plain text; only strip markup when there is some
+        if "<" in letter_plain:
+            letter_plain = _LETTER_MARKUP_RE.sub(_letter_markup_repl, letter_plain)
+        letter_plain = _BLANK_LINES_RE.sub("\n\n", letter_plain).strip()
     if not letter_plain:
-        return jsonify({"ok": False, "error": "Empty output"}), 200
+        return {"ok": False, "error": "Empty output"}
 
     provider_name = (form.get("from_doctor") or form.get("provider_name") or "").strip()
     sig_client = bool(form.get("signature_present"))
@@ -1562,20 +2605,261 @@ def generate_report():
     want_label = (form.get("reason_label") or "Reason for Report").strip()
     if want_label:
         if want_label.lower() == "reason for report":
-            letter_plain = re.sub(r"^Reason\s+for\s+Referral\s*:", "Reason for Report:", letter_plain, flags=re.IGNORECASE | re.MULTILINE)
+            letter_plain = _REASON_REFERRAL_RE.sub("Reason for Report:", letter_plain)
         else:
-            letter_plain = re.sub(r"^Reason\s+for\s+Report\s*:", "Reason for Referral:", letter_plain, flags=re.IGNORECASE | re.MULTILINE)
+            letter_plain = _REASON_REPORT_RE.sub("Reason for Referral:", letter_plain)
+
+    return {"ok": True, "letter_plain": letter_plain, "letter_html": letter_html}
+
+
+def run_report_job(job_id: str, form: Dict[str, Any], analysis: Dict[str, Any]) -> None:
+    set_job(job_id, status="processing", stage="writing", stage_label="Writing letter...", progress=30, updated_at=now_utc_iso(), heartbeat_at=now_utc_iso())
+    try:
+        result = build_report(form, analysis)
+    except Exception as e:
+        result = {"ok": False, "error": f"Generation failed: {type(e).__name__}: {e}"}
+    if result.get("ok"):
+        set_job(job_id, status="complete", stage="complete", progress=100, data=result, updated_at=now_utc_iso())
+    else:
+        set_job(job_id, status="error", error=result.get("error") or "Generation failed", updated_at=now_utc_iso())
+
+
+@api_bp.route("/generate_report", methods=["POST"])
+@login_required
+def generate_report():
+    """Write the letter inline, or with {"async": true} as a job polled via /report_status."""
+    payload = request_json()
+    form = payload.get("form") or {}
+    analysis = payload.get("analysis") or {}
+    if payload.get("async"):
+        job_id = new_job_id()
+        set_job(job_id, status="waiting", stage="received", stage_label="Received", progress=0, updated_at=now_utc_iso())
+        try:
+            started = start_background_job(run_report_job, job_id, form, analysis, executor=_REPORT_EXECUTOR)
+        except Exception:
+            started = False
+        if not started:
+            set_job(job_id, status="error", error="Could not start letter generation", updated_at=now_utc_iso())
+            return jsonify({"ok": False, "error": "Could not start letter generation"}), 500
+        return jsonify({"ok": True, "job_id": job_id}), 202
+    return jsonify(build_report(form, analysis)), 200
+
+
+@api_bp.route("/report_status", methods=["GET"])
+@api_bp.route("/triage_batch_status", methods=["GET"])
+@login_required
+def report_status():
+    job_id = (request.args.get("job_id") or "").strip()
+    if not job_id:
+        return jsonify({"ok": False, "error": "Missing job_id"}), 400
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "Unknown job_id"}), 404
+    return job_status_response(job)
+
+
+# Decoded letterhead/signature uploads, keyed by data URL hash; clinics resend the same images.
+# Files are shared by export threads and by every worker on the host, so
+# evicting an entry never unlinks it; files unused for DATA_URL_FILE_MAX_AGE
+# seconds are pruned from the temp dir instead (each use refreshes the mtime).
+DATA_URL_CACHE_SIZE = int(os.getenv("DATA_URL_CACHE_SIZE", "32"))
+DATA_URL_FILE_MAX_AGE = float(os.getenv("DATA_URL_FILE_MAX_AGE", "86400"))
+_DATA_URL_PRUNE_INTERVAL = 3600.0
+_DATA_URL_FILES: "OrderedDict[str, str]" = OrderedDict()
+_DATA_URL_LOCK = threading.Lock()
+_DATA_URL_PRUNED_AT = 0.0
+_DATA_URL_FILE_RE = re.compile(r"^maneiro_(?:letterhead|signature)_[0-9a-f]{40}\.(?:png|jpg)(?:\.[0-9a-f]{32}\.tmp)?$")
+
+
+def _prune_data_url_files() -> None:
+    """Delete decoded data URL files nobody has used for DATA_URL_FILE_MAX_AGE."""
+    global _DATA_URL_PRUNED_AT
+    now = time.monotonic()
+    with _DATA_URL_LOCK:
+        if _DATA_URL_PRUNED_AT and now - _DATA_URL_PRUNED_AT < _DATA_URL_PRUNE_INTERVAL:
+            return
+        _DATA_URL_PRUNED_AT = now
+    cutoff = time.time() - DATA_URL_FILE_MAX_AGE
+    try:
+        with os.scandir(tempfile.gettempdir()) as it:
+            for entry in it:
+                if not _DATA_URL_FILE_RE.match(entry.name):
+                    continue
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+
+def _touch(path: str) -> bool:
+    """Refresh path's mtime so the age-based prune keeps it; False if it is gone."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def data_url_to_tempfile(data_url: str, prefix: str) -> Optional[str]:
+    if not data_url or not data_url.startswith("data:"):
+        return None
+    try:
+        digest = hashlib.sha1(data_url.encode("utf-8")).hexdigest()
+        with _DATA_URL_LOCK:
+            path = _DATA_URL_FILES.get(digest)
+            if path:
+                _DATA_URL_FILES.move_to_end(digest)
+        if path and _touch(path):
+            return path
+
+        _prune_data_url_files()
+        header, b64 = data_url.split(",", 1)
+        mime = header.split(";", 1)[0].split(":", 1)[1].strip().lower()
+        ext = ".png"
+        if "jpeg" in mime or "jpg" in mime:
+            ext = ".jpg"
+        path = os.path.join(tempfile.gettempdir(), f"maneiro_{prefix}_{digest}{ext}")
+        if not _touch(path):
+            # pybase64 is SIMD-accelerated; same lenient decoding as the stdlib default
+            raw = pybase64.b64decode(b64) if pybase64 is not None else base64.b64decode(b64)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(raw)
+            os.replace(tmp_path, path)
+
+        with _DATA_URL_LOCK:
+            _DATA_URL_FILES[digest] = path
+            _DATA_URL_FILES.move_to_end(digest)
+            while len(_DATA_URL_FILES) > DATA_URL_CACHE_SIZE:
+                _DATA_URL_FILES.popitem(last=False)
+        return path
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=1)
+def _reportlab() -> Optional[SimpleNamespace]:
+    """ReportLab, imported on the first PDF export rather than at worker boot."""
+    try:
+        from reportlab.lib.pagesizes import letter
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.enums import TA_LEFT, TA_JUSTIFY
+    except Exception:
+        return None
+    return SimpleNamespace(
+        letter=letter, SimpleDocTemplate=SimpleDocTemplate, Paragraph=Paragraph,
+        Spacer=Spacer, Image=Image, Table=Table, TableStyle=TableStyle,
+        getSampleStyleSheet=getSampleStyleSheet, ParagraphStyle=ParagraphStyle,
+        TA_LEFT=TA_LEFT, TA_JUSTIFY=TA_JUSTIFY,
+    )
+
+
+@lru_cache(maxsize=128)
+def _image_size_cached(path: str, mtime_ns: int) -> Tuple[float, float]:
+    # mtime_ns only keys the cache so a replaced image is re-measured
+    if Image is not None:
+        with Image.open(path) as im:
+            w, h = im.size
+    else:
+        img = _reportlab().Image(path)
+        w, h = img.imageWidth, img.imageHeight
+    return float(w), float(h)
+
+
+def image_size(path: str) -> Tuple[float, float]:
+    """Pixel size of an image file, read once per file version."""
+    return _image_size_cached(path, os.stat(path).st_mtime_ns)
+
 
-    return jsonify({"ok": True, "letter_plain": letter_plain, "letter_html": letter_html}), 200
+@lru_cache(maxsize=8)
+def _dir_files(abs_dir: str, dir_mtime_ns: int) -> frozenset:
+    # dir_mtime_ns only keys the cache: adding or removing a file changes it
+    with os.scandir(abs_dir) as it:
+        return frozenset(e.name for e in it if e.is_file())
+
+
+def find_signature_file(abs_dir: str, slug: str) -> Optional[str]:
+    """Signature image for slug in abs_dir, from a cached directory listing."""
+    try:
+        files = _dir_files(abs_dir, os.stat(abs_dir).st_mtime_ns)
+    except OSError:
+        return None
+    for ext in (".png", ".jpg", ".jpeg"):
+        if slug + ext in files:
+            return os.path.join(abs_dir, slug + ext)
+    return None
+
+
+# Letter line classification for export_pdf: exact lines first, then prefixes
+_LETTER_LINE_KINDS = {
+    "clinical summary": "skip",
+    "clinical summary:": "skip",
+    "exam findings": "heading",
+    "exam findings:": "heading",
+    "assessment": "heading",
+    "assessment:": "heading",
+    "plan": "heading",
+    "plan:": "heading",
+}
+_LETTER_LINE_PREFIXES = (
+    ("reason for referral", "reason_referral"),
+    ("reason for report", "reason_report"),
+    ("to:", "header"),
+    ("from:", "header"),
+    ("date:", "header"),
+    ("dear ", "salutation"),
+    ("kind regards", "signoff"),
+)
+_LETTER_PREFIX_TUPLE = tuple(p for p, _ in _LETTER_LINE_PREFIXES)
+
+
+def letter_line_kind(lower: str) -> str:
+    kind = _LETTER_LINE_KINDS.get(lower)
+    if kind:
+        return kind
+    if lower.startswith(_LETTER_PREFIX_TUPLE):
+        for prefix, kind in _LETTER_LINE_PREFIXES:
+            if lower.startswith(prefix):
+                return kind
+    return "text"
+
+
+# Header lines export_pdf gathers into the compact demographics block
+_DEMO_KEYS = frozenset({"patient", "dob", "sex", "phn", "phone", "email", "address"})
+
+
+@lru_cache(maxsize=1)
+def letter_pdf_styles() -> Tuple[Any, Any, Any]:
+    """(body, heading, header-line) paragraph styles for letter PDFs, built once."""
+    rl = _reportlab()
+    styles = rl.getSampleStyleSheet()
+    base = rl.ParagraphStyle(
+        "base", parent=styles["Normal"], fontName="Helvetica",
+        fontSize=10, leading=13.5, spaceAfter=4, alignment=rl.TA_JUSTIFY
+    )
+    head = rl.ParagraphStyle(
+        "head", parent=base, fontName="Helvetica-Bold",
+        spaceBefore=8, spaceAfter=5, alignment=rl.TA_LEFT
+    )
+    mono = rl.ParagraphStyle(
+        "mono", parent=base, fontName="Helvetica",
+        fontSize=10, leading=12.8, alignment=rl.TA_LEFT, spaceAfter=0
+    )
+    return base, head, mono
 
 
 @api_bp.route("/export_pdf", methods=["POST"])
 @login_required
 def export_pdf():
-    if SimpleDocTemplate is None:
+    rl = _reportlab()
+    if rl is None:
         return jsonify({"error": "PDF generator not available"}), 500
 
-    payload = request.get_json(silent=True) or {}
+    payload = request_json()
     text_in = (payload.get("text") or "").strip()
     provider_name = (payload.get("provider_name") or "").strip() or "Provider"
     patient_token = (payload.get("patient_token") or "").strip()
@@ -1605,59 +2889,32 @@ def export_pdf():
 
     doc_tok = doctor_token(provider_name)
     px_tok = patient_token or "PxUnknown"
-    today = datetime.utcnow().strftime("%Y%m%d")
+    today = today_utc_yyyymmdd()
     kind = recipient_type.lower() or "report"
     kind = "referral" if "special" in kind or "physician" in kind else kind
     kind = safe_token(kind)
 
     filename = f"{safe_token(clinic_short)}_{doc_tok}_{safe_token(px_tok)}_{today}_{kind}.pdf"
-    out_path = os.path.join(tempfile.gettempdir(), f"maneiro_{uuid.uuid4().hex}.pdf")
-
-    def data_url_to_tempfile(data_url: str, prefix: str) -> Optional[str]:
-        if not data_url or not data_url.startswith("data:"):
-            return None
-        try:
-            header, b64 = data_url.split(",", 1)
-            mime = header.split(";", 1)[0].split(":", 1)[1].strip().lower()
-            ext = ".png"
-            if "jpeg" in mime or "jpg" in mime:
-                ext = ".jpg"
-            raw = base64.b64decode(b64)
-            path = os.path.join(tempfile.gettempdir(), f"maneiro_{prefix}_{uuid.uuid4().hex}{ext}")
-            with open(path, "wb") as f:
-                f.write(raw)
-            return path
-        except Exception:
-            return None
 
     def signature_slug(prov_name: str) -> str:
-        s = (prov_name or "").strip().lower()
-        s = re.sub(r"\b(dr\.?|md|od|mba)\b", "", s)
-        s = re.sub(r"[^a-z0-9]+", "_", s)
-        s = re.sub(r"_+", "_", s).strip("_")
-        return s
+        # The non-alnum run replacement already leaves single underscores
+        s = _SIG_TITLE_RE.sub("", (prov_name or "").strip().lower())
+        return _SIG_NON_ALNUM_RE.sub("_", s).strip("_")
 
     def find_signature_image(prov_name: str) -> Optional[str]:
-        base_dir = os.getenv("SIGNATURE_DIR", "static/signatures")
-        # Try relative to app folder
-        app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        abs_dir = os.path.join(app_dir, "app", base_dir)
+        # SIGNATURE_DIR is relative to the app folder
+        abs_dir = os.path.join(_MODULE_DIR, os.getenv("SIGNATURE_DIR", "static/signatures"))
         slug = signature_slug(prov_name)
         if not slug:
             return None
-        for ext in (".png", ".jpg", ".jpeg"):
-            cand = os.path.join(abs_dir, slug + ext)
-            if os.path.exists(cand):
-                return cand
-        return None
+        return find_signature_file(abs_dir, slug)
 
     # Get letterhead: client upload > static letterhead.png
     lh_override = data_url_to_tempfile(letterhead_data_url, "letterhead")
     lh_path = lh_override
     if not lh_path:
-        static_lh = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "img", "letterhead.png")
-        if os.path.exists(static_lh):
-            lh_path = static_lh
+        if os.path.exists(_STATIC_LETTERHEAD):
+            lh_path = _STATIC_LETTERHEAD
 
     # Get signature: client upload > server lookup by provider name
     sig_override = data_url_to_tempfile(signature_data_url, "signature")
@@ -1667,19 +2924,7 @@ def export_pdf():
     if sig_path_effective and os.path.exists(sig_path_effective):
         text_in = finalize_signoff(text_in, provider_name, True)
 
-    styles = getSampleStyleSheet()
-    base = ParagraphStyle(
-        "base", parent=styles["Normal"], fontName="Helvetica",
-        fontSize=10, leading=13.5, spaceAfter=4, alignment=TA_JUSTIFY
-    )
-    head = ParagraphStyle(
-        "head", parent=base, fontName="Helvetica-Bold",
-        spaceBefore=8, spaceAfter=5, alignment=TA_LEFT
-    )
-    mono = ParagraphStyle(
-        "mono", parent=base, fontName="Helvetica",
-        fontSize=10, leading=12.8, alignment=TA_LEFT, spaceAfter=0
-    )
+    base, head, mono = letter_pdf_styles()
 
     def esc(s: str) -> str:
         return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
@@ -1691,7 +2936,7 @@ def export_pdf():
         return lv not in {"na", "n/a", "none", "unknown", ""}
 
     def emit_demographics(demo: dict) -> list:
-        """Compact demographics layout - multiple fields per line"""
+        """Compact demographics layout - multiple fields per line, as mono-run strings"""
         lines = []
         # Line 1: Patient, DOB, Sex, PHN
         parts = []
@@ -1704,7 +2949,7 @@ def export_pdf():
         if meaningful(demo.get("phn")):
             parts.append(f"<b>PHN:</b> {esc(demo.get('phn'))}")
         if parts:
-            lines.append(Paragraph("  ".join(parts), mono))
+            lines.append("  ".join(parts))
 
         # Line 2: Phone, Email, Address
         parts2 = []
@@ -1716,24 +2961,24 @@ def export_pdf():
         if meaningful(addr) and len(addr) <= 80:
             parts2.append(f"<b>Address:</b> {esc(addr)}")
         if parts2:
-            lines.append(Paragraph("  ".join(parts2), mono))
+            lines.append("  ".join(parts2))
         return lines
 
+    # Header and demographics lines go in as markup strings; each run of them
+    # becomes one <br/>-joined mono Paragraph (mono has no spaceBefore/After,
+    # so the layout is unchanged) instead of one Paragraph parse per line
     story = []
 
     # Add letterhead if available
     if lh_path and os.path.exists(lh_path):
         try:
-            img = RLImage(lh_path)
-            img.drawHeight = 50
-            img.drawWidth = 500
+            img = rl.Image(lh_path, width=500, height=50)
             story.append(img)
-            story.append(Spacer(1, 8))
+            story.append(rl.Spacer(1, 8))
         except Exception:
             pass
 
     raw_lines = text_in.splitlines()
-    demo_keys = {"patient", "dob", "sex", "phn", "phone", "email", "address"}
     demo_data = {}
     demo_active = False
     demo_emitted = False
@@ -1744,14 +2989,15 @@ def export_pdf():
             if demo_active and not demo_emitted:
                 story.extend(emit_demographics(demo_data))
                 demo_emitted = True
-            story.append(Spacer(1, 8))
+            story.append(rl.Spacer(1, 8))
             continue
 
-        lower = line.strip().lower()
+        stripped = line.strip()
+        lower = stripped.lower()
         key = lower.split(":", 1)[0].strip() if ":" in lower else ""
 
         # Collect demographics for compact display
-        if key in demo_keys:
+        if key in _DEMO_KEYS:
             demo_active = True
             try:
                 demo_data[key] = line.split(":", 1)[1].strip()
@@ -1763,62 +3009,63 @@ def export_pdf():
             story.extend(emit_demographics(demo_data))
             demo_emitted = True
 
+        kind = letter_line_kind(lower)
+
         # Skip "Clinical Summary" heading
-        if lower in {"clinical summary", "clinical summary:"}:
+        if kind == "skip":
             continue
 
         # Reason for referral/report - styled prominently
-        if lower.startswith("reason for referral") or lower.startswith("reason for report"):
-            label = "Reason for Referral" if lower.startswith("reason for referral") else "Reason for Report"
+        if kind in ("reason_referral", "reason_report"):
+            label = "Reason for Referral" if kind == "reason_referral" else "Reason for Report"
             value = line.split(":", 1)[1].strip() if ":" in line else ""
-            story.append(Spacer(1, 10))
-            story.append(Paragraph(f"<b>{label}:</b> {esc(value)}", base))
-            story.append(Spacer(1, 10))
+            story.append(rl.Spacer(1, 10))
+            story.append(rl.Paragraph(f"<b>{label}:</b> {esc(value)}", base))
+            story.append(rl.Spacer(1, 10))
             continue
 
         # Section headings
-        if lower in {"exam findings", "exam findings:", "assessment", "assessment:", "plan", "plan:"}:
-            title = line.strip().replace(":", "")
-            story.append(Paragraph(f"<b>{esc(title)}</b>", head))
+        if kind == "heading":
+            title = stripped.replace(":", "")
+            story.append(rl.Paragraph(f"<b>{esc(title)}</b>", head))
             continue
 
         # To/From/Date header lines
-        if lower.startswith("to:") or lower.startswith("from:") or lower.startswith("date:"):
+        if kind == "header":
             try:
                 k, v = line.split(":", 1)
-                story.append(Paragraph(f"<b>{esc(k)}:</b> {esc(v.strip())}", mono))
+                story.append(f"<b>{esc(k)}:</b> {esc(v.strip())}")
             except Exception:
-                story.append(Paragraph(esc(line), mono))
+                story.append(esc(line))
             continue
 
         # Salutation
-        if lower.startswith("dear "):
-            story.append(Spacer(1, 8))
-            story.append(Paragraph(esc(line), base))
-            story.append(Spacer(1, 6))
+        if kind == "salutation":
+            story.append(rl.Spacer(1, 8))
+            story.append(rl.Paragraph(esc(line), base))
+            story.append(rl.Spacer(1, 6))
             continue
 
         # Signature block
-        if lower.startswith("kind regards"):
-            story.append(Spacer(1, 12))
-            story.append(Paragraph("Kind regards,", base))
+        if kind == "signoff":
+            story.append(rl.Spacer(1, 12))
+            story.append(rl.Paragraph("Kind regards,", base))
             
             if sig_path_effective and os.path.exists(sig_path_effective):
                 try:
-                    sig = RLImage(sig_path_effective)
-                    page_w = rl_letter[0]
+                    page_w = rl.letter[0]
                     max_width = int(page_w * 0.25)
                     max_height = 90
-                    iw = float(sig.imageWidth)
-                    ih = float(sig.imageHeight)
+                    iw, ih = image_size(sig_path_effective)
                     if iw > 0 and ih > 0:
                         scale = min(max_width / iw, max_height / ih)
-                        sig.drawWidth = iw * scale
-                        sig.drawHeight = ih * scale
-                    story.append(Spacer(1, 6))
-                    text_w = rl_letter[0] - 54 - 54
-                    tbl = Table([[sig]], colWidths=[text_w])
-                    tbl.setStyle(TableStyle([
+                        sig = rl.Image(sig_path_effective, width=iw * scale, height=ih * scale)
+                    else:
+                        sig = rl.Image(sig_path_effective)
+                    story.append(rl.Spacer(1, 6))
+                    text_w = rl.letter[0] - 54 - 54
+                    tbl = rl.Table([[sig]], colWidths=[text_w])
+                    tbl.setStyle(rl.TableStyle([
                         ("ALIGN", (0, 0), (-1, -1), "RIGHT"),
                         ("VALIGN", (0, 0), (-1, -1), "TOP"),
                         ("LEFTPADDING", (0, 0), (-1, -1), 0),
@@ -1828,22 +3075,36 @@ def export_pdf():
                     ]))
                     story.append(tbl)
                 except Exception:
-                    story.append(Paragraph(esc(provider_name), base))
+                    story.append(rl.Paragraph(esc(provider_name), base))
             else:
                 # No signature image - add provider name
-                story.append(Paragraph(esc(provider_name), base))
+                story.append(rl.Paragraph(esc(provider_name), base))
             continue
 
         # Regular paragraph
-        story.append(Paragraph(esc(line), base))
+        story.append(rl.Paragraph(esc(line), base))
 
     # Emit any remaining demographics
     if demo_active and not demo_emitted:
         story.extend(emit_demographics(demo_data))
 
-    doc = SimpleDocTemplate(
-        out_path,
-        pagesize=rl_letter,
+    flowables = []
+    mono_run: List[str] = []
+    for item in story:
+        if isinstance(item, str):
+            mono_run.append(item)
+            continue
+        if mono_run:
+            flowables.append(rl.Paragraph("<br/>".join(mono_run), mono))
+            mono_run = []
+        flowables.append(item)
+    if mono_run:
+        flowables.append(rl.Paragraph("<br/>".join(mono_run), mono))
+
+    buf = io.BytesIO()
+    doc = rl.SimpleDocTemplate(
+        buf,
+        pagesize=rl.letter,
         leftMargin=54,
         rightMargin=54,
         topMargin=54,
@@ -1852,10 +3113,11 @@ def export_pdf():
     )
 
     try:
-        doc.build(story)
-        return send_file(out_path, as_attachment=True, download_name=filename, mimetype="application/pdf")
+        doc.build(flowables)
     except Exception as e:
         return jsonify({"error": f"PDF export failed: {type(e).__name__}: {str(e)}"}), 500
+    buf.seek(0)
+    return send_file(buf, as_attachment=True, download_name=filename, mimetype="application/pdf")
 
 
 @api_bp.route("/healthz", methods=["GET"])
@@ -1871,44 +3133,20 @@ def healthz():
         "ocr_ready": ocr_ok,
         "ocr_message": ocr_msg,
         "model": model_name(),
+        "triage_model": triage_model_name(),
     }), 200
 
 
+@api_bp.route("/llm_usage", methods=["GET"])
+@login_required
+def llm_usage():
+    """This worker's running token and call totals by call kind."""
+    return jsonify({"ok": True, "llm_usage": llm_usage_snapshot()}), 200
+
+
 # ============ ASSISTANT MODE ENDPOINTS ============
 
-def triage_fax_prompt(summary_html: str, patient_block: str, full_text: str = "", analysis: dict = None) -> str:
-    """Prompt for triaging incoming fax/communication with intelligent reasoning"""
-    context = full_text or summary_html or ""
-    
-    # Include more analysis data if available
-    extra_context = ""
-    if analysis:
-        doc_type = analysis.get("document_type", "")
-        referral_info = analysis.get("referral_info", {})
-        diagnoses = analysis.get("diagnoses", [])
-        chief_complaint = analysis.get("chief_complaint", "")
-        provider_name = analysis.get("provider_name", "")
-        provider_clinic = analysis.get("provider_clinic", "")
-        
-        if doc_type:
-            extra_context += f"\nDocument type detected: {doc_type}"
-        if chief_complaint:
-            extra_context += f"\nChief complaint: {chief_complaint}"
-        if provider_name:
-            extra_context += f"\nSending provider: {provider_name}"
-        if provider_clinic:
-            extra_context += f"\nSending clinic: {provider_clinic}"
-        if referral_info.get("is_referral"):
-            extra_context += f"\nReferral direction: {referral_info.get('referral_direction', 'unknown')}"
-            extra_context += f"\nReferring to: {referral_info.get('referring_to', '')}"
-            extra_context += f"\nReason: {referral_info.get('reason_for_referral', '')}"
-            extra_context += f"\nRequested service: {referral_info.get('requested_service', '')}"
-        if diagnoses:
-            dx_list = ", ".join([d.get("label", "") for d in diagnoses[:5] if d.get("label")])
-            extra_context += f"\nDiagnoses: {dx_list}"
-    
-    return f"""
-You are an expert medical office coordinator helping triage incoming faxes and communications for an ophthalmology clinic.
+TRIAGE_INSTRUCTIONS = """You are an expert medical office coordinator helping triage incoming faxes and communications for an ophthalmology clinic.
 
 STEP 1: DOCUMENT CLASSIFICATION
 Identify the document type:
@@ -1928,37 +3166,11 @@ STEP 2: URGENCY ASSESSMENT
 - ROUTINE: Standard processing (records requests, normal results)
 
 STEP 3: ANALYZE CAREFULLY
-{extra_context}
-
-Patient information:
-{patient_block}
-
-Document content:
-{context[:10000]}
+The request below gives any detected document details, then the patient information and the document content.
 
 STEP 4: GENERATE ACTIONABLE TASKS
 Based on your analysis, create specific tasks for staff and doctors.
 
-Output VALID JSON only:
-{{
-  "document_type": "string - REFERRAL_REQUEST, CONSULTATION_REPORT, LAB_RESULTS, INSURANCE, RECORDS_REQUEST, PRESCRIPTION, CORRESPONDENCE, MARKETING, OTHER",
-  "urgency": "string - URGENT, SOON, ROUTINE",
-  "from_provider": "string - name of sending doctor/organization",
-  "from_clinic": "string - clinic/organization name",
-  "from_fax": "string - fax number if visible",
-  "regarding": "string - clear description: patient name + what this is about",
-  "patient_name": "string - patient name if mentioned",
-  "patient_dob": "string - DOB if mentioned",
-  "reasoning": "string - brief explanation of your classification and why",
-  "front_desk_tasks": [
-    "string - specific actionable task with clear instruction"
-  ],
-  "doctor_tasks": [
-    "string - specific actionable task requiring clinical decision"
-  ],
-  "key_clinical_info": "string - any critical clinical details the doctor should know immediately"
-}}
-
 TASK WRITING RULES:
 1. Tasks must be specific and actionable (who, what, when)
 2. Include patient name in tasks when known
@@ -1969,7 +3181,7 @@ TASK WRITING RULES:
 7. If document is unclear or illegible, note that in reasoning
 
 EXAMPLE for a referral request:
-{{
+{
   "document_type": "REFERRAL_REQUEST",
   "urgency": "SOON",
   "from_provider": "Dr. Jane Smith, OD",
@@ -1985,46 +3197,115 @@ EXAMPLE for a referral request:
     "Determine appointment urgency based on IOP levels"
   ],
   "key_clinical_info": "IOP elevated: OD 28, OS 26. C/D ratio 0.7 OU. Patient on Latanoprost."
-}}
-""".strip()
+}"""
 
 
-def patient_letter_prompt(analysis: dict) -> str:
-    """Prompt for generating patient-friendly letter"""
-    diagnoses = analysis.get("diagnoses", [])
-    plan = analysis.get("plan", [])
-    
-    # Format diagnoses for the letter
-    dx_summary = ""
-    for dx in diagnoses[:5]:
-        if isinstance(dx, dict) and dx.get("label"):
-            dx_summary += f"- {dx.get('label')}\n"
+def _schema_str(description: str) -> Dict[str, str]:
+    return {"type": "string", "description": description}
+
+
+def _schema_str_list(description: str) -> Dict[str, Any]:
+    return {"type": "array", "items": {"type": "string"}, "description": description}
+
+
+def _json_format(name: str, properties: Dict[str, Any]) -> Dict[str, Any]:
+    """Strict structured-output schema (an OpenAI json_schema block) requiring every property."""
+    return {
+        "name": name,
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False,
+        },
+    }
+
+
+# Reply shape for triage; the field descriptions double as the model's field guide
+_TRIAGE_FIELDS = {
+    "document_type": {
+        "type": "string",
+        "enum": [
+            "REFERRAL_REQUEST", "CONSULTATION_REPORT", "LAB_RESULTS", "INSURANCE", "RECORDS_REQUEST",
+            "PRESCRIPTION", "CORRESPONDENCE", "MARKETING", "OTHER",
+        ],
+    },
+    "urgency": {"type": "string", "enum": ["URGENT", "SOON", "ROUTINE"]},
+    "from_provider": _schema_str("name of sending doctor/organization"),
+    "from_clinic": _schema_str("clinic/organization name"),
+    "from_fax": _schema_str("fax number if visible"),
+    "regarding": _schema_str("clear description: patient name + what this is about"),
+    "patient_name": _schema_str("patient name if mentioned"),
+    "patient_dob": _schema_str("DOB if mentioned"),
+    "reasoning": _schema_str("brief explanation of your classification and why"),
+    "front_desk_tasks": _schema_str_list("specific actionable tasks with clear instructions"),
+    "doctor_tasks": _schema_str_list("specific actionable tasks requiring clinical decision"),
+    "key_clinical_info": _schema_str("any critical clinical details the doctor should know immediately"),
+}
+TRIAGE_FORMAT = _json_format("fax_triage", _TRIAGE_FIELDS)
+
+
+def triage_fax_prompt(summary_html: str, patient_block: str, full_text: str = "", analysis: dict = None) -> str:
+    """Per-fax request for triaging incoming communication; pair with TRIAGE_INSTRUCTIONS"""
+    context = full_text or html_to_prompt_text(summary_html, 10000)
     
-    # Format plan items
-    plan_summary = ""
-    for p in plan[:5]:
-        if isinstance(p, dict) and p.get("title"):
-            plan_summary += f"- {p.get('title')}\n"
-            for bullet in (p.get("bullets") or [])[:3]:
-                plan_summary += f"  â€¢ {bullet}\n"
+    # Include more analysis data if available
+    extra_context = ""
+    if analysis:
+        doc_type = analysis.get("document_type", "")
+        referral_info = analysis.get("referral_info", {})
+        diagnoses = analysis.get("diagnoses", [])
+        chief_complaint = analysis.get("chief_complaint", "")
+        provider_name = analysis.get("provider_name", "")
+        provider_clinic = analysis.get("provider_clinic", "")
+        
+        if doc_type:
+            extra_context += f"\nDocument type detected: {doc_type}"
+        if chief_complaint:
+            extra_context += f"\nChief complaint: {chief_complaint}"
+        if provider_name:
+            extra_context += f"\nSending provider: {provider_name}"
+        if provider_clinic:
+            extra_context += f"\nSending clinic: {provider_clinic}"
+        if referral_info.get("is_referral"):
+            extra_context += f"\nReferral direction: {referral_info.get('referral_direction', 'unknown')}"
+            extra_context += f"\nReferring to: {referral_info.get('referring_to', '')}"
+            extra_context += f"\nReason: {referral_info.get('reason_for_referral', '')}"
+            extra_context += f"\nRequested service: {referral_info.get('requested_service', '')}"
+        if diagnoses:
+            dx_list = ", ".join([d.get("label", "") for d in diagnoses[:5] if d.get("label")])
+            extra_context += f"\nDiagnoses: {dx_list}"
     
     return f"""
-You are a compassionate healthcare communicator writing a letter to a patient about their recent eye examination.
+{extra_context}
 
-PATIENT INFO:
-{analysis.get('patient_block', '')}
+Patient information:
+{patient_block}
 
-PROVIDER:
-{analysis.get('provider_name', '')}
+Document content:
+{context[:10000]}
+""".strip()
 
-CLINICAL SUMMARY:
-{analysis.get('summary_html', '')[:4000]}
 
-DIAGNOSES FOUND:
-{dx_summary}
+def _bulleted_items(items: List[Dict[str, Any]], title_key: str) -> str:
+    """'- title' lines, each followed by up to three indented bullets."""
+    return "".join(
+        f"- {item.get(title_key, '')}\n" + "".join(f"  â€¢ {b}\n" for b in (item.get("bullets") or [])[:3])
+        for item in items
+    )
 
-RECOMMENDED PLAN:
-{plan_summary}
+
+def _coded_diagnoses(diagnoses: List[Any]) -> str:
+    """'- code label' lines for the first five diagnoses, each with up to three bullets."""
+    return "".join(
+        f"- {dx.get('code', '')} {dx.get('label', '')}\n" + "".join(f"  â€¢ {b}\n" for b in dx.get("bullets", [])[:3])
+        for dx in diagnoses[:5]
+        if isinstance(dx, dict)
+    )
+
+
+PATIENT_LETTER_INSTRUCTIONS = """You are a compassionate healthcare communicator writing a letter to a patient about their recent eye examination.
 
 WRITING GUIDELINES:
 1. Use warm, reassuring language - patients may be anxious about their results
@@ -2044,40 +3325,26 @@ STRUCTURE:
 - Reassurance: Appropriate closing based on findings
 - Contact info: How to reach the clinic with questions
 
-Output VALID JSON only:
-{{
-  "letter": "string - the complete letter text with proper paragraph breaks"
-}}
-""".strip()
+LENGTH:
+- Match the DETAIL LEVEL in the request: brief (a few short paragraphs), standard, or detailed (explain each finding and step fully)"""
 
 
-def insurance_letter_prompt(analysis: dict) -> str:
-    """Prompt for generating insurance/prior authorization letter"""
+def patient_letter_prompt(analysis: dict, detail: str = "standard") -> str:
+    """Per-patient request for a patient-friendly letter; pair with PATIENT_LETTER_INSTRUCTIONS"""
     diagnoses = analysis.get("diagnoses", [])
     plan = analysis.get("plan", [])
     
-    # Format diagnoses with codes
-    dx_formatted = ""
-    for dx in diagnoses[:5]:
-        if isinstance(dx, dict):
-            code = dx.get("code", "")
-            label = dx.get("label", "")
-            bullets = dx.get("bullets", [])
-            dx_formatted += f"- {code} {label}\n"
-            for b in bullets[:3]:
-                dx_formatted += f"  â€¢ {b}\n"
+    # Format diagnoses for the letter
+    dx_summary = "".join(
+        f"- {dx.get('label')}\n" for dx in diagnoses[:5] if isinstance(dx, dict) and dx.get("label")
+    )
     
     # Format plan items
-    plan_formatted = ""
-    for p in plan[:5]:
-        if isinstance(p, dict):
-            plan_formatted += f"- {p.get('title', '')}\n"
-            for b in (p.get("bullets") or [])[:3]:
-                plan_formatted += f"  â€¢ {b}\n"
+    plan_summary = _bulleted_items(
+        [p for p in plan[:5] if isinstance(p, dict) and p.get("title")], "title"
+    )
     
     return f"""
-You are a medical documentation specialist writing a letter for insurance purposes (prior authorization, medical necessity, or appeal).
-
 PATIENT INFO:
 {analysis.get('patient_block', '')}
 
@@ -2085,13 +3352,19 @@ PROVIDER:
 {analysis.get('provider_name', '')}
 
 CLINICAL SUMMARY:
-{analysis.get('summary_html', '')[:4000]}
+{html_to_prompt_text(analysis.get('summary_html', ''), 4000)}
 
-DIAGNOSES (with ICD codes if available):
-{dx_formatted}
+DIAGNOSES FOUND:
+{dx_summary}
+
+RECOMMENDED PLAN:
+{plan_summary}
+
+DETAIL LEVEL: {detail}
+""".strip()
 
-TREATMENT PLAN:
-{plan_formatted}
+
+INSURANCE_LETTER_INSTRUCTIONS = """You are a medical documentation specialist writing a letter for insurance purposes (prior authorization, medical necessity, or appeal).
 
 LETTER REQUIREMENTS:
 1. Use formal medical terminology appropriate for insurance review
@@ -2122,31 +3395,74 @@ PERSUASION TECHNIQUES:
 - Cite impact on daily functioning / quality of life
 - Note any failed conservative treatments
 
-Output VALID JSON only:
-{{
-  "letter": "string - the complete formal letter text"
-}}
-""".strip()
+LENGTH:
+- Match the DETAIL LEVEL in the request: brief (a few short paragraphs), standard, or detailed (explain each finding and step fully)"""
 
 
-@api_bp.route("/triage_fax", methods=["POST"])
-@login_required
-def triage_fax():
-    """Triage an incoming fax/communication for front desk"""
-    payload = request.get_json(silent=True) or {}
-    analysis = payload.get("analysis") or {}
+def _plain_text_instructions(instructions: str, what: str) -> str:
+    """Letter instructions for a raw-text reply instead of the JSON schema."""
+    return f"{instructions}\n\nOutput only {what}. No JSON, markdown or commentary."
+
+
+PATIENT_LETTER_FORMAT = _json_format(
+    "patient_letter", {"letter": _schema_str("the complete letter text with proper paragraph breaks")}
+)
+INSURANCE_LETTER_FORMAT = _json_format("insurance_letter", {"letter": _schema_str("the complete formal letter text")})
+
+
+def insurance_letter_prompt(analysis: dict, detail: str = "standard") -> str:
+    """Per-patient request for an insurance/prior authorization letter; pair with INSURANCE_LETTER_INSTRUCTIONS"""
+    diagnoses = analysis.get("diagnoses", [])
+    plan = analysis.get("plan", [])
     
+    return f"""
+PATIENT INFO:
+{analysis.get('patient_block', '')}
+
+PROVIDER:
+{analysis.get('provider_name', '')}
+
+CLINICAL SUMMARY:
+{html_to_prompt_text(analysis.get('summary_html', ''), 4000)}
+
+DIAGNOSES (with ICD codes if available):
+{_coded_diagnoses(diagnoses)}
+
+TREATMENT PLAN:
+{_bulleted_items([p for p in plan[:5] if isinstance(p, dict)], "title")}
+
+DETAIL LEVEL: {detail}
+""".strip()
+
+
+TRIAGE_MAX_TOKENS = 1500
+
+
+def run_triage(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """Triage one analyzed fax; returns the /triage_fax response body."""
     summary_html = analysis.get("summary_html", "")
     patient_block = analysis.get("patient_block", "")
+    if not (summary_html or patient_block):
+        # Nothing for the model to triage; answer without an LLM round-trip
+        return {"ok": False, "error": "Insufficient analysis data"}
     
     # Pass full analysis for better context
     prompt = triage_fax_prompt(summary_html, patient_block, analysis=analysis)
-    obj, err = llm_json(prompt, temperature=0.1)  # Lower temperature for more consistent output
+    # Lower temperature for more consistent output; re-submitted faxes reuse the cached triage
+    obj, err = llm_json(
+        prompt,
+        temperature=0.1,
+        cache=True,
+        instructions=TRIAGE_INSTRUCTIONS,
+        schema=TRIAGE_FORMAT,
+        max_tokens=TRIAGE_MAX_TOKENS,
+        model=triage_model_name(),
+    )
     
     if err or not obj:
-        return jsonify({"ok": False, "error": err or "Triage failed"}), 200
+        return {"ok": False, "error": err or "Triage failed"}
     
-    return jsonify({
+    return {
         "ok": True,
         "document_type": obj.get("document_type", ""),
         "urgency": obj.get("urgency", "ROUTINE"),
@@ -2160,25 +3476,152 @@ def triage_fax():
         "front_desk_tasks": obj.get("front_desk_tasks", []),
         "doctor_tasks": obj.get("doctor_tasks", []),
         "key_clinical_info": obj.get("key_clinical_info", ""),
-        # Keep backwards compatibility
-        "from": obj.get("from_provider", obj.get("from", ""))
-    }), 200
+    }
+
+
+def wants_legacy_triage_fields() -> bool:
+    """True for callers that still read the deprecated 'from' alias of 'from_provider'.
+
+    Opt in with ?legacy=1 or an X-EyeDoc-Client-Version header below 1.5.
+    """
+    if request.args.get("legacy") == "1":
+        return True
+    version = (request.headers.get("X-EyeDoc-Client-Version") or "").strip()
+    if not version:
+        return False
+    try:
+        parts = tuple(int(p) for p in version.split(".")[:2])
+    except ValueError:
+        return False
+    return parts < (1, 5)
+
+
+@api_bp.route("/triage_fax", methods=["POST"])
+@login_required
+def triage_fax():
+    """Triage an incoming fax/communication for front desk"""
+    payload = request_json()
+    analysis = payload.get("analysis") or {}
+    result = run_triage(analysis)
+    if result.get("ok") and wants_legacy_triage_fields():
+        result["from"] = result["from_provider"]
+    return jsonify(result), 200
+
+
+# Batch triage fans out over a bounded pool; the work is waiting on the LLM, not CPU
+TRIAGE_BATCH_CONCURRENCY = int(os.getenv("TRIAGE_BATCH_CONCURRENCY", "8"))
+TRIAGE_BATCH_MAX = int(os.getenv("TRIAGE_BATCH_MAX", "50"))
+_TRIAGE_EXECUTOR = ThreadPoolExecutor(max_workers=TRIAGE_BATCH_CONCURRENCY, thread_name_prefix="triage")
+
+
+def run_triage_batch_job(job_id: str, analyses: List[Dict[str, Any]]) -> None:
+    set_job(job_id, status="processing", stage="triaging", stage_label="Triaging faxes...", progress=5, updated_at=now_utc_iso(), heartbeat_at=now_utc_iso())
+    futures = [_TRIAGE_EXECUTOR.submit(run_triage, analysis) for analysis in analyses]
+    results = []
+    for done, fut in enumerate(futures, 1):
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            results.append({"ok": False, "error": f"Triage failed: {type(e).__name__}: {e}"})
+        set_job(job_id, progress=5 + 90 * done // len(futures), heartbeat_at=now_utc_iso())
+    set_job(job_id, status="complete", stage="complete", progress=100, data={"ok": True, "results": results}, updated_at=now_utc_iso())
+
+
+@api_bp.route("/triage_fax_batch", methods=["POST"])
+@login_required
+def triage_fax_batch():
+    """Triage several analyzed faxes as a job polled via /triage_batch_status.
+
+    A batch can outlast the gunicorn request timeout when the provider is
+    slow, so it runs off the request thread; results keep the input order.
+    """
+    payload = request_json()
+    items = payload.get("items") or []
+    if not isinstance(items, list) or not items:
+        return jsonify({"ok": False, "error": "No items"}), 400
+    if len(items) > TRIAGE_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"At most {TRIAGE_BATCH_MAX} items per batch"}), 400
+    analyses = [(it.get("analysis") or {}) if isinstance(it, dict) else {} for it in items]
+    job_id = new_job_id()
+    set_job(job_id, status="waiting", stage="received", stage_label="Received", progress=0, updated_at=now_utc_iso())
+    try:
+        # The batch waits on _TRIAGE_EXECUTOR, so it must not run on it
+        started = start_background_job(run_triage_batch_job, job_id, analyses, executor=_REPORT_EXECUTOR)
+    except Exception:
+        started = False
+    if not started:
+        set_job(job_id, status="error", error="Could not start triage", updated_at=now_utc_iso())
+        return jsonify({"ok": False, "error": "Could not start triage"}), 500
+    return jsonify({"ok": True, "job_id": job_id}), 202
+
+
+# Output-token caps per assistant-letter detail level; generous enough that a
+# letter of the requested length is not cut off mid-sentence
+_LETTER_MAX_TOKENS = {"brief": 800, "standard": 1600, "detailed": 3200}
+
+# Streaming variants of the assistant-letter instructions, keyed by the JSON version
+_STREAM_INSTRUCTIONS = {
+    PATIENT_LETTER_INSTRUCTIONS: _plain_text_instructions(
+        PATIENT_LETTER_INSTRUCTIONS, "the complete letter text with proper paragraph breaks"
+    ),
+    INSURANCE_LETTER_INSTRUCTIONS: _plain_text_instructions(
+        INSURANCE_LETTER_INSTRUCTIONS, "the complete formal letter text"
+    ),
+}
+
+
+def _sse(obj: Dict[str, Any]) -> str:
+    return f"data: {_json_bytes(obj).decode('utf-8')}\n\n"
+
+
+def _stream_letter(prompt: str, instructions: str, max_tokens: Optional[int] = None) -> Response:
+    """Server-sent events: {"delta": ...} per chunk, then {"done": true} or {"error": ...}."""
+    def events() -> Iterator[str]:
+        got_text = False
+        try:
+            for delta in llm_text_stream(prompt, temperature=0.3, instructions=instructions, max_tokens=max_tokens):
+                got_text = True
+                yield _sse({"delta": delta})
+        except Exception as e:
+            yield _sse({"error": f"Letter generation failed: {type(e).__name__}: {e}"})
+            return
+        yield _sse({"done": True} if got_text else {"error": "Empty letter generated"})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @api_bp.route("/generate_assistant_letter", methods=["POST"])
 @login_required
 def generate_assistant_letter():
     """Generate patient or insurance letter from analysis"""
-    payload = request.get_json(silent=True) or {}
+    payload = request_json()
     analysis = payload.get("analysis") or {}
     letter_type = payload.get("letter_type", "patient")
+    detail = payload.get("detail") if payload.get("detail") in _LETTER_MAX_TOKENS else "standard"
+    if not (analysis.get("patient_block") or analysis.get("summary_html") or analysis.get("diagnoses")):
+        # An empty analysis only gets a refusal or an invented letter back
+        return jsonify({"ok": False, "error": "Insufficient analysis data"}), 200
     
     if letter_type == "insurance":
-        prompt = insurance_letter_prompt(analysis)
+        prompt = insurance_letter_prompt(analysis, detail)
+        instructions, schema = INSURANCE_LETTER_INSTRUCTIONS, INSURANCE_LETTER_FORMAT
     else:
-        prompt = patient_letter_prompt(analysis)
+        prompt = patient_letter_prompt(analysis, detail)
+        instructions, schema = PATIENT_LETTER_INSTRUCTIONS, PATIENT_LETTER_FORMAT
+    max_tokens = _LETTER_MAX_TOKENS[detail]
+
+    if payload.get("stream") or "text/event-stream" in (request.headers.get("Accept") or ""):
+        return _stream_letter(prompt, _STREAM_INSTRUCTIONS[instructions], max_tokens)
     
-    obj, err = llm_json(prompt, temperature=0.3)
+    # Not cached: letters are sampled at temperature 0.3 and asking again
+    # should give a fresh draft, as with the streamed path and build_report
+    obj, err = llm_json(
+        prompt, temperature=0.3, instructions=instructions, schema=schema, max_tokens=max_tokens
+    )
     
     if err or not obj:
         return jsonify({"ok": False, "error": err or "Letter generation failed"}), 200
@@ -2,6 +2,7 @@
 let uploadedFile = null
 let jobId = ""
 let latestAnalysis = null
+let partialShown = false
 let latestLetterHtml = ""
 // Single theme for consistency
 let theme = "light"
@@ -811,6 +812,7 @@ async function startAnalyze(triedOcr){
     return
   }
   jobId = json.job_id
+  partialShown = false
   pollAnalyze()
 }
 
@@ -844,6 +846,14 @@ async function pollAnalyze(){
     
     if(status === "waiting" || status === "processing"){
       setAnalyzeStatus("processing", stageLabel, progress)
+      // Show the analysis while citations are still being assigned
+      if(json.partial && !partialShown){
+        partialShown = true
+        latestAnalysis = json.partial
+        try{ renderSummary() }catch(e){ console.error("renderSummary error:", e) }
+        try{ renderDx() }catch(e){ console.error("renderDx error:", e) }
+        try{ renderPlan() }catch(e){ console.error("renderPlan error:", e) }
+      }
       setTimeout(pollAnalyze, 1200)
       return
     }
@@ -905,6 +915,32 @@ function buildForm(){
   }
 }
 
+// Poll a /generate_report job until it finishes; resolves to the letter response body
+async function waitForReport(reportJobId){
+  const deadline = Date.now() + 180000
+  while(Date.now() < deadline){
+    await new Promise(r => setTimeout(r, 1200))
+    let json
+    try{
+      const res = await fetch(`/report_status?job_id=${encodeURIComponent(reportJobId)}`)
+      json = await res.json()
+    }catch(e){
+      continue
+    }
+    if(!json.ok){
+      // The job may not be visible on this worker yet
+      continue
+    }
+    if(json.status === "complete"){
+      return json.data || { ok: false, error: "Generation failed" }
+    }
+    if(json.status === "error"){
+      return { ok: false, error: json.error || "Generation failed" }
+    }
+  }
+  return { ok: false, error: "Generation timed out" }
+}
+
 async function generateReport(){
   if(!latestAnalysis){
     toast("Analyze first")
@@ -914,14 +950,15 @@ async function generateReport(){
   btn.disabled = true
   setGenerateStatus("processing")
   const originalLabel = btn.textContent
-  const payload = { form: buildForm(), analysis: latestAnalysis }
+  const payload = { form: buildForm(), analysis: latestAnalysis, async: true }
   try{
     const res = await fetch("/generate_report", {
       method:"POST",
       headers: {"Content-Type":"application/json"},
       body: JSON.stringify(payload)
     })
-    const json = await res.json()
+    const started = await res.json()
+    const json = started.job_id ? await waitForReport(started.job_id) : started
     if(!json.ok){
       toast(json.error || "Generation failed")
       setGenerateStatus("idle")
@@ -1129,6 +1166,26 @@ async function stopRec(){
   }, 250)
 }
 
+// Upload straight to S3 with a presigned POST; returns the key, or "" to fall back to proxying
+async function uploadAudioDirect(blob){
+  try{
+    const res = await fetch("/transcribe_presign", {
+      method:"POST",
+      headers:{ "Content-Type":"application/json" },
+      body: JSON.stringify({ ext: ".webm" })
+    })
+    const json = await res.json()
+    if(!json.ok){ return "" }
+    const fd = new FormData()
+    Object.entries(json.fields || {}).forEach(([k, v]) => fd.append(k, v))
+    fd.append("file", blob, "recording.webm")
+    const up = await fetch(json.url, { method:"POST", body: fd })
+    return up.ok ? json.key : ""
+  }catch(e){
+    return ""
+  }
+}
+
 async function startTranscribeBlob(blob){
   el("recordState").textContent = "Transcribing"
   const fd = new FormData()
@@ -1136,7 +1193,12 @@ async function startTranscribeBlob(blob){
   const mode = el("recordMode") ? el("recordMode").value : "dictation"
   fd.append("language", lang)
   fd.append("mode", mode)
-  fd.append("audio", blob, "recording.webm")
+  const key = await uploadAudioDirect(blob)
+  if(key){
+    fd.append("key", key)
+  }else{
+    fd.append("audio", blob, "recording.webm")
+  }
   const res = await fetch("/transcribe_start", { method:"POST", body: fd })
   const json = await res.json()
   if(!json.ok){
@@ -1163,7 +1225,7 @@ async function pollTranscribe(){
     const st = json.status || "transcribing"
     if(st === "transcribing"){
       el("recordState").textContent = "Transcribing"
-      setTimeout(pollTranscribe, 1500)
+      setTimeout(pollTranscribe, json.next_poll_ms || 1500)
       return
     }
     if(st === "error"){
@@ -1200,6 +1262,7 @@ async function saveTranscriptToAnalyze(){
     return
   }
   jobId = json.job_id
+  partialShown = false
   closeRecord()
   setAnalyzeStatus("processing")
   pollAnalyze()
@@ -0,0 +1,61 @@
+"""
+Flask JSON provider backed by orjson
+
+jsonify() and request.get_json() go through app.json, so status polls,
+letters and triage results all serialize in C when orjson is installed.
+Anything orjson can't encode, and pretty-printed debug output, falls back
+to Flask's stdlib provider.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# Sorted keys keep responses (and their ETags) byte-stable like Flask's default.
+# Dates and dataclasses go through Flask's default() so they render as before.
+_ORJSON_OPTS = 0
+if orjson is not None:
+    _ORJSON_OPTS = (
+        orjson.OPT_SORT_KEYS
+        | orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """DefaultJSONProvider with orjson fast paths for dumps, loads and response."""
+
+    def _orjson_ok(self, kwargs) -> bool:
+        if orjson is None or kwargs:
+            return False
+        return self.compact or (self.compact is None and not self._app.debug)
+
+    def dumps(self, obj, **kwargs):
+        if self._orjson_ok(kwargs):
+            try:
+                return orjson.dumps(obj, default=self.default, option=_ORJSON_OPTS).decode("utf-8")
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass  # let the stdlib raise its usual error
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if self._orjson_ok({}):
+            obj = self._prepare_response_obj(args, kwargs)
+            try:
+                body = orjson.dumps(obj, default=self.default, option=_ORJSON_OPTS | orjson.OPT_APPEND_NEWLINE)
+            except TypeError:
+                pass
+            else:
+                return self._app.response_class(body, mimetype=self.mimetype)
+        return super().response(*args, **kwargs)
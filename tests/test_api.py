@@ -116,3 +116,17 @@ class TestExportPDF:
             content_type='application/json')
         
         assert response.status_code == 400
+
+
+class TestJsonProvider:
+    """Test the orjson-backed Flask JSON provider"""
+
+    def test_matches_stdlib_output(self, app, monkeypatch):
+        """Sorted keys and Flask's date rendering survive the orjson fast path"""
+        from datetime import datetime
+        from flask import jsonify
+        monkeypatch.setattr(app, 'debug', False)
+        with app.test_request_context():
+            body = jsonify({'b': 1, 'a': 'Olá', 'at': datetime(2026, 1, 1)}).get_data()
+        assert json.loads(body) == {'a': 'Olá', 'at': 'Thu, 01 Jan 2026 00:00:00 GMT', 'b': 1}
+        assert body.index(b'"a"') < body.index(b'"b"')
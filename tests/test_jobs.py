@@ -0,0 +1,264 @@
+"""
+Job persistence tests
+"""
+import io
+import json
+import os
+import threading
+
+import pytest
+
+from app import api
+
+
+class FakeS3:
+    """Records put_object calls instead of talking to AWS"""
+
+    def __init__(self):
+        self.puts = []
+        self.objects = {}
+
+    def put_object(self, **kwargs):
+        self.puts.append(kwargs)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise KeyError(Key)
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+@pytest.fixture
+def job_env(tmp_path, monkeypatch):
+    """Isolated job dir with a fake S3 mirror."""
+    s3 = FakeS3()
+    monkeypatch.setattr(api, "JOB_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(api, "job_s3_enabled", lambda: True)
+    monkeypatch.setattr(api, "aws_clients", lambda: (s3, None))
+    monkeypatch.setenv("AWS_S3_BUCKET", "test-bucket")
+    monkeypatch.setattr(api, "JOBS", {})
+    monkeypatch.setattr(api, "_LAST_PERSIST", {})
+    monkeypatch.setattr(api, "_JOB_FILE_SIG", {})
+    return s3
+
+
+class TestSetJob:
+    """Test set_job persistence"""
+
+    def test_heartbeat_ticks_are_debounced(self, job_env):
+        """Heartbeat-only updates right after a write should not hit S3"""
+        api.set_job("job_1", status="processing", stage="analyzing")
+        api.set_job("job_1", heartbeat_at="t1")
+        api.set_job("job_1", heartbeat_at="t2", progress=20)
+        assert api.flush_job_writes()
+        assert len(job_env.puts) == 1
+        assert api.get_job("job_1")["heartbeat_at"] == "t2"
+
+    def test_heartbeat_ticks_skip_the_job_file(self, job_env):
+        """Debounced ticks stay in memory; the next stage change writes them out"""
+        api.set_job("job_9", status="processing", stage="analyzing")
+        api.set_job("job_9", heartbeat_at="t1", progress=20)
+        with open(api._job_path("job_9"), encoding="utf-8") as f:
+            assert "heartbeat_at" not in json.load(f)
+        api.set_job("job_9", stage="references")
+        with open(api._job_path("job_9"), encoding="utf-8") as f:
+            assert json.load(f)["progress"] == 20
+
+    def test_stage_and_status_changes_always_persist(self, job_env):
+        """Stage transitions and terminal status must reach S3"""
+        api.set_job("job_2", status="processing", stage="analyzing")
+        api.set_job("job_2", stage="references", progress=65)
+        api.set_job("job_2", status="complete", stage="complete", progress=100)
+        assert api.flush_job_writes()
+        assert 1 <= len(job_env.puts) <= 3
+        assert json.loads(job_env.puts[-1]["Body"])["status"] == "complete"
+
+    def test_s3_writes_coalesce_per_job(self, job_env):
+        """Only the newest pending snapshot for a job is uploaded"""
+        # Holding the condition keeps the writer from draining between queues
+        with api._S3_COND:
+            api._queue_s3_write("job_3", b"old")
+            api._queue_s3_write("job_3", b"new")
+        assert api.flush_job_writes()
+        assert [p["Body"] for p in job_env.puts] == [b"new"]
+
+    def test_pending_jobs_upload_as_one_batch(self, job_env):
+        """Snapshots for different jobs all land, each at its latest version"""
+        with api._S3_COND:
+            for job_id in ("job_a", "job_b", "job_c"):
+                api._queue_s3_write(job_id, b"old")
+                api._queue_s3_write(job_id, job_id.encode())
+        assert api.flush_job_writes()
+        assert sorted(p["Body"] for p in job_env.puts) == [b"job_a", b"job_b", b"job_c"]
+
+
+class TestGetJob:
+    """Test get_job cache validation"""
+
+    def test_reads_cache_while_file_unchanged(self, job_env, monkeypatch):
+        """Same-worker reads should not re-parse the job file"""
+        api.set_job("job_4", status="processing")
+        monkeypatch.setattr(api, "_json_from_bytes", lambda data: pytest.fail("file was re-read"))
+        assert api.get_job("job_4")["status"] == "processing"
+
+    def test_rereads_file_written_by_another_worker(self, job_env):
+        """A write from another process must invalidate the cached copy"""
+        api.set_job("job_5", status="processing")
+        with open(api._job_path("job_5"), "w", encoding="utf-8") as f:
+            json.dump({"status": "complete", "progress": 100}, f)
+        assert api.get_job("job_5")["status"] == "complete"
+
+    def test_same_size_rewrite_in_one_mtime_tick_is_seen(self, job_env):
+        """A renamed-in file is a new inode even when size and mtime match"""
+        api.set_job("job_11", status="processing")
+        path = api._job_path("job_11")
+        before = os.stat(path)
+        with open(path + ".other", "wb") as f:
+            f.write(json.dumps({"status": "complete"}).encode().ljust(before.st_size))
+        os.utime(path + ".other", ns=(before.st_atime_ns, before.st_mtime_ns))
+        os.replace(path + ".other", path)
+        assert api.get_job("job_11")["status"] == "complete"
+
+    def test_returns_read_only_snapshot(self, job_env):
+        """Callers share the cached snapshot, so it must not be writable"""
+        api.set_job("job_10", status="processing")
+        job = api.get_job("job_10")
+        with pytest.raises(TypeError):
+            job["status"] = "complete"
+        api.set_job("job_10", status="complete")
+        assert job["status"] == "processing"
+        assert api.get_job("job_10")["status"] == "complete"
+
+    def test_s3_prefers_current_key_over_legacy(self, job_env):
+        """Candidate keys are probed together but the current prefix wins"""
+        legacy, current = api.job_s3_key_fallbacks("job_8")[1], api.job_s3_key("job_8")
+        job_env.objects[legacy] = b'{"status": "processing"}'
+        job_env.objects[current] = b'{"status": "complete"}'
+        assert api.get_job("job_8")["status"] == "complete"
+        del job_env.objects[current]
+        api.JOBS.clear()
+        os.remove(api._job_path("job_8"))
+        assert api.get_job("job_8")["status"] == "processing"
+
+
+class TestRunAnalysisJob:
+    """Test the analysis pipeline's job updates"""
+
+    def test_partial_analysis_is_not_mutated_by_citations(self, job_env, monkeypatch):
+        """The previewed snapshot keeps its state while refs are assigned"""
+        replies = iter([
+            ({"diagnoses": [{"number": 1, "label": "POAG"}], "plan": []}, ""),
+            ({"diagnoses": [{"number": 1, "refs": [1]}], "plan": []}, ""),
+        ])
+        monkeypatch.setattr(api, "llm_json", lambda *a, **kw: next(replies))
+        monkeypatch.setattr(api, "pubmed_fetch_for_terms", lambda terms, **kw: [{"pmid": "1"}])
+        monkeypatch.setattr(api, "canonical_reference_pool", lambda labels, **kw: [])
+        monkeypatch.setattr(api, "merge_references", lambda refs, canonical: refs)
+        partials = []
+        set_job = api.set_job
+
+        def recording_set_job(job_id, **updates):
+            if updates.get("partial"):
+                partials.append(updates["partial"])
+            set_job(job_id, **updates)
+
+        monkeypatch.setattr(api, "set_job", recording_set_job)
+        api.run_analysis_job("job_12", "note")
+        assert "refs" not in partials[0]["diagnoses"][0]
+        assert api.get_job("job_12")["data"]["diagnoses"][0]["refs"] == [1]
+
+    def test_image_uploads_are_recognised_on_the_ocr_pool(self, job_env, tmp_path, monkeypatch):
+        """Analysis threads never run tesseract themselves"""
+        from PIL import Image
+
+        upload = tmp_path / "scan.png"
+        Image.new("L", (8, 8), 255).save(upload)
+        threads, notes = [], []
+        monkeypatch.setattr(api, "ocr_image", lambda img, psm=6: threads.append(threading.current_thread().name) or "IOP 28")
+        monkeypatch.setattr(api, "run_analysis_job", lambda job_id, note_text: notes.append(note_text))
+        api.set_job("job_13", upload_path=str(upload))
+        api.run_analysis_upload_job("job_13", "scan.png")
+        assert notes == ["IOP 28"]
+        assert threads[0].startswith("ocr-page")
+
+
+class TestStartBackgroundJob:
+    """Test analysis job scheduling"""
+
+    def test_same_job_is_not_scheduled_twice(self):
+        """A resume racing a running job must not start a second copy"""
+        started, release = threading.Event(), threading.Event()
+        runs = []
+
+        def work(job_id):
+            runs.append(job_id)
+            started.set()
+            release.wait(5)
+
+        assert api.start_background_job(work, "job_6") is True
+        assert started.wait(5)
+        assert api.start_background_job(work, "job_6") is False
+        release.set()
+        assert runs == ["job_6"]
+
+
+class TestStatusPolling:
+    """Test status endpoint polling"""
+
+    def test_transcribe_status_throttles_aws_lookups(self, app, job_env, monkeypatch):
+        """Polls inside the interval should not query Transcribe again"""
+        calls = []
+        monkeypatch.setattr(api, "_TRANSCRIBE_CHECKED", {})
+        monkeypatch.setattr(api, "fetch_transcribe_result", lambda job_id: calls.append(job_id) or ("", "in_progress", ""))
+        api.set_job("job_7", status="transcribing")
+        view = api.transcribe_status.__wrapped__
+        for _ in range(3):
+            with app.test_request_context("/transcribe_status?job_id=job_7"):
+                assert view().get_json()["status"] == "transcribing"
+        assert calls == ["job_7"]
+
+    def test_transcribe_throttle_forgets_finished_and_abandoned_jobs(self, app, job_env, monkeypatch):
+        """Failed jobs leave the throttle map, and long-unpolled entries are swept"""
+        monkeypatch.setattr(api, "_TRANSCRIBE_CHECKED", {"job_old": api.time.monotonic() - 2 * api._TRANSCRIBE_CHECKED_TTL})
+        monkeypatch.setattr(api, "fetch_transcribe_result", lambda job_id: ("", "failed", "Transcribe failed"))
+        api.set_job("job_14", status="transcribing")
+        with app.test_request_context("/transcribe_status?job_id=job_14"):
+            assert api.transcribe_status.__wrapped__().get_json()["status"] == "error"
+        assert api._TRANSCRIBE_CHECKED == {}
+
+    def test_unchanged_status_returns_304(self, app):
+        """A poll with a matching ETag gets an empty 304"""
+        with app.test_request_context("/analyze_status"):
+            etag = api.job_status_response({"status": "processing"}).get_etag()[0]
+        with app.test_request_context("/analyze_status", headers={"If-None-Match": f'"{etag}"'}):
+            assert api.job_status_response({"status": "processing"}).status_code == 304
+
+    def test_transcribe_start_rejects_foreign_keys(self, app, job_env):
+        """Only keys minted by /transcribe_presign may be transcribed"""
+        view = api.transcribe_start.__wrapped__
+        with app.test_request_context("/transcribe_start", method="POST", data={"key": "jobs/secret.json"}):
+            assert view()[1] == 400
+
+    def test_async_report_runs_as_a_polled_job(self, app, job_env, monkeypatch):
+        """async letters return 202 and a job whose data is the letter response"""
+        monkeypatch.setattr(api, "build_report", lambda form, analysis: {"ok": True, "letter_plain": "Dear Dr. Kim"})
+        monkeypatch.setattr(api, "start_background_job", lambda target, job_id, *args, **kw: target(job_id, *args) or True)
+        with app.test_request_context("/generate_report", method="POST", json={"form": {}, "analysis": {}, "async": True}):
+            resp, status = api.generate_report.__wrapped__()
+        job_id = resp.get_json()["job_id"]
+        assert status == 202
+        with app.test_request_context(f"/report_status?job_id={job_id}"):
+            body = api.report_status.__wrapped__().get_json()
+        assert body["status"] == "complete"
+        assert body["data"]["letter_plain"] == "Dear Dr. Kim"
+
+    def test_async_report_that_cannot_start_is_an_error(self, app, job_env, monkeypatch):
+        """A failed submission fails the request instead of leaving a job waiting forever"""
+        def refuse(*args, **kw):
+            raise RuntimeError("cannot schedule new futures after shutdown")
+
+        monkeypatch.setattr(api, "start_background_job", refuse)
+        with app.test_request_context("/generate_report", method="POST", json={"form": {}, "analysis": {}, "async": True}):
+            resp, status = api.generate_report.__wrapped__()
+        assert status == 500
+        assert [job["status"] for job in api.JOBS.values()] == ["error"]
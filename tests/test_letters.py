@@ -0,0 +1,76 @@
+"""
+Letter formatting tests
+"""
+import os
+from collections import OrderedDict
+
+import pytest
+
+from app import api
+
+PNG_DATA_URL = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+class TestLetterLineKind:
+    """Test export_pdf line classification"""
+
+    def test_exact_and_prefix_lines(self):
+        """Headings match exactly; header and sign-off lines match by prefix"""
+        assert api.letter_line_kind("assessment:") == "heading"
+        assert api.letter_line_kind("clinical summary") == "skip"
+        assert api.letter_line_kind("reason for referral: poag") == "reason_referral"
+        assert api.letter_line_kind("to: dr smith") == "header"
+        assert api.letter_line_kind("kind regards,") == "signoff"
+
+    def test_plain_text_lines(self):
+        """Body text that merely contains a keyword stays a paragraph"""
+        assert api.letter_line_kind("plan to review in 3 months") == "text"
+        assert api.letter_line_kind("she was seen to: assess iop") == "text"
+
+
+class TestDataUrlTempfile:
+    """Test letterhead/signature data URL decoding"""
+
+    def test_repeat_upload_reuses_decoded_file(self, tmp_path, monkeypatch):
+        """The same data URL is decoded once and then served from cache"""
+        monkeypatch.setattr(api.tempfile, "gettempdir", lambda: str(tmp_path))
+        monkeypatch.setattr(api, "_DATA_URL_FILES", OrderedDict())
+        first = api.data_url_to_tempfile(PNG_DATA_URL, "letterhead")
+        monkeypatch.setattr(api.base64, "b64decode", lambda data: pytest.fail("decoded twice"))
+        monkeypatch.setattr(api, "pybase64", None)
+        assert api.data_url_to_tempfile(PNG_DATA_URL, "letterhead") == first
+        assert open(first, "rb").read().startswith(b"\x89PNG")
+
+    def test_eviction_keeps_files_and_prunes_stale_ones(self, tmp_path, monkeypatch):
+        """Dropped entries stay on disk for in-flight exports; unused files age out"""
+        monkeypatch.setattr(api.tempfile, "gettempdir", lambda: str(tmp_path))
+        monkeypatch.setattr(api, "_DATA_URL_FILES", OrderedDict())
+        monkeypatch.setattr(api, "_DATA_URL_PRUNED_AT", 0.0)
+        monkeypatch.setattr(api, "DATA_URL_CACHE_SIZE", 1)
+        stale = tmp_path / f"maneiro_signature_{'0' * 40}.png"
+        stale.write_bytes(b"")
+        os.utime(stale, (0, 0))
+        (tmp_path / "maneiro_jobs").mkdir()
+        first = api.data_url_to_tempfile(PNG_DATA_URL, "letterhead")
+        second = api.data_url_to_tempfile(PNG_DATA_URL + "==", "signature")
+        assert list(api._DATA_URL_FILES.values()) == [second]
+        assert os.path.exists(first) and os.path.exists(second)
+        assert not stale.exists() and (tmp_path / "maneiro_jobs").is_dir()
+
+    def test_image_size_is_measured_once(self, tmp_path, monkeypatch):
+        """Signature dimensions come from cache until the file changes"""
+        monkeypatch.setattr(api.tempfile, "gettempdir", lambda: str(tmp_path))
+        monkeypatch.setattr(api, "_DATA_URL_FILES", OrderedDict())
+        path = api.data_url_to_tempfile(PNG_DATA_URL, "signature")
+        before = api._image_size_cached.cache_info().hits
+        assert api.image_size(path) == (1.0, 1.0)
+        assert api.image_size(path) == (1.0, 1.0)
+        assert api._image_size_cached.cache_info().hits == before + 1
+
+    def test_signature_lookup_sees_new_files(self, tmp_path):
+        """The cached directory listing is refreshed when the directory changes"""
+        assert api.find_signature_file(str(tmp_path), "dr_smith") is None
+        (tmp_path / "dr_smith.jpg").write_bytes(b"")
+        assert api.find_signature_file(str(tmp_path), "dr_smith") == str(tmp_path / "dr_smith.jpg")
@@ -0,0 +1,251 @@
+"""
+LLM helper tests
+"""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app import api
+
+
+class TestLLMCache:
+    """Test the llm_json response cache"""
+
+    def test_hit_returns_independent_copy(self):
+        """Cached results must not be shared between callers"""
+        cache = api.LLMCache(maxsize=4, ttl=60)
+        key = api.LLMCache.key("gpt-4.1", "prompt", 0.2)
+        cache.set(key, {"diagnoses": [{"number": 1}]})
+        first = cache.get(key)
+        first["diagnoses"][0]["refs"] = [1]
+        assert cache.get(key) == {"diagnoses": [{"number": 1}]}
+
+    def test_key_depends_on_model_and_temperature(self):
+        """Different models or temperatures must not share entries"""
+        base = api.LLMCache.key("gpt-4.1", "prompt", 0.2)
+        assert base != api.LLMCache.key("gpt-4.1-mini", "prompt", 0.2)
+        assert base != api.LLMCache.key("gpt-4.1", "prompt", 0.0)
+        assert base != api.LLMCache.key("gpt-4.1", "prompt", 0.2, instructions="letter")
+
+    def test_evicts_least_recently_used(self):
+        """Cache stays bounded"""
+        cache = api.LLMCache(maxsize=2, ttl=60)
+        cache.set("a", {"v": 1})
+        cache.set("b", {"v": 2})
+        cache.get("a")
+        cache.set("c", {"v": 3})
+        assert cache.get("b") is None
+        assert cache.get("a") == {"v": 1}
+
+    def test_expired_entries_are_dropped(self):
+        """Entries older than the TTL are misses"""
+        cache = api.LLMCache(maxsize=2, ttl=-1)
+        cache.set("a", {"v": 1})
+        assert cache.get("a") is None
+
+
+class TestClients:
+    """Test SDK client reuse"""
+
+    def test_openai_client_is_reused_per_key(self, monkeypatch):
+        """Repeat calls share one client (and its connection pool) until the key changes"""
+        monkeypatch.setattr(api, "_SDK_CLIENTS", {})
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test-one")
+        first = api.get_client()
+        assert first is not None and api.get_client() is first
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test-two")
+        assert api.get_client() is not first
+
+
+class TestSafeJsonLoads:
+    """Test model output parsing"""
+
+    def test_fenced_output_with_trailing_commas(self):
+        """Fences are stripped and trailing commas repaired as a last resort"""
+        obj, err = api.safe_json_loads('```json\n{"letter": "Olá", "refs": [1, 2,],}\n```')
+        assert err == ""
+        assert obj == {"letter": "Olá", "refs": [1, 2]}
+
+    def test_object_is_cut_out_of_surrounding_prose(self):
+        """Braces inside strings and after the object do not confuse extraction"""
+        obj, err = api.safe_json_loads('Here you go: {"note": "IOP {high}", "eye": "OD"} as requested {see above}')
+        assert err == ""
+        assert obj == {"note": "IOP {high}", "eye": "OD"}
+
+
+class TestLLMJson:
+    """Test llm_json request handling"""
+
+    def test_concurrent_identical_requests_share_one_call(self, monkeypatch):
+        """A double-submitted request waits for the first instead of calling again"""
+        calls = []
+
+        def fake_call(prompt, temperature, instructions, schema=None, max_tokens=None, model=""):
+            calls.append(prompt)
+            time.sleep(0.2)
+            return {"letter": "Dear Jane"}, ""
+
+        monkeypatch.setattr(api, "LLM_CACHE", api.LLMCache(maxsize=4, ttl=60))
+        monkeypatch.setattr(api, "_llm_json_call", fake_call)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(api.llm_json("same prompt", cache=True)))
+            for _ in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        assert calls == ["same prompt"]
+        assert results == [({"letter": "Dear Jane"}, "")] * 3
+        assert api._LLM_INFLIGHT == {}
+
+    def test_schema_is_sent_as_structured_output(self, monkeypatch):
+        """A schema rides along as response_format; token usage is tallied per kind"""
+        sent = {}
+
+        def create(**kwargs):
+            sent.update(kwargs)
+            message = SimpleNamespace(content='{"letter": "Dear Jane"}')
+            usage = SimpleNamespace(
+                prompt_tokens=1200, completion_tokens=300, prompt_tokens_details=SimpleNamespace(cached_tokens=1024)
+            )
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        monkeypatch.setattr(api, "get_client", lambda: client)
+        monkeypatch.setattr(api, "LLM_USAGE", {})
+        monkeypatch.setattr(api, "LLM_CACHE", api.LLMCache(maxsize=4, ttl=60))
+        for _ in range(2):
+            obj, err = api.llm_json("prompt", cache=True, schema=api.PATIENT_LETTER_FORMAT)
+            assert (obj, err) == ({"letter": "Dear Jane"}, "")
+        assert sent["response_format"] == {"type": "json_schema", "json_schema": api.PATIENT_LETTER_FORMAT}
+        assert sent["model"] == api.model_name()
+        assert api.TRIAGE_FORMAT["schema"]["required"] == list(api.TRIAGE_FORMAT["schema"]["properties"])
+        assert api.llm_usage_snapshot() == {
+            "patient_letter": {"calls": 1, "prompt": 1200, "cached_prompt": 1024, "completion": 300, "cache_hits": 1}
+        }
+
+    def test_triage_uses_the_triage_model(self, monkeypatch):
+        """Triage requests go to TRIAGE_MODEL rather than OPENAI_MODEL"""
+        seen = {}
+        monkeypatch.setenv("TRIAGE_MODEL", "small-model")
+        monkeypatch.setattr(api, "llm_json", lambda prompt, **kw: (seen.update(kw) or {"urgency": "SOON"}, ""))
+        assert api.run_triage({"patient_block": "Jane Doe"})["urgency"] == "SOON"
+        assert seen["model"] == "small-model"
+
+    def test_assistant_letter_streams_deltas(self, app, monkeypatch):
+        """Streaming requests get SSE deltas with plain-text instructions"""
+        seen = {}
+
+        def fake_stream(prompt, temperature=0.2, instructions="", max_tokens=None):
+            seen["instructions"] = instructions
+            seen["max_tokens"] = max_tokens
+            yield "Dear "
+            yield "Jane"
+
+        monkeypatch.setattr(api, "llm_text_stream", fake_stream)
+        view = api.generate_assistant_letter.__wrapped__
+        with app.test_request_context("/generate_assistant_letter", method="POST", json={"analysis": {"patient_block": "Jane Doe"}, "stream": True, "detail": "brief"}):
+            body = "".join(view().response)
+        events = [json.loads(e[len("data: "):]) for e in body.split("\n\n") if e]
+        assert events == [{"delta": "Dear "}, {"delta": "Jane"}, {"done": True}]
+        assert "Output VALID JSON" not in seen["instructions"]
+        assert seen["max_tokens"] == api._LETTER_MAX_TOKENS["brief"]
+
+    def test_empty_analysis_skips_the_model(self, app, monkeypatch):
+        """Letters and triage for an empty analysis fail fast without an LLM call"""
+        monkeypatch.setattr(api, "llm_json", lambda *a, **k: pytest.fail("LLM was called"))
+        view = api.generate_assistant_letter.__wrapped__
+        with app.test_request_context("/generate_assistant_letter", method="POST", json={"analysis": {}}):
+            resp, status = view()
+        assert resp.get_json() == {"ok": False, "error": "Insufficient analysis data"}
+        assert api.run_triage({"diagnoses": []})["ok"] is False
+
+    def test_request_body_parsing(self, app):
+        """Bodies parse like get_json(silent=True), with anything but an object read as {}"""
+        with app.test_request_context("/triage_fax", method="POST", json={"analysis": {"patient_block": "Jane"}}):
+            assert api.request_json() == {"analysis": {"patient_block": "Jane"}}
+        for kwargs in ({"data": "{oops", "content_type": "application/json"}, {"json": [1, 2]}, {"data": "{}"}):
+            with app.test_request_context("/triage_fax", method="POST", **kwargs):
+                assert api.request_json() == {}
+
+
+class TestLetterPrompt:
+    """Test letter prompt layout"""
+
+    def test_per_letter_fields_stay_out_of_instructions(self):
+        """Only the request half varies between letters"""
+        prompt = api.letter_prompt({"reason_label": "Reason for Referral", "output_language": "French"}, {})
+        assert "reason_label: Reason for Referral" in prompt
+        assert "Write the letter in French." in prompt
+        assert "Reason for Referral" not in api.LETTER_INSTRUCTIONS
+
+    def test_sender_fields_precede_per_letter_fields(self):
+        """A provider's letters share everything up to the recipient"""
+        prompts = [
+            api.letter_prompt({"from_doctor": "Dr. Lee", "to_whom": to, "output_language": "en"}, {"patient_block": to})
+            for to in ("Dr. Kim", "Dr. Park")
+        ]
+        head = prompts[0].split("Letter settings:")[0]
+        assert "Dr. Lee" in head and "Dr. Kim" not in head
+        assert prompts[1].startswith(head)
+
+    def test_assistant_prompts_carry_only_patient_data(self):
+        """Triage and assistant-letter requests leave the boilerplate to their instructions"""
+        analysis = {"patient_block": "Jane Doe", "diagnoses": [{"label": "POAG"}]}
+        for prompt in (
+            api.triage_fax_prompt("", "Jane Doe", analysis=analysis),
+            api.patient_letter_prompt(analysis),
+            api.insurance_letter_prompt(analysis),
+        ):
+            assert "Jane Doe" in prompt
+            assert "Output VALID JSON" not in prompt
+
+    def test_legacy_from_alias_is_opt_in(self, app, monkeypatch):
+        """Only old clients get the duplicate 'from' field"""
+        monkeypatch.setattr(api, "run_triage", lambda analysis: {"ok": True, "from_provider": "Dr. Lee"})
+        view = api.triage_fax.__wrapped__
+        for url, headers, expected in (
+            ("/triage_fax", {}, False),
+            ("/triage_fax?legacy=1", {}, True),
+            ("/triage_fax", {"X-EyeDoc-Client-Version": "1.4.2"}, True),
+            ("/triage_fax", {"X-EyeDoc-Client-Version": "1.5"}, False),
+        ):
+            with app.test_request_context(url, method="POST", json={"analysis": {}}, headers=headers):
+                body = view()[0].get_json()
+            assert ("from" in body) is expected
+            assert body["from_provider"] == "Dr. Lee"
+
+    def test_triage_batch_keeps_input_order(self, app, tmp_path, monkeypatch):
+        """Batch results line up with the submitted items"""
+        monkeypatch.setattr(api, "JOB_DIR", str(tmp_path))
+        monkeypatch.setattr(api, "job_s3_enabled", lambda: False)
+        monkeypatch.setattr(api, "run_triage", lambda analysis: {"ok": True, "regarding": analysis.get("patient_block")})
+        monkeypatch.setattr(api, "start_background_job", lambda target, job_id, *args, **kw: target(job_id, *args) or True)
+        items = [{"analysis": {"patient_block": name}} for name in ("A", "B", "C")]
+        with app.test_request_context("/triage_fax_batch", method="POST", json={"items": items}):
+            resp, status = api.triage_fax_batch.__wrapped__()
+        assert status == 202
+        with app.test_request_context(f"/triage_batch_status?job_id={resp.get_json()['job_id']}"):
+            body = api.report_status.__wrapped__().get_json()
+        assert body["status"] == "complete"
+        assert [r["regarding"] for r in body["data"]["results"]] == ["A", "B", "C"]
+
+    def test_summary_markup_is_stripped_before_clipping(self):
+        """The summary budget is spent on text, not tags"""
+        html = "<p><b>Examination:</b><ul>" + "<li>IOP 28 mmHg OD</li>" * 400 + "</ul></p>"
+        text = api.html_to_prompt_text(html, 4000)
+        assert "<" not in text
+        assert text.startswith("Examination:\n- IOP 28 mmHg OD\n")
+        assert len(text) == 4000
+
+    def test_report_markup_becomes_plain_lines(self, monkeypatch):
+        """Line-break tags turn into newlines and other tags are dropped"""
+        letter = "Dear Dr. Kim,<br/><p>Reason for Referral: <b>POAG</b></p><P>Thanks</P>"
+        monkeypatch.setattr(api, "llm_json", lambda *a, **kw: ({"letter_plain": letter}, ""))
+        out = api.build_report({"document_type": "Optometrist"}, {})["letter_plain"]
+        assert out == "Dear Dr. Kim,\n\nReason for Report: POAG\n\nThanks"
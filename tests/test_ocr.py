@@ -0,0 +1,164 @@
+"""
+OCR pipeline tests
+"""
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app import api
+
+fitz = pytest.importorskip("fitz")
+
+
+def _text_page():
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 72), "IOP 28 mmHg OD", fontsize=14)
+    return doc, page
+
+
+class TestOcrPipeline:
+    """Test page rendering and engine selection"""
+
+    def test_pages_render_to_clamped_grayscale(self):
+        """Pages come out as 8-bit grayscale with near-black/white levels clamped"""
+        doc, page = _text_page()
+        img = api._ocr_page_image(page, 100)
+        hist = img.histogram()
+        assert img.mode == "L"
+        assert img.size == (827, 1170)
+        assert sum(hist[1:15]) == 0 and sum(hist[241:255]) == 0
+        assert hist[0] and hist[255]
+        doc.close()
+
+    def test_falls_back_to_the_tesseract_cli(self, monkeypatch):
+        """Without an in-process engine, pages go through pytesseract"""
+        calls = []
+        monkeypatch.setattr(api, "_TESS_LOCAL", threading.local())
+        monkeypatch.setattr(api, "_TESS_ERROR", "tesserocr not available")
+        monkeypatch.setattr(
+            api.pytesseract, "image_to_string", lambda img, config="": calls.append((img.mode, config)) or "IOP 28"
+        )
+        doc, page = _text_page()
+        assert api.ocr_image(api._ocr_page_image(page, 100)) == "IOP 28"
+        assert calls == [("L", "--psm 6")]
+        doc.close()
+
+    def test_readiness_check_keeps_no_engine(self, monkeypatch):
+        """ocr_ready probes tesserocr once and leaves no engine on the calling thread"""
+        engines = []
+
+        class FakeEngine:
+            def __init__(self, path=None):
+                self.ended = False
+                engines.append(self)
+
+            def End(self):
+                self.ended = True
+
+        monkeypatch.setattr(api, "tesserocr", SimpleNamespace(PyTessBaseAPI=FakeEngine))
+        monkeypatch.setattr(api, "_TESS_LOCAL", threading.local())
+        monkeypatch.setattr(api, "_TESS_ERROR", "")
+        monkeypatch.setattr(api, "_TESS_OK", False)
+        assert api.ocr_ready() == (True, "")
+        assert api.ocr_ready() == (True, "")
+        assert len(engines) == 1 and engines[0].ended
+        assert getattr(api._TESS_LOCAL, "engine", None) is None
+
+    def test_parallel_pages_keep_document_order(self, monkeypatch):
+        """Pages finishing out of order still join in page order"""
+        def fake_ocr(img, psm=6):
+            time.sleep(0.05 if img.width < 300 else 0)
+            return str(img.width), 90
+
+        monkeypatch.setattr(api, "ocr_image_conf", fake_ocr)
+        monkeypatch.setattr(api, "OCR_MIN_PAGE_CHARS", 0)
+        doc = fitz.open()
+        for width in (200, 400, 600):
+            doc.new_page(width=width, height=200)
+        assert api._ocr_pages(doc, [0, 1, 2], 72) == ["200", "400", "600"]
+        doc.close()
+
+    def test_only_weak_pages_are_rerendered(self, monkeypatch):
+        """A low-confidence page is redone at the retry DPI; every page read beats the heartbeat"""
+        monkeypatch.setattr(api, "ocr_image_conf", lambda img, psm=6: (str(img.width), 40 if img.width == 200 else 90))
+        monkeypatch.setattr(api, "OCR_MIN_PAGE_CHARS", 0)
+        doc = fitz.open()
+        for width in (200, 400):
+            doc.new_page(width=width, height=200)
+        beats = []
+        assert api._ocr_pages(doc, [0, 1], 72, heartbeat=lambda: beats.append(1)) == ["834", "400"]
+        assert len(beats) == 3
+        doc.close()
+
+    def test_repeat_uploads_reuse_cached_text(self, tmp_path, monkeypatch):
+        """The same PDF, as bytes or from disk, is only OCR'd once"""
+        calls = []
+        monkeypatch.setattr(api, "JOB_DIR", str(tmp_path))
+        monkeypatch.setattr(api, "ocr_ready", lambda: (True, ""))
+        monkeypatch.setattr(api, "_ocr_pages", lambda doc, indices, dpi, heartbeat=None: calls.append(dpi) or ["IOP 28 mmHg OD " * 20])
+        doc, _ = _text_page()
+        pdf = doc.tobytes()
+        doc.close()
+        upload = tmp_path / "upload.pdf"
+        upload.write_bytes(pdf)
+        first = api.ocr_pdf_bytes(pdf)
+        assert api.ocr_pdf_bytes(str(upload)) == first
+        assert first[0].startswith("IOP 28") and calls == [api.OCR_FIRST_DPI]
+
+    def test_cache_prunes_least_recently_used(self, tmp_path, monkeypatch):
+        """Past the size cap, the oldest entries go first"""
+        monkeypatch.setattr(api, "OCR_CACHE_MAX_BYTES", 10)
+        old, new = tmp_path / "aa" / "old.txt", tmp_path / "bb" / "new.txt"
+        for path, mtime in ((old, 1), (new, 2)):
+            path.parent.mkdir()
+            path.write_text("x" * 8)
+            os.utime(path, (mtime, mtime))
+        api._prune_ocr_cache(str(tmp_path))
+        assert not old.exists() and new.exists()
+
+    def test_text_layer_reads_from_bytes_and_disk(self, tmp_path):
+        """Digital PDFs extract the same text from memory or a saved upload"""
+        doc, _ = _text_page()
+        pdf = doc.tobytes()
+        doc.close()
+        upload = tmp_path / "upload.pdf"
+        upload.write_bytes(pdf)
+        assert api.extract_pdf_text(pdf) == "IOP 28 mmHg OD"
+        assert api.extract_pdf_text(str(upload)) == "IOP 28 mmHg OD"
+
+    def test_hybrid_pdf_only_ocrs_scanned_pages(self, tmp_path, monkeypatch):
+        """Typed pages keep their text layer; only the image-only page is OCR'd"""
+        calls = []
+        monkeypatch.setattr(api, "JOB_DIR", str(tmp_path))
+        monkeypatch.setattr(api, "ocr_ready", lambda: (True, ""))
+        monkeypatch.setattr(api, "_ocr_pages", lambda doc, indices, dpi, heartbeat=None: calls.append(indices) or ["Scanned referral"])
+        doc = fitz.open()
+        typed = doc.new_page()
+        typed.insert_textbox(typed.rect + (72, 72, -72, -72), "Visual acuity 20/40 OD, 20/25 OS. " * 12, fontsize=11)
+        scan = doc.new_page()
+        scan.insert_image(fitz.Rect(72, 72, 272, 272), pixmap=fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 20, 20), False))
+        pdf = doc.tobytes()
+        doc.close()
+        text, err, ocr_attempted = api.extract_or_ocr(pdf)
+        assert calls == [[1]] and not err and ocr_attempted
+        assert text.startswith("Visual acuity") and text.endswith("Scanned referral")
+
+    def test_unreadable_layer_ocrs_every_text_poor_page(self, tmp_path, monkeypatch):
+        """Pages without a listed image are still OCR'd when the whole layer is unusable"""
+        calls = []
+        monkeypatch.setattr(api, "JOB_DIR", str(tmp_path))
+        monkeypatch.setattr(api, "ocr_ready", lambda: (True, ""))
+        monkeypatch.setattr(api, "_ocr_pages", lambda doc, indices, dpi, heartbeat=None: calls.append(indices) or ["Scanned"] * len(indices))
+        doc = fitz.open()
+        doc.new_page()
+        stamp = doc.new_page()
+        stamp.insert_text((72, 72), "Page 2", fontsize=11)
+        pdf = doc.tobytes()
+        doc.close()
+        text, err, ocr_attempted = api.extract_or_ocr(pdf)
+        assert calls == [[0, 1]] and not err and ocr_attempted
+        assert text == "Scanned\nScanned"
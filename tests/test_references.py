@@ -0,0 +1,40 @@
+"""
+Reference selection tests
+"""
+from app import api
+
+
+class TestPediatricFilter:
+    """Test pediatric reference filtering"""
+
+    def test_matches_whole_words_only(self):
+        """Short keywords like 'rop' must not match inside other words"""
+        assert api.is_pediatric_reference("Retinopathy of prematurity screening")
+        assert api.is_pediatric_reference("ROP treatment outcomes")
+        assert not api.is_pediatric_reference("European Glaucoma Society Guidelines")
+        for title in ("Pediatrics", "Paediatrics", "Outcomes in neonates", "Congenitally absent lens"):
+            assert api.is_pediatric_reference(title)
+        assert not api.is_pediatric_reference("Cropped fundus images")
+
+    def test_adult_pool_keeps_adult_guidelines(self):
+        """Adult glaucoma patients still get the EGS guideline"""
+        pool = api.canonical_reference_pool(["primary open angle glaucoma"], patient_age=64)
+        assert any("European Glaucoma Society" in r["citation"] for r in pool)
+
+
+class TestCanonicalPool:
+    """Test canonical_reference_pool memoization"""
+
+    def test_equivalent_labels_share_cache_entry(self):
+        """Case and whitespace differences should hit the same cache entry"""
+        api._canonical_reference_pool_cached.cache_clear()
+        first = api.canonical_reference_pool(["Hypertension "], patient_age=50)
+        second = api.canonical_reference_pool(["hypertension", None], patient_age=70)
+        assert first == second
+        assert api._canonical_reference_pool_cached.cache_info().hits == 1
+
+    def test_returned_entries_are_independent_copies(self):
+        """Mutating a result must not corrupt the cached pool"""
+        pool = api.canonical_reference_pool(["asthma"])
+        pool[0]["citation"] = "changed"
+        assert api.canonical_reference_pool(["asthma"])[0]["citation"] != "changed"